@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Throughput and latency of relays and proxies on loopback
+
+    python -m benchmarks.bench [--targets TCPProxy,UDPProxy] [--forwarders thread,selector] [--output results.json]
+
+    Tests:
+      - stream: messages of SIZE are sent to a sink, MB/s and messages/s
+        are computed from what reached it
+      - rr: messages of SIZE are echoed one at a time, messages/s and the
+        latency of round trips
+      - connect: connections are opened, one byte is echoed and they are
+        closed, connections/s and the latency until the echo
+
+    Every test runs in CONCURRENCY connections spread over client processes,
+    servers and targets have their own process. Results are written in JSON,
+    to be compared with benchmarks.compare.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import argparse
+import subprocess
+import multiprocessing
+
+from pynet.forwarder import get_forwarder
+
+from benchmarks.servers import run_servers
+from benchmarks.load import run_threads,wait_ready,Result
+from benchmarks.targets import TARGETS,TLSProxyTarget
+
+TESTS = ("stream","rr","connect")
+MB = 1000000.
+
+
+def parse_list(value,type=str):
+    return [type(v) for v in value.split(",") if v]
+
+
+def parse_forwarders(value):
+    """ Keep the names, targets are given them, asyncio needs async endpoints """
+    names = parse_list(value)
+    for name in names:
+        if name == "asyncio":
+            raise argparse.ArgumentTypeError("The asyncio forwarder only relays async endpoints")
+        get_forwarder(name)
+    return names
+
+
+def percentile(latencies,p):
+    if not latencies: return None
+    return latencies[min(len(latencies)-1,int(len(latencies)*p))]
+
+
+class Benchmark(object):
+    def __init__(self,args):
+        self.args = args
+        self.context = multiprocessing.get_context("fork")
+        self.results = []
+        self.skipped = []
+        self.tmp = tempfile.mkdtemp(prefix="pynet-bench-")
+        host = "127.0.0.1"
+        # Addresses of the servers by transport, clients of the targets connect to the listen ones
+        self.servers = {"tcp":(host,args.port),"udp":(host,args.port),"tls":(host,args.port+1),"unix":os.path.join(self.tmp,"server.sock")}
+        self.listen = {"tcp":(host,args.port+2),"udp":(host,args.port+2),"tls":(host,args.port+3),"unix":os.path.join(self.tmp,"proxy.sock")}
+
+    def start_servers(self):
+        conf = {"tcp":self.servers["tcp"],"udp":self.servers["udp"],"unix":self.servers["unix"]}
+        if "TLSProxy" in self.args.targets and not TLSProxyTarget.unavailable():
+            certificate,key = TLSProxyTarget.certificate()
+            conf.update({"tls":self.servers["tls"],"certificate":certificate,"key":key})
+        self.server_process = self.context.Process(target=run_servers,kwargs=conf,daemon=True)
+        self.server_process.start()
+        for kind in ("tcp","udp","unix"):
+            wait_ready(kind,self.servers[kind])
+
+    def stop(self,process):
+        process.terminate()
+        process.join(2)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+    def run_clients(self,test,kind,address,size,concurrency):
+        """ Spread concurrency connections over client processes, return their Result """
+        processes = max(1,min(concurrency,self.args.clients))
+        threads = [concurrency//processes + (1 if i < concurrency % processes else 0) for i in range(processes)]
+        total = Result()
+        with self.context.Pool(processes) as pool:
+            for res in pool.starmap(run_threads,[(test,kind,address,size,self.args.duration,n) for n in threads]):
+                total.add(res)
+        return total
+
+    def run_one(self,name,target_cls,forwarder,test,size,concurrency):
+        kind = target_cls.kind
+        address = self.servers[kind]
+        process = None
+        if target_cls.relayed:
+            target = target_cls(self.listen[kind],self.servers[kind],forwarder)
+            process = self.context.Process(target=target.run,daemon=True)
+            process.start()
+            address = self.listen[kind]
+            # Single targets would be done with the probe
+            if not target_cls.single:
+                wait_ready(kind,address)
+        try:
+            res = self.run_clients(test,kind,address,size,concurrency)
+        finally:
+            if process: self.stop(process)
+
+        latencies = sorted(res.latencies)
+        elapsed = res.elapsed if res.elapsed else self.args.duration
+        result = {"target":name,
+                  "transport":kind,
+                  "forwarder":forwarder if target_cls.relayed else None,
+                  "test":test,
+                  "size":size,
+                  "concurrency":concurrency,
+                  "duration":round(elapsed,3),
+                  "bytes":res.bytes,
+                  "messages":res.messages,
+                  "connections":res.connections,
+                  "errors":res.errors,
+                  "lost":res.lost,
+                  "mb_per_s":round(res.bytes/elapsed/MB,3),
+                  "messages_per_s":round(res.messages/elapsed,1),
+                  "connections_per_s":round(res.connections/elapsed,1) if test == "connect" else None,
+                  "latency_p50_ms":None,
+                  "latency_p99_ms":None,
+                  "latency_max_ms":None}
+        if latencies:
+            result.update({"latency_p50_ms":round(percentile(latencies,.5)*1000,4),
+                           "latency_p99_ms":round(percentile(latencies,.99)*1000,4),
+                           "latency_max_ms":round(latencies[-1]*1000,4)})
+        self.results.append(result)
+        print_result(result)
+
+    def run(self):
+        self.start_servers()
+        try:
+            for name in self.args.targets:
+                target_cls = TARGETS[name]
+                reason = target_cls.unavailable()
+                if reason:
+                    print("%s skipped: %s" % (name,reason))
+                    self.skipped.append({"target":name,"reason":reason})
+                    continue
+                for forwarder in (self.args.forwarders if target_cls.relayed else [None]):
+                    for test in self.args.tests:
+                        # Datagrams have no connection
+                        if test == "connect" and target_cls.kind == "udp": continue
+                        for size in (self.args.sizes if test != "connect" else [1]):
+                            for concurrency in self.args.concurrency:
+                                if target_cls.single and (concurrency > 1 or test == "connect"): continue
+                                self.run_one(name,target_cls,forwarder,test,size,concurrency)
+        finally:
+            self.stop(self.server_process)
+            shutil.rmtree(self.tmp,ignore_errors=True)
+
+    def report(self):
+        return {"meta":metadata(self.args),"results":self.results,"skipped":self.skipped}
+
+
+def print_result(r):
+    line = "%-20s %-9s %-8s size %6d conc %4d:" % (r["target"],r["forwarder"] or "-",r["test"],r["size"],r["concurrency"])
+    if r["test"] == "connect":
+        line += " %9.1f conn/s" % (r["connections_per_s"],)
+    else:
+        line += " %9.2f MB/s %10.1f msg/s" % (r["mb_per_s"],r["messages_per_s"])
+    if r["latency_p50_ms"] is not None:
+        line += "  p50 %.3f ms p99 %.3f ms" % (r["latency_p50_ms"],r["latency_p99_ms"])
+    if r["lost"]:
+        line += "  (%d datagrams lost)" % (r["lost"],)
+    if r["errors"]:
+        line += "  (%d errors)" % (r["errors"],)
+    print(line)
+    sys.stdout.flush()
+
+
+def metadata(args):
+    try:
+        revision = subprocess.run(["git","rev-parse","HEAD"],cwd=os.path.dirname(os.path.abspath(__file__)),capture_output=True,text=True).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {"date":time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "revision":revision,
+            "python":platform.python_version(),
+            "implementation":platform.python_implementation(),
+            "platform":platform.platform(),
+            "cpus":os.cpu_count(),
+            "duration":args.duration,
+            "clients":args.clients}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets",metavar="LIST",default=",".join(TARGETS),type=parse_list,help="Targets to benchmark among %s" % (", ".join(TARGETS),))
+    parser.add_argument("--forwarders",metavar="LIST",default="thread,selector",type=parse_forwarders,help="Forwarders used by the targets (default thread,selector)")
+    parser.add_argument("--tests",metavar="LIST",default=",".join(TESTS),type=parse_list,help="Tests among %s" % (", ".join(TESTS),))
+    parser.add_argument("--sizes",metavar="LIST",default="64,1024,16384,65536",type=lambda v:parse_list(v,int),help="Message sizes in bytes (default 64,1024,16384,65536)")
+    parser.add_argument("--concurrency",metavar="LIST",default="1,16",type=lambda v:parse_list(v,int),help="Numbers of simultaneous connections (default 1,16)")
+    parser.add_argument("--duration",metavar="SECONDS",default=3,type=float,help="Duration of each measure (default 3)")
+    parser.add_argument("--clients",metavar="N",default=max(1,(os.cpu_count() or 2)//2),type=int,help="Client processes generating the load (default half of the CPUs)")
+    parser.add_argument("--port",metavar="PORT",default=9700,type=int,help="First of the 4 ports used on 127.0.0.1 (default 9700)")
+    parser.add_argument("--output","-o",metavar="PATH",help="Write results in JSON to PATH, - for stdout")
+    args = parser.parse_args()
+
+    for name in args.targets:
+        if not name in TARGETS:
+            print("Unknown target %s, choose among %s" % (name,", ".join(TARGETS)))
+            return 1
+    for test in args.tests:
+        if not test in TESTS:
+            print("Unknown test %s, choose among %s" % (test,", ".join(TESTS)))
+            return 1
+    for size in args.sizes:
+        if size < 1 or size > 65000:
+            print("Message sizes must be between 1 and 65000 bytes (datagrams)")
+            return 1
+
+    bench = Benchmark(args)
+    try:
+        bench.run()
+    except KeyboardInterrupt:
+        print("Interrupted, writing the results so far")
+
+    report = json.dumps(bench.report(),indent=2)
+    if args.output == "-":
+        print(report)
+    elif args.output:
+        with open(args.output,"w") as f:
+            f.write(report + "\n")
+        print("Results written to %s" % (args.output,))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
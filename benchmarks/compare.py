@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Compare two result files of benchmarks.bench
+
+    python -m benchmarks.compare BEFORE.json AFTER.json [--tolerance PCT]
+
+    Exit with 1 when a measure got worse than the tolerance.
+"""
+
+import sys
+import json
+import argparse
+
+KEY = ("target","forwarder","test","size","concurrency")
+# Main rate of each test, higher is better
+RATES = {"stream":"mb_per_s","rr":"messages_per_s","connect":"connections_per_s"}
+
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+    return {tuple(r[k] for k in KEY):r for r in report["results"]},report["meta"]
+
+
+def change(before,after):
+    """ Relative change in percent, None if there is nothing to compare """
+    if before is None or after is None or not before:
+        return None
+    return (after - before)*100./before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before",metavar="BEFORE.json")
+    parser.add_argument("after",metavar="AFTER.json")
+    parser.add_argument("--tolerance",metavar="PCT",default=5,type=float,help="Changes smaller than PCT percent are noise (default 5)")
+    args = parser.parse_args()
+
+    before,meta_before = load(args.before)
+    after,meta_after = load(args.after)
+    print("before: %s (%s)" % (meta_before.get("revision"),meta_before.get("date")))
+    print("after:  %s (%s)" % (meta_after.get("revision"),meta_after.get("date")))
+
+    regressions = 0
+    for key in sorted(set(before) & set(after),key=lambda k:tuple(str(v) for v in k)):
+        b,a = before[key],after[key]
+        rate = RATES[key[2]]
+        rate_change = change(b[rate],a[rate])
+        # Latency is better when lower
+        latency_change = change(b["latency_p99_ms"],a["latency_p99_ms"])
+        worse = (rate_change is not None and rate_change < -args.tolerance) or \
+                (latency_change is not None and latency_change > args.tolerance)
+        regressions += worse
+        line = "%-20s %-9s %-8s size %6d conc %4d: %s %10.2f -> %10.2f (%+6.1f%%)" % \
+               (key[0],key[1] or "-",key[2],key[3],key[4],rate,b[rate] or 0,a[rate] or 0,rate_change or 0)
+        if latency_change is not None:
+            line += "  p99 %.3f -> %.3f ms (%+6.1f%%)" % (b["latency_p99_ms"],a["latency_p99_ms"],latency_change)
+        if worse:
+            line += "  WORSE"
+        print(line)
+
+    missing = set(before) ^ set(after)
+    if missing:
+        print("%d measures are only in one of the files" % (len(missing),))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
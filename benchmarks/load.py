@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Clients generating the traffic, each test runs for a duration in every thread """
+
+import ssl
+import time
+import socket
+import struct
+from array import array
+from threading import Thread
+
+from benchmarks.servers import SINK,ECHO,END,PAYLOAD,COUNT,recv_exactly
+
+# Time given to a target to start listening
+READY_TIMEOUT = 10
+# A datagram not echoed after that is lost
+DATAGRAM_TIMEOUT = 1
+
+
+def connect(kind,address,timeout=READY_TIMEOUT):
+    """ Return a socket connected to address, wait for it to be listening during timeout """
+    deadline = time.monotonic() + timeout
+    while True:
+        family = socket.AF_UNIX if kind == "unix" else socket.AF_INET
+        sock = socket.socket(family,socket.SOCK_DGRAM if kind == "udp" else socket.SOCK_STREAM)
+        try:
+            sock.connect(address)
+        except (ConnectionRefusedError,FileNotFoundError):
+            sock.close()
+            if time.monotonic() > deadline: raise
+            time.sleep(0.05)
+            continue
+        if family == socket.AF_INET and kind != "udp":
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        if kind == "tls":
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            sock = context.wrap_socket(sock)
+        return sock
+
+
+def wait_ready(kind,address):
+    """ Wait until an echo goes through the target """
+    if kind == "udp":
+        sock = connect(kind,address)
+        sock.settimeout(0.1)
+        deadline = time.monotonic() + READY_TIMEOUT
+        try:
+            while True:
+                sock.send(ECHO)
+                try:
+                    if sock.recv(16) == ECHO: return
+                except (socket.timeout,ConnectionRefusedError):
+                    if time.monotonic() > deadline: raise
+        finally:
+            sock.close()
+    sock = connect(kind,address)
+    try:
+        sock.sendall(ECHO + PAYLOAD)
+        recv_exactly(sock,1)
+    finally:
+        sock.close()
+
+
+class Result(object):
+    """ What a thread has measured, added up over threads and processes """
+
+    def __init__(self):
+        self.bytes = 0
+        self.messages = 0
+        self.connections = 0
+        self.errors = 0
+        # Datagrams which did not come through
+        self.lost = 0
+        self.elapsed = 0.
+        self.latencies = array("d")
+
+    def add(self,other):
+        self.bytes += other.bytes
+        self.messages += other.messages
+        self.connections += other.connections
+        self.errors += other.errors
+        self.lost += other.lost
+        self.elapsed = max(self.elapsed,other.elapsed)
+        self.latencies.extend(other.latencies)
+
+
+def stream(kind,address,size,duration):
+    """ Send messages of size to the sink, count what it has received """
+    res = Result()
+    payload = PAYLOAD*size
+    sock = connect(kind,address)
+    try:
+        start = time.monotonic()
+        sock.sendall(SINK)
+        end = start + duration
+        while time.monotonic() < end:
+            for i in range(16):
+                sock.sendall(payload)
+        sock.sendall(END)
+        res.bytes = COUNT.unpack(recv_exactly(sock,COUNT.size))[0]
+        res.elapsed = time.monotonic() - start
+        res.messages = res.bytes // size
+        res.connections = 1
+    except OSError:
+        res.errors += 1
+    finally:
+        sock.close()
+    return res
+
+
+def request_response(kind,address,size,duration):
+    """ Send a message of size to the echo server and wait for it, again and again """
+    res = Result()
+    if kind == "udp":
+        return datagram_request_response(address,size,duration)
+    payload = ECHO*size
+    sock = connect(kind,address)
+    perf_counter = time.perf_counter
+    try:
+        sock.sendall(ECHO)
+        start = time.monotonic()
+        end = start + duration
+        while time.monotonic() < end:
+            t = perf_counter()
+            sock.sendall(payload)
+            recv_exactly(sock,size)
+            res.latencies.append(perf_counter() - t)
+        res.elapsed = time.monotonic() - start
+        res.messages = len(res.latencies)
+        res.bytes = res.messages*size
+        res.connections = 1
+    except OSError:
+        res.errors += 1
+    finally:
+        sock.close()
+    return res
+
+
+def datagram_request_response(address,size,duration):
+    res = Result()
+    payload = ECHO*size
+    sock = connect("udp",address)
+    sock.settimeout(DATAGRAM_TIMEOUT)
+    perf_counter = time.perf_counter
+    try:
+        start = time.monotonic()
+        end = start + duration
+        while time.monotonic() < end:
+            t = perf_counter()
+            sock.send(payload)
+            try:
+                # Late answers of lost datagrams are skipped
+                while len(sock.recv(65536)) != size:
+                    pass
+            except socket.timeout:
+                res.lost += 1
+                continue
+            res.latencies.append(perf_counter() - t)
+        res.elapsed = time.monotonic() - start
+        res.messages = len(res.latencies)
+        res.bytes = res.messages*size
+    finally:
+        sock.close()
+    return res
+
+
+def datagram_stream(address,size,duration):
+    """ Send datagrams of size as fast as possible, count those which reached the server """
+    res = Result()
+    payload = PAYLOAD*size
+    sock = connect("udp",address)
+    try:
+        start = time.monotonic()
+        end = start + duration
+        sent = 0
+        while time.monotonic() < end:
+            for i in range(16):
+                try:
+                    sock.send(payload)
+                except (BlockingIOError,ConnectionRefusedError):
+                    pass
+            sent += 16
+        # Let the last datagrams go through
+        time.sleep(0.1)
+        sock.settimeout(DATAGRAM_TIMEOUT)
+        sock.send(END)
+        try:
+            res.bytes = COUNT.unpack(sock.recv(COUNT.size))[0]
+        except (socket.timeout,struct.error):
+            res.errors += 1
+        res.elapsed = time.monotonic() - start
+        res.messages = res.bytes // size
+        res.lost = sent - res.messages
+    finally:
+        sock.close()
+    return res
+
+
+def connection_setup(kind,address,size,duration):
+    """ Open a connection, exchange one byte and close it, again and again """
+    res = Result()
+    perf_counter = time.perf_counter
+    start = time.monotonic()
+    end = start + duration
+    while time.monotonic() < end:
+        t = perf_counter()
+        try:
+            sock = connect(kind,address,0)
+        except OSError:
+            res.errors += 1
+            continue
+        try:
+            sock.sendall(ECHO + PAYLOAD)
+            recv_exactly(sock,1)
+            res.latencies.append(perf_counter() - t)
+        except OSError:
+            res.errors += 1
+        finally:
+            sock.close()
+    res.elapsed = time.monotonic() - start
+    res.connections = res.messages = len(res.latencies)
+    return res
+
+
+def stream_test(kind,address,size,duration):
+    if kind == "udp":
+        return datagram_stream(address,size,duration)
+    return stream(kind,address,size,duration)
+
+
+TESTS = {"stream":stream_test,"rr":request_response,"connect":connection_setup}
+
+
+def run_threads(test,kind,address,size,duration,threads):
+    """ Run test in threads, in a client process """
+    results = [None]*threads
+    def run(i):
+        try:
+            results[i] = TESTS[test](kind,address,size,duration)
+        except OSError:
+            results[i] = Result()
+            results[i].errors += 1
+    workers = [Thread(target=run,args=(i,)) for i in range(threads)]
+    for w in workers: w.start()
+    for w in workers: w.join()
+    total = Result()
+    for r in results:
+        total.add(r)
+    return total
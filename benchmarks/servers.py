@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Servers behind the benchmarked relays and proxies
+
+    Stream clients first send a command byte:
+      - SINK: everything is read until the END byte, then the number of bytes
+        received is sent back on 8 bytes
+      - ECHO: everything is sent back
+
+    Datagrams starting with ECHO are sent back, END asks for the number of
+    bytes received from the client since its previous END, others are counted.
+"""
+
+import os
+import ssl
+import struct
+import socket
+from threading import Thread
+
+SINK = b"S"
+ECHO = b"E"
+END = b"\x00"
+# Byte of the payloads, never END
+PAYLOAD = b"x"
+
+COUNT = struct.Struct("!Q")
+
+READ_SIZE = 1 << 18
+
+
+def recv_exactly(sock,size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed by peer")
+        data += chunk
+    return bytes(data)
+
+
+def handle_stream(sock):
+    try:
+        command = sock.recv(1)
+        if command == SINK:
+            received = 0
+            while True:
+                data = sock.recv(READ_SIZE)
+                if not data: return
+                received += len(data)
+                if data[-1:] == END:
+                    break
+            sock.sendall(COUNT.pack(received - 1))
+        elif command == ECHO:
+            while True:
+                data = sock.recv(READ_SIZE)
+                if not data: return
+                sock.sendall(data)
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
+
+def serve_stream(listen,context=None):
+    while True:
+        sock,_ = listen.accept()
+        if context:
+            try:
+                sock = context.wrap_socket(sock,server_side=True)
+            except (OSError,ssl.SSLError):
+                sock.close()
+                continue
+        elif sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        Thread(target=handle_stream,args=(sock,),daemon=True).start()
+
+
+def serve_datagram(sock):
+    received = {}
+    while True:
+        data,addr = sock.recvfrom(65536)
+        if data[:1] == ECHO:
+            sock.sendto(data,addr)
+        elif data == END:
+            sock.sendto(COUNT.pack(received.pop(addr,0)),addr)
+        else:
+            received[addr] = received.get(addr,0) + len(data)
+
+
+def listen_stream(family,address,backlog=socket.SOMAXCONN):
+    if family == socket.AF_UNIX and os.path.exists(address):
+        os.unlink(address)
+    sock = socket.socket(family,socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+
+def run_servers(tcp=None,udp=None,unix=None,tls=None,certificate=None,key=None):
+    """ Serve the addresses which are given, until the process is killed """
+    threads = []
+    if tcp:
+        threads.append(Thread(target=serve_stream,args=(listen_stream(socket.AF_INET,tcp),)))
+    if unix:
+        threads.append(Thread(target=serve_stream,args=(listen_stream(socket.AF_UNIX,unix),)))
+    if tls:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certificate,key)
+        threads.append(Thread(target=serve_stream,args=(listen_stream(socket.AF_INET,tls),context)))
+    if udp:
+        sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,1 << 22)
+        sock.bind(udp)
+        threads.append(Thread(target=serve_datagram,args=(sock,)))
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Relays and proxies under benchmark, each one runs in its own process """
+
+import os
+import socket
+
+from pynet.forwarder import get_forwarder
+from pynet.proxy import Relay,MultipleClientRelay
+from pynet.endpoints.socket import TCP,TCP_LISTEN
+
+
+class Target(object):
+    """ Listen on listen and relay clients to server
+
+        kind is the transport of clients and of the server, single targets
+        relay only one connection then exit.
+    """
+    kind = "tcp"
+    single = False
+    relayed = True
+
+    def __init__(self,listen,server,forwarder):
+        self.listen = listen
+        self.server_address = server
+        self.forwarder = get_forwarder(forwarder)
+
+    @classmethod
+    def unavailable(cls):
+        """ Reason why this target cannot be benchmarked here, None if it can """
+        return None
+
+    def run(self):
+        raise NotImplementedError()
+
+
+class Direct(Target):
+    """ No relay, clients talk to the server: the reference of the loopback and load generators """
+    relayed = False
+
+    def run(self):
+        pass
+
+
+class RelayTarget(Target):
+    """ Relay between an accepted client and a connection to the server """
+    single = True
+
+    def run(self):
+        listen = socket.socket()
+        listen.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        listen.bind(self.listen)
+        listen.listen(1)
+        sock,addr = listen.accept()
+        listen.close()
+        client = TCP(destination=addr[0],dport=addr[1],sock=sock)
+        # The client endpoint is already connected
+        client.init = lambda:None
+        server = TCP.from_cli({"destination":self.server_address[0],"dport":self.server_address[1]})
+        Relay(client,server,forwarder=self.forwarder).run()
+
+
+class MultipleClientRelayTarget(Target):
+    def run(self):
+        client = TCP_LISTEN.from_cli({"bind":self.listen[0],"sport":self.listen[1]})
+        # Duplicated for every client
+        server = TCP.from_cli({"destination":self.server_address[0],"dport":self.server_address[1]})
+        MultipleClientRelay(client,server,forwarder=self.forwarder).run()
+
+
+class TCPProxyTarget(Target):
+    def run(self):
+        from pynet.proxys.layer4 import TCPProxy
+        TCPProxy(bind=self.listen[0],port=self.listen[1],server_ip=self.server_address[0],server_port=self.server_address[1],forwarder=self.forwarder).run()
+
+
+class UDPProxyTarget(Target):
+    kind = "udp"
+
+    def run(self):
+        from pynet.proxys.layer4 import UDPProxy
+        UDPProxy(bind=self.listen[0],port=self.listen[1],server_ip=self.server_address[0],server_port=self.server_address[1],forwarder=self.forwarder).run()
+
+
+class UnixSocketProxyTarget(Target):
+    kind = "unix"
+
+    def run(self):
+        from pynet.proxys.layer4 import UnixSocketProxy
+        UnixSocketProxy(bind=self.listen,destination=self.server_address,forwarder=self.forwarder).run()
+
+
+class TLSProxyTarget(Target):
+    kind = "tls"
+
+    @classmethod
+    def unavailable(cls):
+        try:
+            import pynet.proxys.tls
+        except ImportError as e:
+            return str(e)
+        return None
+
+    @classmethod
+    def certificate(cls):
+        """ Certificate and key of the proxy, also used by the TLS server """
+        from pynet.endpoints.tls import CA,CAKEY,create_certificate
+        if not os.path.exists(CA):
+            create_certificate(CA,CAKEY)
+        return CA,CAKEY
+
+    def run(self):
+        from pynet.proxys.tls import TLSProxy
+        certificate,key = self.certificate()
+        TLSProxy(certificate=certificate,key=key,tls_version="TLS",bind=self.listen[0],port=self.listen[1],server_ip=self.server_address[0],server_port=self.server_address[1],forwarder=self.forwarder).run()
+
+
+TARGETS = {"direct":Direct,
+           "Relay":RelayTarget,
+           "MultipleClientRelay":MultipleClientRelayTarget,
+           "TCPProxy":TCPProxyTarget,
+           "UDPProxy":UDPProxyTarget,
+           "UnixSocketProxy":UnixSocketProxyTarget,
+           "TLSProxy":TLSProxyTarget}
@@ -2,9 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import socket
 from collections import defaultdict
 
 from pynet.tools.utils import Register
+from pynet.tools.buffers import get_pool
 from pynet.plugin import Plugin
 from pynet.proto import *
 
@@ -22,30 +24,92 @@ class Endpoint(Plugin):
     EP1 = True
     EP2 = True
 
+    READ_SIZE = 4096
+    MAX_READ_SIZE = 1 << 18
+
+    # Called by do_close instead of close while a forwarder watches the file descriptor
+    closer = None
+
+    # Used by endpoints that do not call Endpoint.__init__
+    read_size = READ_SIZE
+    min_read_size = READ_SIZE
+    adaptive_read = False
+
     @classmethod
     def set_cli_arguments(cls,parser):
         super().set_cli_arguments(parser)
         parser.add_argument("--proto",metavar="PROTO",type=lambda p:eval(p),default=NoProto(),help="Use a specific protocol : %s" % (",".join([x.__name__ for x in ProtoRegister.itervalues()])))
+        io = parser.add_argument_group('I/O',"Read and kernel buffer sizes")
+        io.add_argument("--read-size",metavar="SIZE",type=int,help="Size of a read (default %u)" % (cls.READ_SIZE,))
+        io.add_argument("--adaptive-read",action="store_true",help="Grow the read size while reads fill it, shrink it back for small messages")
+        io.add_argument("--rcvbuf",metavar="SIZE",type=int,help="Kernel receive buffer size (SO_RCVBUF)")
+        io.add_argument("--sndbuf",metavar="SIZE",type=int,help="Kernel send buffer size (SO_SNDBUF)")
 
-    def __init__(self,proto=NoProto(),*args,**kargs):
+    def __init__(self,proto=NoProto(),read_size=None,adaptive_read=False,rcvbuf=None,sndbuf=None,*args,**kargs):
         super().__init__(*args,**kargs)
         self.proto = proto
         self.stop = False
+        self.read_size = read_size if read_size else self.READ_SIZE
+        self.min_read_size = self.read_size
+        self.adaptive_read = adaptive_read
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
 
     def get_conf(self):
         """ Use if we need to duplicate EndPoint, to keep the mandatory parameters """
-        return {"proto":self.proto}
+        return {"proto":self.proto,"read_size":self.min_read_size,"adaptive_read":self.adaptive_read,"rcvbuf":self.rcvbuf,"sndbuf":self.sndbuf}
+
+    def set_socket_buffers(self,sock):
+        """ Set kernel buffer sizes asked by the user """
+        if getattr(self,"rcvbuf",None):
+            sock.setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,self.rcvbuf)
+        if getattr(self,"sndbuf",None):
+            sock.setsockopt(socket.SOL_SOCKET,socket.SO_SNDBUF,self.sndbuf)
+
+    def update_read_size(self,sz):
+        """ In adaptive mode, grow the read size while reads fill it and shrink it for interactive traffic """
+        if not self.adaptive_read: return
+        if sz >= self.read_size:
+            self.read_size = min(self.read_size*2,max(self.MAX_READ_SIZE,self.min_read_size))
+        elif sz < self.read_size//4:
+            self.read_size = max(self.read_size//2,self.min_read_size)
 
     def init(self):
         pass
 
     def do_close(self):
         self.stop = True
-        self.close()
+        if self.closer is None:
+            self.close()
+        else:
+            self.closer(self)
 
     def close(self):
         pass
 
+    def get_buffer(self,size):
+        """ Borrow a receive buffer, it belongs to the endpoint until release_buffers is called """
+        pool = get_pool(size)
+        buf = pool.get()
+        if not hasattr(self,"buffers"): self.buffers = []
+        self.buffers.append((pool,buf))
+        return buf
+
+    def release_buffers(self):
+        """ Called by the forwarder once received data has been sent """
+        buffers = getattr(self,"buffers",None)
+        while buffers:
+            pool,buf = buffers.pop()
+            pool.put(buf)
+
+    def is_alive(self):
+        """ False if the peer of an idle endpoint is known to have closed it """
+        return True
+
+    def splice_fd(self):
+        """ File descriptor usable with splice when data can bypass the endpoint code, None otherwise """
+        return None
+
     def do_recv(self):
         if self.stop: raise EndpointClose()
         return self.recv()
@@ -54,16 +118,56 @@ class Endpoint(Plugin):
         if self.stop: raise EndpointClose()
         return self.send(data)
 
+    def proto_error(self,e):
+        print("Protocol error on %r : %s" % (self,e))
+        self.do_close()
+        raise EndpointClose()
+
     def proto_recv(self):
-        return self.proto.remove(self.do_recv())
+        data = self.do_recv()
+        try:
+            return self.proto.remove(data)
+        except ProtoError as e:
+            self.proto_error(e)
+
+    def proto_recv_batch(self):
+        """ proto_recv of endpoints whose recv returns a list of datagrams, each one goes through the protocol on its own """
+        res = []
+        for d in self.do_recv():
+            try:
+                msgs = self.proto.remove(d)
+            except ProtoError as e:
+                self.proto_error(e)
+            if msgs is None: continue
+            res.extend(msgs if type(msgs) is list else [msgs])
+        return res
+
+    def do_send_vectored(self,pkts):
+        """ Send packets made of fragments, endpoints able to gather fragments in one call override it """
+        for frags in pkts:
+            self.do_send(frags[0] if len(frags) == 1 else b"".join(frags))
+
+    def can_send_nowait(self):
+        """ True if send_nowait is available """
+        return False
+
+    def send_nowait(self,frags):
+        """ Send what can be sent without blocking, return the fragments left """
+        raise NotImplementedError()
+
+    def proto_pack(self,data):
+        """ Return the packets, as lists of fragments, to send for these messages """
+        data = data if type(data) is list else [data]
+        pkts = []
+        try:
+            for d in data:
+                pkts.extend(self.proto.add_vectored(d))
+        except ProtoError as e:
+            self.proto_error(e)
+        return pkts
 
     def proto_send(self,data):
-        data = data if type(data) is list else [data]
-        for d in data:
-            pkts = self.proto.add(d)
-            pkts = pkts if type(pkts) is list else [pkts]
-            for pkt in pkts:
-                self.do_send(pkt)
+        self.do_send_vectored(self.proto_pack(data))
 
     def __repr__(self):
         return "%s" % (self.__class__.__name__,)
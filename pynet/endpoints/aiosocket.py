@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import asyncio
+import socket
+
+from pynet.endpoint import *
+from pynet.endpoints.socket import *
+
+
+class AsyncSOCKET(SOCKET):
+    """ Socket endpoint driven by an asyncio loop, to be used with AsyncForwarder """
+
+    async def init(self):
+        self.create_socket()
+        self.sock.setblocking(False)
+        self.set_socket_buffers(self.sock)
+        self.bind()
+        await self.connect()
+
+    def close(self):
+        # The fd must leave the loop before being closed, it would be reused by the next socket
+        try:
+            loop = asyncio.get_running_loop()
+            loop.remove_reader(self.sock.fileno())
+            loop.remove_writer(self.sock.fileno())
+        except (RuntimeError,ValueError):
+            pass
+        super().close()
+
+    async def connect(self):
+        if self.connect_addr:
+            try:
+                await asyncio.wait_for(asyncio.get_running_loop().sock_connect(self.sock,self.connect_addr),self.connect_timeout)
+            except (OSError,asyncio.TimeoutError) as e:
+                print("Unable to connect: %s" % (e or "timeout",))
+                self.do_close()
+                raise EndpointClose()
+
+    async def send(self,data):
+        try:
+            await asyncio.get_running_loop().sock_sendall(self.sock,data)
+        except:
+            self.do_close()
+            raise EndpointClose()
+
+    async def recv(self):
+        buf = self.get_buffer(self.read_size)
+        try:
+            sz = await asyncio.get_running_loop().sock_recv_into(self.sock,buf)
+        except:
+            sz = 0
+        if sz == 0:
+            self.do_close()
+            raise EndpointClose()
+        self.update_read_size(sz)
+        return memoryview(buf)[:sz]
+
+    async def do_recv(self):
+        if self.stop: raise EndpointClose()
+        return await self.recv()
+
+    async def do_send(self,data):
+        if self.stop: raise EndpointClose()
+        return await self.send(data)
+
+    async def proto_recv(self):
+        data = await self.do_recv()
+        try:
+            return self.proto.remove(data)
+        except ProtoError as e:
+            self.proto_error(e)
+
+    async def proto_send(self,data):
+        await self.do_send_vectored(self.proto_pack(data))
+
+    async def do_send_vectored(self,pkts):
+        if self.sock.type == socket.SOCK_STREAM:
+            # The loop has no sendmsg, join everything for a single send
+            pkts = [[b"".join(f for frags in pkts for f in frags)]] if len(pkts) > 0 else []
+        for frags in pkts:
+            await self.do_send(frags[0] if len(frags) == 1 else b"".join(frags))
+
+
+class AsyncSocketListen(AsyncSOCKET):
+    """ Accept clients without blocking the asyncio loop """
+
+    async def init(self):
+        self.create_socket()
+        self.sock.setblocking(False)
+        self.set_socket_buffers(self.sock)
+        self.bind()
+
+    async def accept(self):
+        csock,caddr = await asyncio.get_running_loop().sock_accept(self.sock)
+        csock.setblocking(False)
+        return self.create_socket_client(sock=csock)
+
+
+class AsyncTCP(AsyncSOCKET,TCP):
+    _desc_ = "TCP Client (asyncio)"
+
+
+class AsyncTCP_LISTEN(AsyncSocketListen,TCP_LISTEN):
+    _desc_ = "TCP Server (asyncio)"
+
+    async def handle_new_client(self):
+        """ Handle the connection of a new client """
+        endpoint_client = await self.accept()
+        return endpoint_client,self.get_original_dst(endpoint_client)
+
+
+class AsyncUDP(AsyncSOCKET,UDP):
+    _desc_ = "UDP Client (asyncio)"
+
+
+class AsyncUnixSocketConnect(AsyncSOCKET,UnixSocketConnect):
+    _desc_ = "Unix socket Stream mode (asyncio)"
+
+
+class AsyncUnixSocketListen(AsyncSocketListen,UnixSocketListen):
+    _desc_ = "Unix Socket Listen in stream mode (asyncio)"
+
+    async def accept(self):
+        csock,addr = await asyncio.get_running_loop().sock_accept(self.sock)
+        csock.setblocking(False)
+        return self.create_socket_client(sock=csock,bind=self.bind_addr)
+
+    async def handle_new_client(self):
+        """ Handle the connection of a new client """
+        endpoint_client = await self.accept()
+        return endpoint_client,None
+
+
+# Synchronous endpoints having an asyncio variant
+ASYNC_ENDPOINTS = {TCP:AsyncTCP,
+                   TCP_LISTEN:AsyncTCP_LISTEN,
+                   UDP:AsyncUDP,
+                   UnixSocketConnect:AsyncUnixSocketConnect,
+                   UnixSocketListen:AsyncUnixSocketListen}
+
+def get_async_endpoint(cls):
+    """ Return the asyncio variant of an endpoint class """
+    try:
+        return ASYNC_ENDPOINTS[cls]
+    except KeyError:
+        raise NotImplementedError("No asyncio variant for %s endpoint, available ones : %s" % (cls.get_cmdline_name(),",".join(c.get_cmdline_name() for c in ASYNC_ENDPOINTS)))
@@ -54,16 +54,20 @@ class Exec(Endpoint):
     def start_cmd(self):
         self.process = subprocess.Popen(self.cmd,shell=True,stdin=self.stdin,stdout=self.stdout,stderr=self.stdout)
 
+    def fileno(self):
+        return self.process.stdout.fileno()
+
     def send(self,data):
         self.process.stdin.write(data)
         self.process.stdin.flush()
 
     def recv(self):
-        data = self.process.stdout.read(4096)
+        data = self.process.stdout.read(self.read_size)
         if self.process.poll() == 0:
             print("End command")
             raise EndpointClose()
         if not data or len(data) == 0:
             pass
         else:
+            self.update_read_size(len(data))
             return data
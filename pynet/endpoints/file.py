@@ -15,12 +15,12 @@ class FILE(OutputEndpoint):
         parser.add_argument("--path","-p",metavar="PATH",help="File to write")
         parser.add_argument("--append","-a",action="store_true",help="Append to file")
 
-    def __init__(self,path,append=False):
-        super().__init__()
+    def __init__(self,path,append=False,*args,**kargs):
+        super().__init__(*args,**kargs)
         self.path = path
         if not append: open(self.path,"w").close()
 
     def send(self,data):
         """ Call to receive data """
         with open(self.path,"a") as f:
-            f.write(data.decode())
+            f.write(bytes(data).decode())
@@ -50,6 +50,7 @@ class Interface(Endpoint):
 
     def init(self):
         self.create_socket()
+        self.set_socket_buffers(self.sock)
         if self.bpf: self.set_bpf_filter(self.bpf[0],self.bpf[1])
         if self.addr: self.set_ip(self.addr)
         if self.promisc: self.set_promisc(self.promisc)
@@ -67,6 +68,9 @@ class Interface(Endpoint):
     def bind(self):
         self.sock.bind((self.iface,0))
 
+    def fileno(self):
+        return self.sock.fileno()
+
     def set_up(self):
         """ iconfig IF up """
         ifr = struct.pack("%usH" % Interface.IFNAMSIZE, self.iface, Interface.IFF_UP)
@@ -97,14 +101,16 @@ class Interface(Endpoint):
             raise EndpointClose()
 
     def recv(self):
+        buf = self.get_buffer(self.read_size)
         try:
-            data = self.sock.recv(4096)
+            sz = self.sock.recv_into(buf)
         except:
-            data = ""
-        if len(data) == 0:
+            sz = 0
+        if sz == 0:
             self.do_close()
             raise EndpointClose()
-        return data
+        self.update_read_size(sz)
+        return memoryview(buf)[:sz]
 
     def set_bpf_filter(self,host,port):
         from pynet.tools.bpf import BPFNetwork
@@ -130,6 +136,7 @@ class VirtualInterface(Interface):
     IFF_TUN   = 0x0001
     IFF_TAP   = 0x0002
     IFF_NO_PI = 0x1000
+    READ_SIZE = Interface.RECV_SIZE
 
     def __init__(self,flags=IFF_TUN|IFF_NO_PI,*args,**kargs):
         super().__init__(*args,**kargs)
@@ -144,8 +151,14 @@ class VirtualInterface(Interface):
     def bind(self):
         pass
 
+    def fileno(self):
+        return self.fd
+
     def recv(self):
-        return os.read(self.fd,Interface.RECV_SIZE)
+        buf = self.get_buffer(self.read_size)
+        sz = os.readv(self.fd,[buf])
+        self.update_read_size(sz)
+        return memoryview(buf)[:sz]
 
     def send(self,data):
         try:
@@ -5,27 +5,97 @@ import sys
 import os
 import socket
 import stat
+import struct
+import argparse
+import time
+from collections import deque
+from threading import Condition,Lock
+from select import select
 
 from pynet.endpoint import *
 from pynet.tools.utils import remove_argument
+from pynet.tools.mmsg import DatagramReceiver,DatagramSender
 
 SO_ORIGINAL_DST = 80 # Socket option
+IOV_MAX = os.sysconf("SC_IOV_MAX") if "SC_IOV_MAX" in os.sysconf_names else 1024
 IP_TRANSPARENT = 19
 IP_RECVORIGDSTADDR = 20
+MAX_DATAGRAM_SIZE = 65536
+TCP_DEFER_ACCEPT = getattr(socket,"TCP_DEFER_ACCEPT",9)
+TCP_INFO = getattr(socket,"TCP_INFO",11)
+TCP_QUICKACK = getattr(socket,"TCP_QUICKACK",12)
+TCP_USER_TIMEOUT = getattr(socket,"TCP_USER_TIMEOUT",18)
+TCP_FASTOPEN = getattr(socket,"TCP_FASTOPEN",23)
+TCP_NOTSENT_LOWAT = getattr(socket,"TCP_NOTSENT_LOWAT",25)
+TCP_FASTOPEN_CONNECT = 30
+
+# TCP options set by each profile, options given one by one take precedence
+TCP_PROFILES = {
+    "default":{},
+    # Small messages are sent and acknowledged at once, little unsent data waits in the kernel
+    "latency":{"nodelay":True,"quickack":True,"fastopen":256,"notsent_lowat":16384},
+    # Full segments and large kernel buffers
+    "throughput":{"nodelay":False,"rcvbuf":1<<22,"sndbuf":1<<22},
+}
+TCP_OPTIONS = ["nodelay","quickack","fastopen","user_timeout","keepalive","notsent_lowat"]
+
+def parse_keepalive(s):
+    """ Parse IDLE,INTERVAL,COUNT """
+    try:
+        idle,interval,count = map(int,s.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError("keepalive must be IDLE,INTERVAL,COUNT")
+    return idle,interval,count
+
+def add_tcp_arguments(parser):
+    tcp = parser.add_argument_group('TCP',"TCP socket options, a profile sets several of them")
+    tcp.add_argument("--tcp-profile",metavar="PROFILE",default="default",choices=list(TCP_PROFILES),help="Set of TCP options between : %s" % (",".join(TCP_PROFILES),))
+    tcp.add_argument("--nodelay",action="store_true",default=None,help="Send small messages without waiting (TCP_NODELAY)")
+    tcp.add_argument("--quickack",action="store_true",default=None,help="Acknowledge received data at once (TCP_QUICKACK)")
+    tcp.add_argument("--fastopen",metavar="QUEUE",type=int,help="Send data with the SYN (TCP_FASTOPEN), QUEUE is the maximum number of pending fast open requests of a listener")
+    tcp.add_argument("--user-timeout",metavar="MS",type=int,help="Close connections whose data is not acknowledged after MS (TCP_USER_TIMEOUT)")
+    tcp.add_argument("--keepalive",metavar="IDLE,INTERVAL,COUNT",type=parse_keepalive,help="Probe connections idle for IDLE seconds, every INTERVAL seconds, COUNT times")
+    tcp.add_argument("--notsent-lowat",metavar="BYTES",type=int,help="Limit unsent data kept by the kernel (TCP_NOTSENT_LOWAT)")
+
+def get_listen_overflows():
+    """ System wide counters of clients dropped because an accept queue was full """
+    try:
+        with open("/proc/net/netstat") as f:
+            lines = f.readlines()
+    except OSError:
+        return 0,0
+    for names,values in zip(lines[::2],lines[1::2]):
+        if names.startswith("TcpExt:"):
+            counters = dict(zip(names.split()[1:],map(int,values.split()[1:])))
+            return counters.get("ListenOverflows",0),counters.get("ListenDrops",0)
+    return 0,0
+
+def drop_sent(frags,sent):
+    """ Drop what has been sent, keep a view on a partially sent fragment """
+    i = 0
+    while i < len(frags) and sent >= len(frags[i]):
+        sent -= len(frags[i])
+        i += 1
+    frags = frags[i:]
+    if sent > 0:
+        frags[0] = memoryview(frags[0])[sent:]
+    return frags
 
 class SOCKET(Endpoint):
     _desc_ = "Socket Client"
     socket_type = None
     socket_family = None
 
-    def __init__(self,sock=None,*args,**kargs):
+    def __init__(self,sock=None,connect_timeout=None,*args,**kargs):
         super().__init__(*args,**kargs)
         self.connect_addr = None
         self.bind_addr = None
         self.sock = sock
+        self.connect_timeout = connect_timeout
 
     def init(self):
         self.create_socket()
+        self.set_socket_buffers(self.sock)
         self.bind()
         self.connect()
 
@@ -41,14 +111,39 @@ class SOCKET(Endpoint):
     def create_socket(self):
         self.sock = socket.socket(self.socket_family,self.socket_type)
 
+    def fileno(self):
+        return self.sock.fileno() if self.sock else None
+
+    def splice_fd(self):
+        # Only plain stream sockets without protocol can be spliced
+        if type(self.sock) is socket.socket and self.sock.type == socket.SOCK_STREAM and type(self.proto) is NoProto:
+            return self.sock.fileno()
+        return None
+
+    def peer_addr(self):
+        return self.sock.getpeername()
+
+    def is_alive(self):
+        try:
+            r,_,_ = select([self.sock],[],[],0)
+            if not r: return True
+            if type(self.sock) is socket.socket:
+                # Readable without data means closed, an idle server is not expected to talk first
+                return len(self.sock.recv(1,socket.MSG_PEEK|socket.MSG_DONTWAIT)) > 0
+            # Data may only be a TLS record, let the first read decide
+            return True
+        except (OSError,ValueError):
+            return False
+
     def connect(self):
+        """ Connect to the destination, errors are raised to the caller """
         if self.connect_addr:
+            #print("[%r] connect to %r" % (self.sock.fileno(),self.connect_addr))
+            self.sock.settimeout(self.connect_timeout)
             try:
-                #print("[%r] connect to %r" % (self.sock.fileno(),self.connect_addr))
                 self.sock.connect(self.connect_addr)
-            except ConnectionRefusedError:
-                print("Connection refused")
-                sys.exit(0)
+            finally:
+                self.sock.settimeout(None)
 
     def bind(self):
         if self.bind_addr:
@@ -58,19 +153,174 @@ class SOCKET(Endpoint):
     def send(self,data):
         #print("[%r] send" % (self.sock.fileno(),))
         try:
-            self.sock.send(data)
+            self.sock.sendall(data)
+        except:
+            self.do_close()
+            raise EndpointClose()
+
+    def sendmsg_all(self,frags):
+        """ Send all fragments, with a single sendmsg when the kernel accepts everything """
+        while len(frags) > 0:
+            sent = self.sock.sendmsg(frags[:IOV_MAX])
+            frags = drop_sent(frags,sent)
+
+    def can_send_nowait(self):
+        return type(self.sock) is socket.socket and self.sock.type == socket.SOCK_STREAM
+
+    def send_nowait(self,frags):
+        if self.stop: raise EndpointClose()
+        try:
+            while len(frags) > 0:
+                sent = self.sock.sendmsg(frags[:IOV_MAX],[],socket.MSG_DONTWAIT)
+                frags = drop_sent(frags,sent)
+        except BlockingIOError:
+            pass
+        except:
+            self.do_close()
+            raise EndpointClose()
+        return frags
+
+    def do_send_vectored(self,pkts):
+        if self.stop: raise EndpointClose()
+        try:
+            if type(self.sock) is not socket.socket:
+                # SSL sockets do not implement sendmsg
+                for frags in pkts:
+                    self.sock.sendall(b"".join(frags))
+            elif self.sock.type == socket.SOCK_STREAM:
+                # No packet boundaries, everything can be gathered
+                frags = [f for frags in pkts for f in frags if len(f) > 0]
+                self.sendmsg_all(frags)
+            else:
+                # One datagram per packet
+                for frags in pkts:
+                    self.sock.sendmsg(frags)
         except:
             self.do_close()
             raise EndpointClose()
 
     def recv(self):
+        buf = self.get_buffer(self.read_size)
         try:
-            data = self.sock.recv(4096)
+            sz = self.sock.recv_into(buf)
         except:
-            data = ""
-        if len(data) == 0:
+            sz = 0
+        if sz == 0:
             self.do_close()
             raise EndpointClose()
+        self.update_read_size(sz)
+        return memoryview(buf)[:sz]
+
+
+class DatagramSocket(SOCKET):
+    """ Datagram sockets moving up to batch datagrams per system call """
+
+    @classmethod
+    def set_cli_arguments(cls,parser):
+        super().set_cli_arguments(parser)
+        parser.add_argument("--batch",metavar="N",default=64,type=int,help="Maximum number of datagrams read or sent by one system call (default 64)")
+
+    def __init__(self,batch=64,*args,**kargs):
+        super().__init__(*args,**kargs)
+        self.batch = batch
+        self.receiver = None
+        self.sender = None
+
+    def get_conf(self):
+        conf = super().get_conf()
+        conf["batch"] = self.batch
+        return conf
+
+    def recv(self):
+        """ Return the list of waiting datagrams, each one is truncated to the read size """
+        if self.receiver is None or self.receiver.sock is not self.sock:
+            self.receiver = DatagramReceiver(self.sock,self.batch,self.read_size)
+        try:
+            datagrams = self.receiver.recv(wait=True)
+        except OSError:
+            datagrams = []
+        # An empty datagram is received once the socket is shut down
+        if len(datagrams) == 0 or len(datagrams[0][0]) == 0:
+            self.do_close()
+            raise EndpointClose()
+        return [data for data,addr in datagrams]
+
+    def proto_recv(self):
+        # The forwarder gets all waiting datagrams as one batch
+        return self.proto_recv_batch()
+
+    def do_send_vectored(self,pkts):
+        if self.stop: raise EndpointClose()
+        if self.sender is None or self.sender.sock is not self.sock:
+            self.sender = DatagramSender(self.sock,self.batch)
+        try:
+            self.sender.send(pkts)
+        except OSError:
+            self.do_close()
+            raise EndpointClose()
+
+
+class TCPSocket(SOCKET):
+    """ TCP options, for clients and listeners """
+
+    @classmethod
+    def set_cli_arguments(cls,parser):
+        super().set_cli_arguments(parser)
+        add_tcp_arguments(parser)
+
+    def __init__(self,tcp_profile="default",nodelay=None,quickack=None,fastopen=None,user_timeout=None,keepalive=None,notsent_lowat=None,*args,**kargs):
+        profile = TCP_PROFILES[tcp_profile]
+        # A profile can also give kernel buffer sizes
+        for option in ("rcvbuf","sndbuf"):
+            if option in profile and not kargs.get(option):
+                kargs[option] = profile[option]
+        super().__init__(*args,**kargs)
+        self.tcp_profile = tcp_profile
+        options = {"nodelay":nodelay,"quickack":quickack,"fastopen":fastopen,"user_timeout":user_timeout,"keepalive":keepalive,"notsent_lowat":notsent_lowat}
+        self.tcp_options = {k:options[k] if options[k] is not None else profile.get(k) for k in TCP_OPTIONS}
+
+    def get_conf(self):
+        conf = super().get_conf()
+        conf["tcp_profile"] = self.tcp_profile
+        conf.update(self.tcp_options)
+        return conf
+
+    def set_tcp_options(self,sock,role="client"):
+        """ Set TCP options on a client, listener or accepted socket """
+        options = self.tcp_options
+        if options["nodelay"] is not None:
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,int(options["nodelay"]))
+        if options["quickack"]:
+            sock.setsockopt(socket.IPPROTO_TCP,TCP_QUICKACK,1)
+        if options["user_timeout"]:
+            sock.setsockopt(socket.IPPROTO_TCP,TCP_USER_TIMEOUT,options["user_timeout"])
+        if options["keepalive"]:
+            idle,interval,count = options["keepalive"]
+            sock.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1)
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_KEEPIDLE,idle)
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_KEEPINTVL,interval)
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_KEEPCNT,count)
+        if options["notsent_lowat"]:
+            sock.setsockopt(socket.IPPROTO_TCP,TCP_NOTSENT_LOWAT,options["notsent_lowat"])
+        if options["fastopen"] and role != "accepted":
+            try:
+                if role == "listener":
+                    sock.setsockopt(socket.IPPROTO_TCP,TCP_FASTOPEN,options["fastopen"])
+                else:
+                    sock.setsockopt(socket.IPPROTO_TCP,TCP_FASTOPEN_CONNECT,1)
+            except OSError:
+                # Not supported by this kernel, connections are opened as usual
+                pass
+
+    def bind(self):
+        self.set_tcp_options(self.sock,"listener" if isinstance(self,StreamListen) else "client")
+        super().bind()
+
+    def recv(self):
+        data = super().recv()
+        if self.tcp_options["quickack"]:
+            # The kernel goes back to delayed acknowledgments by itself
+            self.sock.setsockopt(socket.IPPROTO_TCP,TCP_QUICKACK,1)
         return data
 
 
@@ -85,6 +335,7 @@ class NetSocket(SOCKET):
         parser.add_argument("--destination","-d",metavar="IP",default="127.0.0.1",help="Destination Host")
         parser.add_argument("--port","-p",metavar="PORT",dest="dport",type=int,help="Destination port")
         parser.add_argument("--src-port","-s",metavar="PORT",dest="sport",type=int,help="Source port")
+        parser.add_argument("--connect-timeout",metavar="SECONDS",type=float,help="Give up connecting after SECONDS")
 
     def __init__(self,destination,dport,sport=None,transparent=False,*args,**kargs):
         super().__init__(*args,**kargs)
@@ -111,6 +362,7 @@ class UnixSocketEmission(SOCKET):
         super().set_cli_arguments(parser)
         parser.add_argument("--destination","-d",metavar="FILE",required=True,help="Unix socket destination")
         parser.add_argument("--abstract","-a",action="store_true",help="Use abstract socket")
+        parser.add_argument("--connect-timeout",metavar="SECONDS",type=float,help="Give up connecting after SECONDS")
 
     def __init__(self,destination,abstract=False,*args,**kargs):
         super().__init__(*args,**kargs)
@@ -128,8 +380,9 @@ class NetSocketListen(SOCKET):
         parser.add_argument("--bind","-b",metavar="IP",default="0.0.0.0",help="Bind Address")
         parser.add_argument("--port","-p",metavar="PORT",dest="sport",type=int,required=True,help="Bind port")
 
-    def __init__(self,sport=None,bind="0.0.0.0",transparent=False,destination=None,dport=None,*args,**kargs):
+    def __init__(self,sport=None,bind="0.0.0.0",transparent=False,destination=None,dport=None,reuse_port=False,*args,**kargs):
         super().__init__(*args,**kargs)
+        self.reuse_port = reuse_port
         self.bind_ip = bind
         self.sport = sport
         self.destination = destination
@@ -144,6 +397,9 @@ class NetSocketListen(SOCKET):
             self.sock.setsockopt(socket.SOL_IP, IP_RECVORIGDSTADDR, 1)
             # Because we will receive packet that were not for us
             self.sock.setsockopt(socket.SOL_IP, IP_TRANSPARENT, 1)
+        if self.reuse_port:
+            # Several processes listen on the same port, the kernel balances clients between them
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         super().bind()
 
     def create_socket_client(self,*args,**kargs):
@@ -152,6 +408,40 @@ class NetSocketListen(SOCKET):
         return self.__class__(*args,**kargs)
 
 
+class StreamListen(SOCKET):
+    """ Listening stream socket, every client already waiting is accepted at once """
+
+    @classmethod
+    def set_cli_arguments(cls,parser):
+        super().set_cli_arguments(parser)
+        parser.add_argument("--backlog",metavar="N",default=socket.SOMAXCONN,type=int,help="Maximum number of clients waiting to be accepted (default %d)" % (socket.SOMAXCONN,))
+
+    def __init__(self,backlog=socket.SOMAXCONN,*args,**kargs):
+        super().__init__(*args,**kargs)
+        self.backlog = backlog
+        self.accepted = deque()
+
+    def bind(self):
+        super().bind()
+        self.sock.listen(self.backlog)
+
+    def accept_pending(self):
+        """ Wait for a client, then accept every client already waiting so that the kernel queue does not overflow """
+        self.accepted.append(self.accept())
+        while len(self.accepted) < self.backlog and select([self.sock],[],[],0)[0]:
+            self.accepted.append(self.accept())
+
+    def get_original_dst(self,endpoint_client):
+        return None
+
+    def handle_new_client(self):
+        """ Handle the connection of a new client """
+        if not self.accepted:
+            self.accept_pending()
+        endpoint_client = self.accepted.popleft()
+        return endpoint_client,self.get_original_dst(endpoint_client)
+
+
 class UnixSocketReception(SOCKET):
     socket_family = socket.AF_UNIX
     EP2 = False
@@ -165,12 +455,14 @@ class UnixSocketReception(SOCKET):
     def __init__(self,bind,abstract=False,*args,**kargs):
         super().__init__(*args,**kargs)
         self.bind_addr = "\x00" + bind if abstract else bind
-        if not abstract and os.path.exists(bind) and stat.S_ISSOCK(os.stat(bind).st_mode):
+        # Accepted clients are given their socket, the path belongs to the listening endpoint
+        self.owns_path = self.sock is None and not abstract
+        if self.owns_path and os.path.exists(bind) and stat.S_ISSOCK(os.stat(bind).st_mode):
             os.remove(bind)
 
     def close(self):
         super().close()
-        if self.bind_addr[0] != "\x00":
+        if self.owns_path:
             try:
                 os.remove(self.bind_addr)
             except FileNotFoundError:
@@ -178,71 +470,227 @@ class UnixSocketReception(SOCKET):
  
 
 @Endpoint.register
-class TCP(NetSocket):
+class TCP(TCPSocket,NetSocket):
     _desc_ = "TCP Client"
     socket_type = socket.SOCK_STREAM
 
 
 @Endpoint.register
-class TCP_LISTEN(NetSocketListen):
+class TCP_LISTEN(StreamListen,TCPSocket,NetSocketListen):
     _desc_ = "TCP Server"
     _cmd_ = "TCP-LISTEN"
     socket_type = socket.SOCK_STREAM
 
+    @classmethod
+    def set_cli_arguments(cls,parser):
+        super().set_cli_arguments(parser)
+        parser.add_argument("--defer-accept",metavar="SECONDS",type=int,help="Accept clients only once they have sent data, or after SECONDS (TCP_DEFER_ACCEPT, not for protocols where the server talks first)")
+
+    def __init__(self,defer_accept=None,*args,**kargs):
+        super().__init__(*args,**kargs)
+        self.defer_accept = defer_accept
+        self.overflows = None
+        self.next_overflow_check = 0
+
     def accept(self):
         csock,caddr = self.sock.accept()
         #print("New client: %r" % (caddr,))
         x = self.create_socket_client(sock=csock)
+        x.set_tcp_options(csock,"accepted")
         return x
 
     def bind(self):
         super().bind()
-        self.sock.listen(10)
+        if self.defer_accept:
+            self.sock.setsockopt(socket.IPPROTO_TCP,TCP_DEFER_ACCEPT,self.defer_accept)
 
-    def handle_new_client(self):
-        """ Handle the connection of a new client """
-        endpoint_client = self.accept()
+    def accept_stats(self):
+        """ Length and maximum of the accept queue, system wide overflow counters """
+        try:
+            queue,backlog = struct.unpack_from("II",self.sock.getsockopt(socket.IPPROTO_TCP,TCP_INFO,104),24)
+        except OSError:
+            queue,backlog = 0,self.backlog
+        overflows,drops = get_listen_overflows()
+        return {"queue":queue,"backlog":backlog,"listen_overflows":overflows,"listen_drops":drops}
+
+    def accept_pending(self):
+        super().accept_pending()
+        # Warn at most once per second when clients have been dropped
+        now = time.monotonic()
+        if now >= self.next_overflow_check:
+            self.next_overflow_check = now + 1
+            overflows,drops = get_listen_overflows()
+            if self.overflows is not None and overflows > self.overflows:
+                print("%d clients dropped by full accept queues on this system, increase --backlog (currently %d)" % (overflows - self.overflows,self.backlog))
+            self.overflows = overflows
+
+    def get_original_dst(self,endpoint_client):
+        """ Return the real destination of a client in transparent mode """
         if self.transparent:
             dst_addr = endpoint_client.sock.getsockopt(socket.SOL_IP,SO_ORIGINAL_DST,16)
             dst_port,dst_ip = struct.unpack("!2xH4s8x", dst_addr)
             dst_ip = socket.inet_ntoa(dst_ip)
-            return endpoint_client,(dst_ip,dst_port)
+            return dst_ip,dst_port
         else:
-            return endpoint_client,None
+            return None
+
 
 @Endpoint.register
-class UDP(NetSocket):
+class UDP(DatagramSocket,NetSocket):
     _desc_ = "UDP Client"
     socket_type = socket.SOCK_DGRAM
 
 
+class UDPSession(Endpoint):
+    """ Virtual endpoint of one client of an UDP_LISTEN, fed with its datagrams by the listening socket """
+
+    def __init__(self,listen,peer,*args,**kargs):
+        super().__init__(*args,**kargs)
+        self.listen = listen
+        self.peer = peer
+        self.datagrams = deque()
+        self.cond = Condition()
+        self.last_activity = time.monotonic()
+
+    def feed(self,data):
+        """ Called by the listening endpoint for each datagram of this client """
+        with self.cond:
+            self.datagrams.append(data)
+            self.cond.notify()
+        self.last_activity = time.monotonic()
+
+    def peer_addr(self):
+        return self.peer
+
+    def recv(self):
+        """ Return every datagram waiting """
+        with self.cond:
+            while not self.datagrams and not self.stop:
+                self.cond.wait()
+            if not self.datagrams:
+                raise EndpointClose()
+            data = list(self.datagrams)
+            self.datagrams.clear()
+        return data
+
+    def proto_recv(self):
+        # The forwarder gets all waiting datagrams as one batch
+        return self.proto_recv_batch()
+
+    def send(self,data):
+        try:
+            self.listen.sock.sendto(data,self.peer)
+        except OSError:
+            self.do_close()
+            raise EndpointClose()
+        self.last_activity = time.monotonic()
+
+    def do_send_vectored(self,pkts):
+        if self.stop: raise EndpointClose()
+        try:
+            for frags in pkts:
+                self.listen.sock.sendmsg(frags,[],0,self.peer)
+        except OSError:
+            self.do_close()
+            raise EndpointClose()
+        self.last_activity = time.monotonic()
+
+    def close(self):
+        with self.cond:
+            self.cond.notify_all()
+        self.listen.remove_session(self)
+
+    def __repr__(self):
+        return "%s(%s:%s)" % (self.__class__.__name__,self.peer[0],self.peer[1])
+
+
 @Endpoint.register
 class UDP_LISTEN(NetSocketListen):
     _cmd_ = "UDP-LISTEN"
     _desc_ = "UDP Server"
     socket_type = socket.SOCK_DGRAM
-    def handle_new_client(self):
-        """ Handle the connection of a new client """
-        # Read without consuming data, to get client addr
-        if self.transparent:
-            data,ancdata,flags,c_addr = sock.recvmsg(4096,socket.MAX_ANC_SIZE|socket.MSK_PEED)
-            # Find real address
-            for cmsg_level, cmsg_type, cmsg_data in ancdata:
-                if cmsg_level == socket.SOL_IP and cmsg_type == IP_RECVORIGDSTADDR:
-                    port,ip = struct.unpack_from("!xxH4s", cmsg_data)
-                    real_dst_addr = socket.inet_ntoa(ip),port
-                    break
-        else:
-            data,c_addr = self.sock.recvfrom(4096,socket.MSG_PEEK)
-            real_dst_addr = None
 
-        endpoint = self.create_socket_client(sock=self.sock,destination=c_addr[0],dport=c_addr[1])
-        endpoint.connect()
+    @classmethod
+    def set_cli_arguments(cls,parser):
+        super().set_cli_arguments(parser)
+        parser.add_argument("--session-timeout",metavar="SECONDS",default=60,type=float,help="Forget a client after SECONDS without traffic (default 60)")
+        parser.add_argument("--batch",metavar="N",default=64,type=int,help="Maximum number of datagrams read by one system call (default 64)")
+
+    def __init__(self,session_timeout=60,batch=64,*args,**kargs):
+        super().__init__(*args,**kargs)
+        self.session_timeout = session_timeout
+        self.batch = batch
+        # Sessions by client address
+        self.sessions = {}
+        self.sessions_lock = Lock()
+        self.new_sessions = deque()
+        self.next_expiry = 0
+
+    def init(self):
+        super().init()
+        self.receiver = DatagramReceiver(self.sock,self.batch,MAX_DATAGRAM_SIZE)
+
+    def close(self):
+        with self.sessions_lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            session.do_close()
+        super().close()
+
+    def remove_session(self,session):
+        with self.sessions_lock:
+            if self.sessions.get(session.peer) is session:
+                del self.sessions[session.peer]
+
+    def expire_interval(self):
+        return min(self.session_timeout/2,1)
+
+    def expire_sessions(self):
+        """ Close sessions without traffic for too long """
+        now = time.monotonic()
+        if now < self.next_expiry: return
+        self.next_expiry = now + self.expire_interval()
+        with self.sessions_lock:
+            idle = [s for s in self.sessions.values() if now - s.last_activity > self.session_timeout]
+        for session in idle:
+            session.do_close()
+
+    def recv_datagrams(self):
+        """ Return a list of (data,client address,real destination) """
+        if not self.transparent:
+            return [(data,c_addr,None) for data,c_addr in self.receiver.recv()]
+
+        # The real destination is only given in ancillary data, one datagram at a time
+        try:
+            data,ancdata,flags,c_addr = self.sock.recvmsg(MAX_DATAGRAM_SIZE,socket.CMSG_SPACE(16),socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return []
+        real_dst_addr = None
+        for cmsg_level, cmsg_type, cmsg_data in ancdata:
+            if cmsg_level == socket.SOL_IP and cmsg_type == IP_RECVORIGDSTADDR:
+                port,ip = struct.unpack_from("!xxH4s", cmsg_data)
+                real_dst_addr = socket.inet_ntoa(ip),port
+                break
+        return [(data,c_addr,real_dst_addr)]
+
+    def dispatch(self):
+        """ Give received datagrams to the session of their client, creating new ones """
+        for data,c_addr,real_dst_addr in self.recv_datagrams():
+            with self.sessions_lock:
+                session = self.sessions.get(c_addr)
+                if session is None:
+                    session = self.sessions[c_addr] = UDPSession(self,c_addr,**Endpoint.get_conf(self))
+                    self.new_sessions.append((session,real_dst_addr))
+            session.feed(data)
+
+    def handle_new_client(self):
+        """ Wait for the first datagram of a new client, datagrams of known clients are dispatched meanwhile """
+        while not self.new_sessions:
+            self.expire_sessions()
+            r,_,_ = select([self.sock],[],[],self.expire_interval())
+            if r: self.dispatch()
+        return self.new_sessions.popleft()
 
-        # Recreate a new listening socket for potential new UDP clients
-        self.init()
-        return endpoint,real_dst_addr
-    
 
 @Endpoint.register
 class UnixSocketConnect(UnixSocketEmission):
@@ -252,14 +700,14 @@ class UnixSocketConnect(UnixSocketEmission):
 
 
 @Endpoint.register
-class UnixSocketSend(UnixSocketEmission):
+class UnixSocketSend(DatagramSocket,UnixSocketEmission):
     _desc_ = "Unix socket datagram mode"
     _cmd_ = "UNIX-SENDTO"
     socket_type = socket.SOCK_DGRAM
 
 
 @Endpoint.register
-class UnixSocketListen(UnixSocketReception):
+class UnixSocketListen(StreamListen,UnixSocketReception):
     _desc_ = "Unix Socket Listen in stream mode"
     _cmd_ = "UNIX-LISTEN"
     socket_type = socket.SOCK_STREAM
@@ -268,15 +716,6 @@ class UnixSocketListen(UnixSocketReception):
         csock,addr = self.sock.accept()
         return self.create_socket_client(sock=csock,bind=self.bind_addr)
 
-    def bind(self):
-        super().bind()
-        self.sock.listen(10)
-
-    def handle_new_client(self):
-        """ Handle the connection of a new client """
-        endpoint_client = self.accept()
-        return endpoint_client,None
-
     def create_socket_client(self,*args,**kargs):
         # Some configuration can be set from upper classes
         kargs.update(self.get_conf())
@@ -284,7 +723,7 @@ class UnixSocketListen(UnixSocketReception):
 
 
 @Endpoint.register
-class UnixSocketRecv(UnixSocketReception):
+class UnixSocketRecv(DatagramSocket,UnixSocketReception):
     _desc_ = "Unix Socket receive in datagram mode"
     _cmd_ = "UNIX-RECV"
     socket_type = socket.SOCK_DGRAM
@@ -34,7 +34,7 @@ class Socks4Client(TCP):
         super().connect()
         connection_pkt = b"\x04\x01" + struct.pack(">H",self.fport) + socket.inet_aton(self.fserver) + b"pynet\x00"
         super().send(connection_pkt)
-        res = super().recv()
+        res = bytes(super().recv())
         if res[1] != 0x5a:
             print("Unable to connect to socks server (res:0x%02x)" % (res[1],))
             sys.exit(0)
@@ -60,6 +60,16 @@ class Socks4Server(TCP):
     def connect(self):
         self.create_socket()
 
+    def fileno(self):
+        # The socket is only connected once the socks request has been received
+        return None
+
+    def splice_fd(self):
+        return None
+
+    # The first message is the socks request, handled by do_send
+    do_send_vectored = Endpoint.do_send_vectored
+
     def do_send(self,data):
         if not self.connected:
             self.receive_ready_event.wait()
@@ -128,7 +138,7 @@ class Socks5Client(TCP):
             super().send(b"\x05\x01\x00")
 
         # Get the server's answer regarding authentication
-        res = super().recv()
+        res = bytes(super().recv())
 
         if not res:
             print("Unable to connect to socks server: empty response to greeting")
@@ -172,7 +182,7 @@ class Socks5Client(TCP):
 
         connection_pkt = b"\x05\x01\x00\x01" + socket.inet_aton(self.fserver) + struct.pack(">H",self.fport)
         super().send(connection_pkt)
-        res = super().recv()
+        res = bytes(super().recv())
         if res[:3] != b"\x05\x00\x00":
             print("Unable to connect to socks server (res:%s)" % (res,))
             sys.exit(0)
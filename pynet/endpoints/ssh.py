@@ -16,6 +16,7 @@ except:
     raise NotImplementedError
 
 from pynet.tools.utils import remove_argument
+from pynet.tools.flow import BoundedQueue
 from pynet.endpoint import *
 from pynet.endpoints.socket import TCP,TCP_LISTEN
 from pynet.tools.common import PYNET_FOLDER,create_pynet_folder
@@ -63,7 +64,8 @@ class SSH(TCP):
         self.ssh.load_system_host_keys()
         self.ssh.set_missing_host_key_policy(paramiko.WarningPolicy)
 
-        self.out = Queue()
+        # Outputs are queued by chunks, a slow reader pauses the command instead of buffering all of it
+        self.out = BoundedQueue()
 
     def connect(self):
         super().connect()
@@ -82,15 +84,17 @@ class SSH(TCP):
             self.stdout_shell = self.shell_channel.makefile('r')
 
     def close(self):
+        self.out.close()
         self.ssh.close()
 
     def send(self,data):
         try:
             if self.exec_command:
-                i,o,e = self.ssh.exec_command(data,get_pty=self.tty)
-                self.out.put(o.read())
+                i,o,e = self.ssh.exec_command(bytes(data),get_pty=self.tty)
+                for chunk in iter(lambda:o.read(self.read_size),b""):
+                    if not self.out.put(chunk): break
             elif self.invoke_shell:
-                self.shell_channel.send(data)
+                self.shell_channel.send(bytes(data))
         except:
             self.do_close()
             raise EndpointClose()
@@ -99,7 +103,7 @@ class SSH(TCP):
         if self.exec_command:
             data = self.out.get()
         elif self.invoke_shell:
-            data = self.shell_channel.recv(4096)
+            data = self.shell_channel.recv(self.read_size)
         return data
 
 
@@ -184,7 +188,7 @@ class SSHListeningChannel(Endpoint):
         return chan
         
     def recv(self):
-        data = self.channel.recv(4096)
+        data = self.channel.recv(self.read_size)
 
         if len(data) == 0:
             self.do_close()
@@ -194,7 +198,7 @@ class SSHListeningChannel(Endpoint):
 
     def send(self,data):
         try:
-            self.channel.sendall(data)
+            self.channel.sendall(bytes(data))
             #print("Sent : %r" % (data,))
         except:
             self.do_close()
@@ -210,7 +214,7 @@ class SSHChannel(Endpoint):
         self.channel.close()
 
     def recv(self):
-        data = self.channel.recv(4096)
+        data = self.channel.recv(self.read_size)
 
         if len(data) == 0:
             self.do_close()
@@ -220,7 +224,7 @@ class SSHChannel(Endpoint):
 
     def send(self,data):
         try:
-            self.channel.sendall(data)
+            self.channel.sendall(bytes(data))
         except:
             self.do_close()
             raise EndpointClose()
@@ -5,9 +5,9 @@ import sys
 import select
 import tty
 import termios
-from queue import Queue
 
 from pynet.endpoint import *
+from pynet.tools.flow import BoundedQueue
 
 
 @Endpoint.register
@@ -96,14 +96,17 @@ class ECHO(Endpoint):
 
     def __init__(self,*args,**kargs):
         super().__init__(*args,**kargs)
-        self.q = Queue()
+        # Sending blocks while too much data waits to be echoed, the sender stops reading its peer
+        self.q = BoundedQueue()
 
     def send(self,data):
-        self.q.put_nowait(data)
+        # Data is kept after the send, it must not be a view on a receive buffer
+        if not self.q.put(bytes(data)):
+            raise EndpointClose()
 
     def recv(self):
         return self.q.get()
 
     def close(self):
-        self.q.put_nowait(None)
+        self.q.close()
  
@@ -79,7 +79,9 @@ class TLS_LISTEN(TCP_LISTEN):
 
     def get_conf(self):
         """ Use if we need to duplicate EndPoint, to keep the mandatory parameters """
-        return {"proto":self.proto, "certificate":self.certificate, "key":self.key, "tls_version":self.tls_version, "ciphers":self.ciphers}
+        conf = super().get_conf()
+        conf.update({"certificate":self.certificate, "key":self.key, "tls_version":self.tls_version, "ciphers":self.ciphers})
+        return conf
 
     def create_socket(self):
         tcp_sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
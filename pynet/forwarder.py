@@ -2,15 +2,26 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import os
 import time
-from threading import Thread
+import itertools
+import argparse
+import selectors
+import asyncio
+import fcntl
+import ssl
+from collections import deque
+from threading import Thread,Event,Lock,current_thread
 from select import select
 
 import logging
 
 from pynet.tools.utils import Register
-from pynet.module import Module
+from pynet.module import Module,PassThrough
 from pynet.endpoint import EndpointClose
+from pynet.tools.flow import FlowControl
+from pynet.tools import metrics
+from pynet.tools import tracing
 
 logger = logging.getLogger("Forwarder")
 logger.setLevel(logging.WARNING)
@@ -19,57 +30,180 @@ ch.setLevel(logging.DEBUG)
 logger.addHandler(ch)
 
 
+F_SETPIPE_SZ = getattr(fcntl,"F_SETPIPE_SZ",1031)
+F_GETPIPE_SZ = getattr(fcntl,"F_GETPIPE_SZ",1032)
+
+def module_name(m):
+    # Offloaded modules are named after the module they run
+    return getattr(m,"module_cls",type(m)).__name__
+
+
 class Forwarder(object):
-   
+    # Maximum amount of data moved by one splice call
+    SPLICE_SIZE = 1 << 20
+
+    ids = itertools.count()
+    # Name of the relay or proxy using the forwarder, set by the relay
+    name = "relay"
+
     def __init__(self,ep1,ep2,modules=[],end_forwarder_callback=None):
+        self.id = next(Forwarder.ids)
         self.modules = list(map(lambda m:m.get(ep1,ep2),modules))
         self.ep1 = ep1
         self.ep2 = ep2
         self.callback_end = end_forwarder_callback
+        self.pipes = {}
+        self.spliced = 0
+        self.zero_copy = self.can_splice()
+        if self.zero_copy:
+            metrics.spliced_connections.inc()
         logger.debug("New forwarder [%r:%r]" % (self.ep1,self.ep2))
 
     @staticmethod
     def is_forward_possible(ep1,ep2):
         return hasattr(ep1,"recv") and hasattr(ep2,"send")
 
+    def can_splice(self):
+        """ Data can be moved inside the kernel if nobody needs to look at it """
+        return hasattr(os,"splice") and \
+               all(type(m) is PassThrough for m in self.modules) and \
+               self.ep1.splice_fd() is not None and self.ep2.splice_fd() is not None
+
+    def get_pipe(self,receiver):
+        """ Pipe through which data of receiver is spliced """
+        if receiver not in self.pipes:
+            self.pipes[receiver] = os.pipe()
+            try:
+                fcntl.fcntl(self.pipes[receiver][1],F_SETPIPE_SZ,Forwarder.SPLICE_SIZE)
+            except OSError:
+                pass
+        return self.pipes[receiver]
+
+    def close_pipe(self,receiver):
+        pipe = self.pipes.pop(receiver,None)
+        if pipe:
+            os.close(pipe[0])
+            os.close(pipe[1])
+
+    def splice(self,receiver,sender):
+        """ Move data from receiver to sender through a pipe without copying it into python. Return True if the communication has ended """
+        pipe_r,pipe_w = self.get_pipe(receiver)
+
+        end = receiver.stop or sender.stop
+        if not end:
+            try:
+                sz = os.splice(receiver.splice_fd(),pipe_w,Forwarder.SPLICE_SIZE,flags=os.SPLICE_F_MOVE)
+            except OSError:
+                sz = 0
+            end = sz == 0
+            self.spliced += sz
+            metrics.direction_bytes[receiver is self.ep1].inc(sz)
+
+        while not end and sz > 0:
+            try:
+                sz -= os.splice(pipe_r,sender.splice_fd(),sz,flags=os.SPLICE_F_MOVE)
+            except OSError:
+                end = True
+
+        if end:
+            logger.debug("End of zero-copy forwarding from %r to %r" % (receiver,sender))
+            receiver.do_close()
+            sender.do_close()
+            self.close_pipe(receiver)
+        return end
+
     def fw(self,receiver,sender,from_client):
         """ Forward between receiver and sender. Return True if the communication has ended """
+        if self.zero_copy:
+            return self.splice(receiver,sender)
+
+        try:
+            return self.fw_data(receiver,sender,from_client)
+        finally:
+            # Received data has been sent or dropped, receive buffers can be reused
+            receiver.release_buffers()
+
+    def fw_data(self,receiver,sender,from_client):
         try:
             data = receiver.proto_recv()
             logger.debug("Received data from %r [%r]" % (receiver,data))
         except EndpointClose:
             logger.debug("Receiver %r has closed, closing sender %r" % (receiver,sender))
-            sender.do_close()
+            self.end_direction(receiver,sender)
             return True
 
         # If endpoint returns None, we won't send it to modules
         if data is None: return False
 
+        trace = tracing.sample(self,from_client)
         if not type(data) is list:
             data = [data]
+        metrics.received(from_client,data)
 
-        for msg in data:
-            msg = self.handle_data(msg,from_client)
+        out = self.handle_messages(data,from_client,trace)
+        # Modules are still working on the messages, they will be sent later
+        if out is None: return False
+        return self.send_messages(receiver,sender,out,trace)
 
-            # If Module returns None, it means that this packet won't be forwarded
-            if msg is None: return False
+    def send_messages(self,receiver,sender,out,trace=None):
+        """ Send what modules returned. Return True if the communication has ended """
+        if len(out) == 0:
+            if trace: trace.end()
+            return False
 
-            try:
-                sender.proto_send(msg)
-                logger.debug("Sending data to %r" % (sender,))
-            except EndpointClose:
-                logger.debug("Sender %r has closed, closing receiver %r" % (sender,receiver))
-                receiver.do_close()
-                return True
+        # Everything produced by this iteration is sent at once
+        try:
+            pkts = sender.proto_pack(out)
+            if trace: trace.mark("encode")
+            self.send(receiver,sender,pkts)
+            logger.debug("Sending data to %r" % (sender,))
+            if trace:
+                trace.mark("send")
+                trace.end()
+        except EndpointClose:
+            logger.debug("Sender %r has closed, closing receiver %r" % (sender,receiver))
+            receiver.do_close()
+            return True
 
         return False
 
-    def handle_data(self,data,from_client):
-        """ Function to transform data """
-        for m in self.modules:
-            data = m.handle(data,from_client)
+    def send(self,receiver,sender,pkts):
+        """ Send packets made from messages of receiver, blocking until the sender has taken them """
+        sender.do_send_vectored(pkts)
+
+    def end_direction(self,receiver,sender):
+        """ Receiver has closed, nothing more will be sent """
+        sender.do_close()
+
+    def buffered(self):
+        """ Bytes received and not yet accepted by the other endpoint """
+        return 0
+
+    def handle_messages(self,data,from_client,trace=None,first=0):
+        """ Give received messages to modules from the first one, return the list of messages to send """
+        for m in self.modules[first:]:
+            data = self.handle_module(m,data,from_client,trace)
+
+            # Everything has been dropped, next modules have nothing to do
+            if not data: return []
         return data
 
+    def handle_module(self,m,data,from_client,trace=None):
+        if not m.ZERO_COPY:
+            data = [bytes(msg) if type(msg) is memoryview else msg for msg in data]
+        try:
+            data = m.handle_batch(data,from_client)
+        except Exception:
+            metrics.module_errors.labels(module_name(m)).inc()
+            raise
+        if trace: trace.mark("module",module_name(m))
+        return data
+
+    @staticmethod
+    def is_offloaded(m):
+        """ True if the module runs in a worker process, loop driven forwarders must not wait for it """
+        return hasattr(m,"submit_batch")
+
     def start(self):
         raise NotImplementedError()
 
@@ -87,7 +221,7 @@ class Forwarder(object):
         return True
 
     def __repr__(self):
-        return "%s(%s:%s)" % (self.__class__.__name__,self.ep1,self.ep2)
+        return "%s(%s:%s%s)" % (self.__class__.__name__,self.ep1,self.ep2,",splice" if self.zero_copy else "")
 
 
 class ThreadForwarder(Forwarder):
@@ -160,3 +294,535 @@ class ThreadForwarder(Forwarder):
             self.threads[0].ep2.close()
         except IndexError:
             pass
+
+
+class SelectorLoop(Thread):
+    """ Thread waiting for readiness of many endpoints at once, using epoll when available """
+
+    def __init__(self):
+        super().__init__()
+        self.daemon = True
+        self.selector = selectors.DefaultSelector()
+        self.calls = deque()
+        # Pipe used to wake up the selector when a call is queued from another thread
+        self.rfd,self.wfd = os.pipe()
+        os.set_blocking(self.rfd,False)
+        self.selector.register(self.rfd,selectors.EVENT_READ,None)
+
+    def call(self,f,*args):
+        """ Run f inside the loop thread, every change to the selector must be done there """
+        self.calls.append((f,args))
+        os.write(self.wfd,b"\x00")
+
+    def watch(self,fd,event,watcher):
+        """ Call watcher.ready when fd is readable, watcher.writable when fd is writable
+
+            Raise KeyError if another watcher already waits for this event.
+        """
+        try:
+            key = self.selector.get_key(fd)
+        except KeyError:
+            self.selector.register(fd,event,{event:watcher})
+            return
+        if key.data.get(event,watcher) is not watcher:
+            raise KeyError(fd)
+        key.data[event] = watcher
+        self.selector.modify(fd,key.events | event,key.data)
+
+    def unwatch(self,fd,event,watcher):
+        try:
+            key = self.selector.get_key(fd)
+        except (KeyError,ValueError):
+            return
+        if key.data.get(event) is not watcher: return
+        del key.data[event]
+        try:
+            if key.data:
+                self.selector.modify(fd,key.events & ~event,key.data)
+            else:
+                self.selector.unregister(fd)
+        except (KeyError,ValueError,OSError):
+            # Already closed, the selector has forgotten it
+            pass
+
+    def owner(self,fd,event):
+        return self.selector.get_key(fd).data[event]
+
+    def run(self):
+        while True:
+            for key,events in self.selector.select():
+                if key.data is None:
+                    os.read(self.rfd,4096)
+                    continue
+                for event,watcher in list(key.data.items()):
+                    if not events & event: continue
+                    if event == selectors.EVENT_READ:
+                        watcher.ready()
+                    else:
+                        watcher.writable()
+            while len(self.calls) > 0:
+                f,args = self.calls.popleft()
+                f(*args)
+
+
+class SelectorForwarder(ThreadForwarder):
+    """ Forward data from ep1 to ep2 AND from ep2 to ep1 from a shared selector thread
+
+        Only endpoints exposing a fileno() are handled by the selector, others
+        and TLS endpoints, whose reads and writes block, fall back to a
+        dedicated FwdThread. Stream sockets are written without blocking the
+        loop: what they do not accept is buffered, and reading the other
+        endpoint is paused while the buffer is above the high watermark.
+    """
+
+    # Number of selector threads shared by all SelectorForwarder
+    nb_loops = 1
+    loops = []
+    loops_lock = Lock()
+    loops_index = itertools.count()
+
+    class Watcher(object):
+        """ Forward data from ep1 to ep2 each time ep1 is readable """
+        def __init__(self,ep1,ep2,from_ep1,forwarder):
+            self.ep1 = ep1
+            self.ep2 = ep2
+            self.from_ep1 = from_ep1
+            self.forwarder = forwarder
+            self.fd = ep1.fileno()
+            self.ended = Event()
+            # Data ep2 has not accepted yet, when it can be written without blocking
+            self.out_fd = ep2.fileno() if ep2.can_send_nowait() else None
+            self.pending = deque()
+            self.flow = FlowControl(pause=self.pause,resume=self.resume)
+            self.eof = False
+            # A batch is handled by a module in a worker process, ep1 is not read meanwhile to keep the order
+            self.waiting = False
+            self.splice = forwarder.zero_copy
+            if self.splice:
+                # The pipe holds buffered data, its size bounds what is read ahead
+                self.out_fd = ep2.splice_fd()
+                os.set_blocking(self.out_fd,False)
+                pipe_size = fcntl.fcntl(forwarder.get_pipe(ep1)[1],F_GETPIPE_SZ)
+                self.flow.high = min(self.flow.high,pipe_size)
+                self.flow.low = min(self.flow.low,self.flow.high//2)
+
+        def start(self):
+            self.forwarder.loop.call(self.register)
+
+        def watch(self,fd,event):
+            loop = self.forwarder.loop
+            try:
+                loop.watch(fd,event,self)
+            except KeyError:
+                # The fd has been closed and reused before the previous owner was unregistered
+                loop.owner(fd,event).forwarder.end_watchers()
+                loop.watch(fd,event,self)
+
+        def register(self):
+            try:
+                self.watch(self.fd,selectors.EVENT_READ)
+            except (OSError,ValueError):
+                # Already closed
+                self.forwarder.end_watchers()
+
+        def pause(self):
+            logger.debug("%r is not draining, stop reading %r" % (self.ep2,self.ep1))
+            self.forwarder.loop.unwatch(self.fd,selectors.EVENT_READ,self)
+
+        def resume(self):
+            if self.ended.is_set() or self.eof or self.waiting: return
+            logger.debug("%r is draining, read %r again" % (self.ep2,self.ep1))
+            self.register()
+
+        def ready(self):
+            if self.ended.is_set() or self.waiting: return
+            try:
+                if self.splice:
+                    end = self.splice_in()
+                else:
+                    end = self.forwarder.fw(self.ep1,self.ep2,self.from_ep1)
+            except Exception:
+                logger.exception("Error while forwarding from %r to %r" % (self.ep1,self.ep2))
+                self.forwarder.end_watchers()
+                self.ep1.do_close()
+                self.ep2.do_close()
+                return
+            if end and not self.eof:
+                # Both endpoints have been closed by fw, so both directions are over
+                self.forwarder.end_watchers()
+
+        def offload(self,m,index,data,trace):
+            """ Give data to a module running in a worker process, stop reading ep1 until it has returned """
+            self.waiting = True
+            self.forwarder.loop.unwatch(self.fd,selectors.EVENT_READ,self)
+            future = m.submit_batch(data,self.from_ep1)
+            future.add_done_callback(lambda future:self.forwarder.loop.call(self.offloaded,m,index,future,trace))
+
+        def offloaded(self,m,index,future,trace):
+            self.waiting = False
+            if self.ended.is_set(): return
+            try:
+                try:
+                    out = future.result()
+                except Exception:
+                    metrics.module_errors.labels(module_name(m)).inc()
+                    raise
+                if trace: trace.mark("module",module_name(m))
+                out = self.forwarder.handle_messages(out,self.from_ep1,trace,index+1) if out else []
+                # Waiting for the next offloaded module
+                if out is None: return
+                end = self.forwarder.send_messages(self.ep1,self.ep2,out,trace)
+            except Exception:
+                logger.exception("Error while forwarding from %r to %r" % (self.ep1,self.ep2))
+                self.forwarder.end_watchers()
+                self.ep1.do_close()
+                self.ep2.do_close()
+                return
+            if end:
+                self.forwarder.end_watchers()
+            elif not self.flow.paused:
+                self.register()
+
+        def send(self,pkts):
+            """ Send what ep2 accepts without blocking, buffer the rest """
+            frags = [f for frags in pkts for f in frags if len(f) > 0]
+            if not self.pending:
+                frags = self.ep2.send_nowait(frags)
+                if not frags: return
+                self.watch(self.out_fd,selectors.EVENT_WRITE)
+            # Receive buffers are reused as soon as fw returns
+            frags = [bytes(f) for f in frags]
+            self.pending.extend(frags)
+            self.flow.add(sum(map(len,frags)))
+
+        def splice_in(self):
+            """ Move data of ep1 into the pipe then to ep2, what ep2 does not accept stays in the pipe. Return True if the communication has ended """
+            pipe_r,pipe_w = self.forwarder.get_pipe(self.ep1)
+            try:
+                sz = os.splice(self.fd,pipe_w,self.flow.high - self.flow.buffered,flags=os.SPLICE_F_MOVE|os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                return False
+            except OSError:
+                sz = 0
+            if sz == 0:
+                self.ep1.do_close()
+                self.end_input()
+                return True
+
+            self.forwarder.spliced += sz
+            metrics.direction_bytes[self.from_ep1].inc(sz)
+            self.flow.add(sz)
+            try:
+                if self.flush():
+                    self.watch(self.out_fd,selectors.EVENT_WRITE)
+            except EndpointClose:
+                self.ep1.do_close()
+                return True
+            return False
+
+        def flush(self):
+            """ Send buffered data without blocking, return True if some is left """
+            if self.splice:
+                pipe_r,pipe_w = self.forwarder.get_pipe(self.ep1)
+                try:
+                    while self.flow.buffered > 0:
+                        self.flow.remove(os.splice(pipe_r,self.out_fd,self.flow.buffered,flags=os.SPLICE_F_MOVE|os.SPLICE_F_NONBLOCK))
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    self.ep2.do_close()
+                    raise EndpointClose()
+            else:
+                size = self.flow.buffered
+                self.pending = deque(self.ep2.send_nowait(list(self.pending)))
+                self.flow.remove(size - sum(map(len,self.pending)))
+            return self.flow.buffered > 0
+
+        def writable(self):
+            if self.ended.is_set(): return
+            try:
+                if self.flush(): return
+            except EndpointClose:
+                self.forwarder.end_watchers()
+                self.ep1.do_close()
+                return
+
+            self.forwarder.loop.unwatch(self.out_fd,selectors.EVENT_WRITE,self)
+            if self.eof:
+                logger.debug("Buffered data sent to %r, closing it" % (self.ep2,))
+                self.forwarder.end_watchers()
+                self.ep2.do_close()
+
+        def end_input(self):
+            """ ep1 has closed, close ep2 once buffered data has been sent """
+            if self.flow.buffered == 0:
+                self.ep2.do_close()
+                return
+            self.eof = True
+            self.forwarder.loop.unwatch(self.fd,selectors.EVENT_READ,self)
+
+        def finish(self):
+            if self.ended.is_set(): return
+            loop = self.forwarder.loop
+            loop.unwatch(self.fd,selectors.EVENT_READ,self)
+            if self.out_fd is not None:
+                loop.unwatch(self.out_fd,selectors.EVENT_WRITE,self)
+            self.pending.clear()
+            self.flow.close()
+            if self.splice:
+                self.forwarder.close_pipe(self.ep1)
+            self.ended.set()
+            self.forwarder.end_thread(self)
+
+        def join(self):
+            self.ended.wait()
+
+        def __repr__(self):
+            return "%s(%s -> %s)" % (self.__class__.__name__,self.ep1,self.ep2)
+
+    @classmethod
+    def get_loop(cls):
+        """ Return one of the shared selector threads, starting them if needed """
+        with cls.loops_lock:
+            if len(cls.loops) == 0:
+                for i in range(cls.nb_loops):
+                    loop = SelectorLoop()
+                    loop.start()
+                    cls.loops.append(loop)
+            return cls.loops[next(cls.loops_index) % len(cls.loops)]
+
+    @staticmethod
+    def is_tls(ep):
+        return isinstance(getattr(ep,"sock",None),ssl.SSLSocket)
+
+    @staticmethod
+    def is_selectable(ep):
+        return hasattr(ep,"fileno") and ep.fileno() is not None and not SelectorForwarder.is_tls(ep)
+
+    def start(self):
+        self.loop = self.get_loop()
+        self.threads = []
+        # Watcher of each receiving endpoint
+        self.watchers = {}
+        for ep1,ep2,from_ep1 in ((self.ep1,self.ep2,True),(self.ep2,self.ep1,False)):
+            if not Forwarder.is_forward_possible(ep1,ep2): continue
+            # A blocking TLS write would stop the loop
+            if SelectorForwarder.is_selectable(ep1) and not SelectorForwarder.is_tls(ep2):
+                watcher = SelectorForwarder.Watcher(ep1,ep2,from_ep1,self)
+                self.watchers[ep1] = watcher
+                self.threads.append(watcher)
+            else:
+                self.threads.append(ThreadForwarder.FwdThread(ep1,ep2,from_ep1,self))
+            logger.debug("Start fwd between %r and %r" % (ep1,ep2))
+
+        # Closing a watched fd would let a new connection reuse its number while the selector still watches it
+        for watcher in self.watchers.values():
+            watcher.ep1.closer = self.close_endpoint
+            if watcher.out_fd is not None:
+                watcher.ep2.closer = self.close_endpoint
+
+        for th in list(self.threads):
+            th.start()
+
+    def send(self,receiver,sender,pkts):
+        watcher = self.watchers.get(receiver)
+        if watcher is None or watcher.out_fd is None:
+            return super().send(receiver,sender,pkts)
+        watcher.send(pkts)
+
+    def end_direction(self,receiver,sender):
+        watcher = self.watchers.get(receiver)
+        if watcher is None or watcher.out_fd is None:
+            return super().end_direction(receiver,sender)
+        watcher.end_input()
+
+    def buffered(self):
+        return sum(w.flow.buffered for w in self.watchers.values())
+
+    def handle_messages(self,data,from_client,trace=None,first=0):
+        """ Modules running in worker processes are not waited for by the loop, None is returned and the watcher sends their result """
+        watcher = self.watchers.get(self.ep1 if from_client else self.ep2)
+        for index in range(first,len(self.modules)):
+            m = self.modules[index]
+            if watcher is not None and Forwarder.is_offloaded(m):
+                watcher.offload(m,index,data,trace)
+                return None
+            data = self.handle_module(m,data,from_client,trace)
+            if not data: return []
+        return data
+
+    def end_watchers(self):
+        """ Stop watching endpoints, must be called from the loop thread """
+        for th in list(self.threads):
+            if isinstance(th,SelectorForwarder.Watcher):
+                th.finish()
+        for ep in (self.ep1,self.ep2):
+            if ep.closer == self.close_endpoint:
+                ep.closer = None
+
+    def unwatch_endpoint(self,ep):
+        for watcher in self.watchers.values():
+            if watcher.ep1 is ep:
+                self.loop.unwatch(watcher.fd,selectors.EVENT_READ,watcher)
+            if watcher.ep2 is ep and watcher.out_fd is not None:
+                self.loop.unwatch(watcher.out_fd,selectors.EVENT_WRITE,watcher)
+
+    def close_endpoint(self,ep):
+        """ Closer of watched endpoints, their fd is unwatched in the loop thread before being closed """
+        if current_thread() is not self.loop:
+            self.loop.call(self.close_endpoint,ep)
+            return
+        self.unwatch_endpoint(ep)
+        ep.close()
+
+    def end_thread(self,thread):
+        super().end_thread(thread)
+        # A fallback thread has closed both endpoints, watchers won't be woken up anymore
+        if isinstance(thread,ThreadForwarder.FwdThread):
+            self.loop.call(self.end_watchers)
+
+    def close(self):
+        self.loop.call(self.close_watched)
+
+    def close_watched(self):
+        """ Stop watching endpoints then close them, in the loop thread """
+        if not self.is_active(): return
+        logger.debug("Closing forwarder [%r:%r]" % (self.ep1,self.ep2))
+        self.end_watchers()
+        self.ep1.close()
+        self.ep2.close()
+
+
+class AsyncForwarder(Forwarder):
+    """ Forward data from ep1 to ep2 AND from ep2 to ep1 with two asyncio tasks
+
+        Endpoints must be asyncio endpoints (see pynet.endpoints.aiosocket),
+        modules are still synchronous and called from the event loop, except
+        those running in worker processes which are awaited.
+    """
+
+    def can_splice(self):
+        return False
+
+    async def fw(self,receiver,sender,from_client):
+        """ Forward between receiver and sender. Return True if the communication has ended """
+        try:
+            return await self.fw_data(receiver,sender,from_client)
+        finally:
+            receiver.release_buffers()
+
+    async def fw_data(self,receiver,sender,from_client):
+        try:
+            data = await receiver.proto_recv()
+            logger.debug("Received data from %r [%r]" % (receiver,data))
+        except EndpointClose:
+            logger.debug("Receiver %r has closed, closing sender %r" % (receiver,sender))
+            sender.do_close()
+            return True
+
+        # If endpoint returns None, we won't send it to modules
+        if data is None: return False
+
+        trace = tracing.sample(self,from_client)
+        if not type(data) is list:
+            data = [data]
+        metrics.received(from_client,data)
+
+        out = await self.handle_messages(data,from_client,trace)
+        if len(out) == 0:
+            if trace: trace.end()
+            return False
+
+        try:
+            pkts = sender.proto_pack(out)
+            if trace: trace.mark("encode")
+            await sender.do_send_vectored(pkts)
+            logger.debug("Sending data to %r" % (sender,))
+            if trace:
+                trace.mark("send")
+                trace.end()
+        except EndpointClose:
+            logger.debug("Sender %r has closed, closing receiver %r" % (sender,receiver))
+            receiver.do_close()
+            return True
+
+        return False
+
+    async def handle_messages(self,data,from_client,trace=None):
+        for m in self.modules:
+            if Forwarder.is_offloaded(m):
+                try:
+                    data = await asyncio.wrap_future(m.submit_batch(data,from_client))
+                except Exception:
+                    metrics.module_errors.labels(module_name(m)).inc()
+                    raise
+                if trace: trace.mark("module",module_name(m))
+            else:
+                data = self.handle_module(m,data,from_client,trace)
+            if not data: return []
+        return data
+
+    async def fw_loop(self,ep1,ep2,from_ep1):
+        while not await self.fw(ep1,ep2,from_ep1):
+            pass
+        logger.debug("End fwd between %r and %r" % (ep1,ep2))
+
+    def start(self):
+        """ Create forwarding tasks, must be called from the running loop """
+        self.tasks = []
+        self.ended = False
+        if Forwarder.is_forward_possible(self.ep1,self.ep2):
+            self.tasks.append(asyncio.ensure_future(self.fw_loop(self.ep1,self.ep2,True)))
+            logger.debug("Start fwd between %r and %r" % (self.ep1,self.ep2))
+
+        if Forwarder.is_forward_possible(self.ep2,self.ep1):
+            self.tasks.append(asyncio.ensure_future(self.fw_loop(self.ep2,self.ep1,False)))
+            logger.debug("Start fwd between %r and %r" % (self.ep2,self.ep1))
+
+        for task in self.tasks:
+            task.add_done_callback(self.end_task)
+
+    async def wait_until_end(self):
+        await asyncio.gather(*self.tasks,return_exceptions=True)
+
+    async def run(self):
+        self.start()
+        await self.wait_until_end()
+
+    def is_active(self):
+        return any(not t.done() for t in self.tasks)
+
+    def end_task(self,task):
+        """ Callback called by a task when it ends """
+        if not task.cancelled() and task.exception():
+            logger.error("Error in forwarder %r : %r" % (self,task.exception()))
+            self.ep1.do_close()
+            self.ep2.do_close()
+
+        # Both endpoints are closed, the other direction would wait forever
+        for t in self.tasks:
+            t.cancel()
+
+        # If there is no more tasks, and a callback is defined, forwarder is terminated
+        if self.callback_end and not self.is_active() and not self.ended:
+            self.ended = True
+            self.callback_end(self)
+
+    def close(self):
+        logger.debug("Closing forwarder [%r:%r]" % (self.ep1,self.ep2))
+        self.ep1.close()
+        self.ep2.close()
+        for task in self.tasks:
+            task.cancel()
+
+
+FORWARDERS = {"thread":ThreadForwarder,
+              "selector":SelectorForwarder,
+              "asyncio":AsyncForwarder}
+
+def get_forwarder(name):
+    """ Return the forwarder class from its command line name """
+    try:
+        return FORWARDERS[name]
+    except KeyError:
+        raise argparse.ArgumentTypeError("Unknown forwarder %r, use one of : %s" % (name,",".join(FORWARDERS)))
@@ -23,17 +23,82 @@ class ModuleContainer(object):
         return self.cls.from_cli(self.args)
 
 class Module(Plugin):
+    """ Called by the forwarder on every message going from one endpoint to the other
+
+        Several modules can be chained, each one receiving what the previous one returned.
+
+        handle receives bytes, unless the module sets ZERO_COPY. Such a module
+        may receive a memoryview on a receive buffer that is reused as soon as
+        the message has been sent: it can return it as is, but it has to copy
+        it (bytes(data)) to keep it or to modify it.
+
+        When worker processes are enabled, a module with OFFLOAD set runs in
+        one of them. It receives None as endpoints and its state is private
+        to the process handling its connection.
+    """
     _desc_ = "Default Module"
     registerer = ModuleRegister
+    ZERO_COPY = False
+    OFFLOAD = True
 
     def __init__(self,ep1,ep2,*args,**kargs):
         super().__init__(*args,**kargs)
         self.ep1 = ep1
         self.ep2 = ep2
 
+    @classmethod
+    def offload_args(cls,module_args):
+        """ Arguments of the instance created in a worker process for a new connection
+
+            Called in the proxy, to set what must not be decided by each worker on its own.
+        """
+        return module_args
+
     def handle(self,data,one):
         pass
 
+    def handle_batch(self,messages,one):
+        """ Called once per received batch of messages, return the list of messages to forward
+
+            Calls handle on each message by default, override it to process the batch at once.
+        """
+        out = []
+        for msg in messages:
+            msg = self.handle(msg,one)
+
+            # If handle returns None, this message won't be forwarded
+            if msg is None: continue
+
+            if type(msg) is list:
+                out.extend(msg)
+            else:
+                out.append(msg)
+        return out
+
 class PassThrough(Module):
+    ZERO_COPY = True
+    OFFLOAD = False
+
     def handle(self,data,one):
         return data
+
+    def handle_batch(self,messages,one):
+        # Subclasses overriding handle still need it to be called
+        if type(self).handle is PassThrough.handle:
+            return messages
+        return super().handle_batch(messages,one)
+
+def create_pipeline(modules,processes=0):
+    """ Create the containers of a list of (module class,module args), data goes through them in order
+
+        Modules allowing it are run in a pool of processes if processes is set.
+    """
+    res = []
+    for module,module_args in modules:
+        module = module if module else PassThrough
+        if processes and module.OFFLOAD:
+            from pynet.tools.offload import OffloadContainer
+            res.append(OffloadContainer(module,module_args,processes))
+        else:
+            res.append(ModuleContainer(module,module_args))
+    return res
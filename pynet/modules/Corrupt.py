@@ -1,39 +1,69 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import array
 import random
+import itertools
 from pynet.module import Module,PassThrough
+from pynet.tools import prefork
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def get_count(l, p, n):
+    """ Number of bits/bytes to corrupt among l """
+    if n is None:
+        n = max(1,int(l*p))
+    return min(n,l)
 
 # Taken from scapy : scapy/utils.py
-def corrupt_bytes(s, p=0.01, n=None):
+def corrupt_bytes(s, p=0.01, n=None, rng=random):
     """Corrupt a given percentage or number of bytes from a string"""
     s = array.array("B",s)
     l = len(s)
-    if n is None:
-        n = max(1,int(l*p))
-    for i in random.sample(range(l), n):
-        s[i] = (s[i]+random.randint(1,255))%256
+    n = get_count(l,p,n)
+    for i in rng.sample(range(l), n):
+        # Uniform among the 255 changes, as np_corrupt_bytes
+        s[i] = (s[i]+rng.randint(1,255))%256
     return s.tobytes()
 
 # Taken from scapy : scapy/utils.py
-def corrupt_bits(s, p=0.01, n=None):
+def corrupt_bits(s, p=0.01, n=None, rng=random):
     """Flip a given percentage or number of bits from a string"""
-    s = array.array("B",s)
-    l = len(s)*8
-    if n is None:
-        n = max(1,int(l*p))
-    for i in random.sample(range(l), n):
-        s[int(i/8)] ^= 1 << (i%8)
+    l = len(s)
+    mask = bytearray(l)
+    for i in rng.sample(range(l*8), get_count(l*8,p,n)):
+        mask[i>>3] |= 1 << (i&7)
+    # Apply the whole mask at once
+    return (int.from_bytes(s,"little") ^ int.from_bytes(mask,"little")).to_bytes(l,"little")
+
+def np_corrupt_bytes(s, p=0.01, n=None, rng=None):
+    """Corrupt a given percentage or number of bytes from a string with numpy"""
+    s = np.frombuffer(s,dtype=np.uint8).copy()
+    n = get_count(len(s),p,n)
+    s[rng.choice(len(s),n,replace=False)] += rng.integers(1,256,n,dtype=np.uint8)
+    return s.tobytes()
+
+def np_corrupt_bits(s, p=0.01, n=None, rng=None):
+    """Flip a given percentage or number of bits from a string with numpy"""
+    s = np.frombuffer(s,dtype=np.uint8).copy()
+    idx = rng.choice(len(s)*8,get_count(len(s)*8,p,n),replace=False)
+    # Positions are distinct, so adding the bits of a same byte is a xor
+    mask = np.bincount(idx >> 3,weights=1 << (idx & 7),minlength=len(s)).astype(np.uint8)
+    s ^= mask
     return s.tobytes()
 
 @Module.register
 class Corrupt(PassThrough):
     _desc_ = "Corruption Module"
+    OFFLOAD = True
 
     @classmethod
     def set_cli_arguments(cls,parser):
-        parser.add_argument("--seed",metavar="SEED",type=int,help="Set seed for random values to be reproductible")
+        parser.add_argument("--seed",metavar="SEED",type=int,help="Set seed for random values to be reproductible, not with --workers where connections are numbered per worker process")
         parser.add_argument("--bytes","-B",action="store_true",help="If set then corrupt byte will be set instead of corrupt bits")
         parser.add_argument("--number","-n",metavar="NUMBER",default=None,type=int,help="Number of bits/bytes fuzzed inside a packet")
         parser.add_argument("--percentage","-c",metavar="PERCENTAGE",default=0.01,type=float,help="Percentage of bits/bytes fuzzed inside a packet (will be override by number if set)")
@@ -41,12 +71,33 @@ class Corrupt(PassThrough):
         parser.add_argument("--response",action="store_true",help="Will corrupt response to fuzz client")
         parser.add_argument("--both",action="store_true",help="Will corrupt request and response to fuzz respectively server and client")
 
+    # Index of each connection in this process, to derive its own random stream from the seed
+    conn_ids = itertools.count()
+
+    @classmethod
+    def new_conn_id(cls):
+        """ Identifier of a new connection, unique among the processes of the proxy
+
+            Prefork workers number their connections from 0 too, their pid
+            keeps them apart. Which worker accepts a connection depends on the
+            kernel, so streams are only reproductible without --workers.
+        """
+        conn_id = [next(cls.conn_ids)]
+        if prefork.worker:
+            conn_id.insert(0,os.getpid())
+        return conn_id
+
+    @classmethod
+    def offload_args(cls,module_args):
+        # Offload workers would each number connections from 0, the proxy numbers them in their order
+        return dict(module_args,conn_id=cls.new_conn_id())
+
     def __init__(self,*args,**kargs):
         super().__init__(*args,**kargs)
-        if self.args.bytes:
-            self.corrupt = corrupt_bytes
+        if np is None:
+            self.corrupt = corrupt_bytes if self.args.bytes else corrupt_bits
         else:
-            self.corrupt = corrupt_bits
+            self.corrupt = np_corrupt_bytes if self.args.bytes else np_corrupt_bits
 
         self.number = self.args.number
         self.percentage = self.args.percentage
@@ -54,12 +105,20 @@ class Corrupt(PassThrough):
         self.corrupt_request = self.args.both or self.args.request
         self.corrupt_response = self.args.both or self.args.response
 
-        # To be reproductible
-        if not self.args.seed is None:
-            random.seed(self.args.seed)
+        # Every connection has its own stream, reproductible when a seed is given
+        conn_id = self.args.get("conn_id")
+        self.rng = self.get_rng(self.args.seed,conn_id if conn_id else Corrupt.new_conn_id())
+
+    @staticmethod
+    def get_rng(seed,conn_id):
+        if np is not None:
+            return np.random.default_rng(None if seed is None else [seed] + conn_id)
+        return random.Random(None if seed is None else "-".join(map(str,[seed] + conn_id)))
 
     def do_corrupt(self,data):
-        return self.corrupt(data,self.percentage,self.number)
+        if not data:
+            return data
+        return self.corrupt(data,self.percentage,self.number,self.rng)
 
     def handle(self,data,one):
         if self.corrupt_request and one:
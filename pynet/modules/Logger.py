@@ -5,47 +5,92 @@ import sys
 import os
 import time
 import json
+import atexit
+import itertools
+from threading import Thread,Lock
 from base64 import b64encode
 from pynet.module import Module,PassThrough
+from pynet.tools.utils import hexdump_lines
+from pynet.tools import prefork
 
 COLOR_END = '\033[0m'
 
-def hexdump(direction,s,color="",size=16):
+def hexdump(direction,s,color="",size=16,limit=None):
     """ Hexdump data """
-    def out(c):
-        if c < 32 or c > 126: sys.stdout.write(".")
-        else: sys.stdout.write(chr(c))
-
-    s = list(s)
-    sys.stdout.write("%s%s " % (color,direction))
-    for i in range(len(s)):
-        sys.stdout.write("%02x " % (s[i],))
-        if i != 0 and i%size == size-1:
-            sys.stdout.write("\t\t|")
-            for j in range(i-size+1,i+1):
-                out(s[j])
-            sys.stdout.write("|\n%s " % direction)
-    l = len(s)
-    m = l%size
-    sys.stdout.write("%s\t\t|" % (" "*(size-m)*3,))
-    for i in range(l-m,l):
-        out(s[i])
-    sys.stdout.write("%s|\n" % (" "*(size-m),))
-    sys.stdout.write(COLOR_END)
+    sys.stdout.write("%s%s%s" % (color,"".join("%s %s\n" % (direction,l) for l in hexdump_lines(s,size,limit)),COLOR_END))
 
 def get_ansi_color(s):
     return "\033[%sm" % (s,)
 
-def output(direction,s,color=""):
+def output(direction,s,color="",limit=None):
+    if limit and len(s) > limit:
+        s = "%s... %d more bytes" % (s[:limit],len(s) - limit)
     print("%s%s %s%s" % (color,direction,s,COLOR_END))
 
 def encode_pkt(pkt):
     """ Encode a bytes pkt for storing it in a json file """
     return b64encode(pkt).decode("ascii")
 
+class JsonLinesWriter(object):
+    """ Append one JSON record per line to a file shared by all connections
+
+        Lines are buffered until flush_size bytes are pending, and flushed
+        at least every flush_interval seconds by a background thread.
+    """
+    writers = {}
+    writers_lock = Lock()
+
+    @classmethod
+    def get(cls,path,flush_size=1<<16,flush_interval=1.0):
+        """ Return the writer of this file, creating (and truncating) it the first time """
+        # Forked workers would truncate and overwrite the file of each other
+        path = prefork.worker_path(path)
+        with cls.writers_lock:
+            if not path in cls.writers:
+                cls.writers[path] = cls(path,flush_size,flush_interval)
+            return cls.writers[path]
+
+    def __init__(self,path,flush_size=1<<16,flush_interval=1.0):
+        self.fd = open(path,"w",buffering=flush_size)
+        self.lock = Lock()
+        self.dirty = False
+        self.flush_interval = flush_interval
+        if flush_interval:
+            self.flusher = Thread(target=self.periodic_flush,daemon=True)
+            self.flusher.start()
+        atexit.register(self.close)
+
+    def write(self,record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            # Forwarding threads may still log after the file was closed at exit
+            if self.fd.closed: return
+            self.fd.write(line)
+            self.dirty = True
+
+    def flush(self):
+        with self.lock:
+            if self.dirty and not self.fd.closed:
+                self.fd.flush()
+                self.dirty = False
+
+    def periodic_flush(self):
+        while not self.fd.closed:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def close(self):
+        with self.lock:
+            self.fd.close()
+
+
 @Module.register
 class Logger(PassThrough):
     _desc_ = "Printer module"
+    # The filter is user code expecting bytes
+    ZERO_COPY = False
+    # Output is shared by all connections of the process
+    OFFLOAD = False
 
     @classmethod
     def set_cli_arguments(cls,parser):
@@ -55,17 +100,27 @@ class Logger(PassThrough):
         parser.add_argument("--no-hex",action="store_false",dest="hex",help="Do not print data in hexa")
         parser.add_argument("--color-client",metavar="COLOR",default="31",type=get_ansi_color,help="Color for client communication (default=31)")
         parser.add_argument("--color-server",metavar="COLOR",default="32",type=get_ansi_color,help="Color for client communication (default=32)")
+        parser.add_argument("--max-dump",metavar="BYTES",type=int,help="Only print the first BYTES of each packet")
         parser.add_argument("--no-color","-N",action="store_false",dest="color",help="Do not use colors")
-        parser.add_argument("--output","-o",metavar="json",dest="output_json",help="Output json file")
+        parser.add_argument("--output","-o",metavar="jsonl",dest="output_json",help="Output JSON Lines file, one record per packet (with --workers, worker N writes jsonl.N)")
+        parser.add_argument("--flush-size",metavar="SIZE",type=int,default=1<<16,help="Buffer that much output before writing it (default 65536)")
+        parser.add_argument("--flush-interval",metavar="SECONDS",type=float,default=1.0,help="Write buffered output at least every SECONDS (default 1, 0 to disable)")
         parser.add_argument("--filter",metavar="PYTHON",dest="filterf",type=lambda p:eval(p),default=lambda p,s:True,help="Python function to apply in order to dispay or not packets. First parameters is the packet and second one is True if packet comes from client (ex:lamba p,c:len(p)>10)")
 
-    def __init__(self,no_log_request=False,no_log_response=False,hex=True,color=True,color_client="\033[31m",color_server="\033[32m",output_json=None,filterf=lambda p:True,*args,**kargs):
+    # Identify records of each connection in the output file, with the pid of prefork workers which number them on their own
+    conn_ids = itertools.count()
+
+    def __init__(self,no_log_request=False,no_log_response=False,hex=True,color=True,color_client="\033[31m",color_server="\033[32m",max_dump=None,output_json=None,flush_size=1<<16,flush_interval=1.0,filterf=lambda p,one:True,*args,**kargs):
         super().__init__(*args,**kargs)
         self.log_request = not no_log_request
         self.log_response = not no_log_response
-        if output_json and os.path.exists(output_json): os.remove(output_json)
-        self.fout = output_json
+        self.conn_id = next(Logger.conn_ids)
+        self.record = {"conn":self.conn_id}
+        if prefork.worker:
+            self.record["pid"] = os.getpid()
+        self.fout = JsonLinesWriter.get(output_json,flush_size,flush_interval) if output_json else None
         self.filterf = filterf
+        self.max_dump = max_dump
         if hex:
             self.output = hexdump
         else:
@@ -78,23 +133,13 @@ class Logger(PassThrough):
             self.color_server = ""
 
     def store(self,data,one):
-        try:
-            with open(self.fout,"r") as f:
-                d = json.loads(f.read())
-        except:
-            d = []
-
-        pkt = [{"one":one,"ts":time.time(),"data":encode_pkt(data)}]
-        d.extend(pkt)
-
-        with open(self.fout,"w") as f:
-            json.dump(d,f)
-        
+        self.fout.write(dict(self.record,one=one,ts=time.time(),data=encode_pkt(data)))
+
     def handle(self,data,one):
         if not self.filterf(data,one): return data
         if self.log_request and one:
-            self.output(">",data,color=self.color_client)
+            self.output(">",data,color=self.color_client,limit=self.max_dump)
         elif self.log_response and not one:
-            self.output("<",data,color=self.color_server)
+            self.output("<",data,color=self.color_server,limit=self.max_dump)
         if self.fout: self.store(data,one)
         return data
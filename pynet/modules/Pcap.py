@@ -4,10 +4,131 @@
 import sys
 import struct
 import time
+import atexit
+import queue
+from threading import Thread,Lock
 
 from pynet.module import Module
+from pynet.tools import prefork
 from pynet.modules.Logger import Logger
 
+PCAP_HEADER = struct.Struct("IHHIIII")
+RECORD_HEADER = struct.Struct("IIII")
+# Fake ethernet header prepended to every packet
+ETHER_HEADER = b"\x00"*12 + b"\x08\x00"
+
+
+class PcapWriter(object):
+    """ Write pcap records from a background thread
+
+        Packets are queued by the forwarding threads and written in batches
+        by a single thread per file. The capture can be rotated when a file
+        reaches rotate_size bytes or is older than rotate_interval seconds,
+        rotated files are named PCAP.0, PCAP.1, ... and at most ring of them
+        are kept (the oldest one is overwritten).
+    """
+    writers = {}
+    writers_lock = Lock()
+
+    # Maximum number of records gathered in one write
+    BATCH_SIZE = 1024
+
+    @classmethod
+    def get(cls,pcap,*args,**kargs):
+        """ Return the writer of this file, starting it the first time """
+        # Forked workers would truncate and overwrite the file of each other
+        pcap = prefork.worker_path(pcap)
+        with cls.writers_lock:
+            if not pcap in cls.writers:
+                cls.writers[pcap] = cls(pcap,*args,**kargs)
+            return cls.writers[pcap]
+
+    def __init__(self,pcap,linktype=1,append=False,sync=False,rotate_size=None,rotate_interval=None,ring=None):
+        self.pcap = pcap
+        self.linktype = linktype
+        self.append = append
+        self.sync = sync
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.ring = ring
+        self.index = 0
+        self.queue = queue.SimpleQueue()
+        self.open()
+        self.thread = Thread(target=self.run,daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def filename(self):
+        if not (self.rotate_size or self.rotate_interval):
+            return self.pcap
+        return "%s.%d" % (self.pcap,self.index)
+
+    def open(self):
+        self.fd = open(self.filename(),"ab" if self.append else "wb")
+        self.opened = time.time()
+        self.size = self.fd.tell()
+        if not self.size:
+            self.write(PCAP_HEADER.pack(0xa1b2c3d4,2,4,0,0,0xFFFF,self.linktype))
+
+    def rotate(self):
+        self.fd.close()
+        self.index += 1
+        if self.ring:
+            self.index %= self.ring
+        # A rotated file is always started from scratch
+        self.append = False
+        self.open()
+
+    def need_rotation(self):
+        if self.rotate_size and self.size >= self.rotate_size:
+            return True
+        if self.rotate_interval and time.time() - self.opened >= self.rotate_interval:
+            return True
+        return False
+
+    def write(self,data):
+        self.fd.write(data)
+        self.size += len(data)
+
+    def add(self,pkt):
+        """ Queue a packet, called from the forwarding threads """
+        self.queue.put((time.time(),bytes(pkt)))
+
+    def record(self,t,pkt):
+        # Rounding the fraction alone could give 1000000 microseconds
+        sec,usec = divmod(int(round(t * 1000000)),1000000)
+        sz = len(pkt) + len(ETHER_HEADER)
+        return b"".join((RECORD_HEADER.pack(sec,usec,sz,sz),ETHER_HEADER,pkt))
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.BATCH_SIZE:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            end = batch[-1] is None
+            if end:
+                batch.pop()
+            if batch:
+                if self.need_rotation():
+                    self.rotate()
+                self.write(b"".join(self.record(t,pkt) for t,pkt in batch))
+                if self.sync:
+                    self.fd.flush()
+            if end:
+                break
+        self.fd.close()
+
+    def close(self):
+        """ Write pending packets and close the file """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
 @Module.register
 class Pcap(Logger):
     _desc_ = "Pcap Module"
@@ -15,38 +136,27 @@ class Pcap(Logger):
     @classmethod
     def set_cli_arguments(cls,parser):
         super().set_cli_arguments(parser)
-        parser.add_argument("--pcap","-p",metavar="PCAP",default="out.pcap",help="Pcap file to write")
+        parser.add_argument("--pcap","-p",metavar="PCAP",default="out.pcap",help="Pcap file to write (with --workers, worker N writes PCAP.N)")
         parser.add_argument("--link","-l",metavar="LINK_TYPE",default=1,type=int,help="Type of link layer")
         parser.add_argument("--append","-a",action="store_true",help="Append to pcap")
-        parser.add_argument("--sync","-s",action="store_true",help="Sync pcap file")
+        parser.add_argument("--sync","-s",action="store_true",help="Sync pcap file after each batch of packets")
+        parser.add_argument("--rotate-size",metavar="BYTES",type=int,help="Start a new pcap file when the current one reaches BYTES")
+        parser.add_argument("--rotate-interval",metavar="SECONDS",type=float,help="Start a new pcap file every SECONDS")
+        parser.add_argument("--ring",metavar="N",type=int,help="Keep only the last N rotated files")
 
-    def __init__(self,pcap="out.pcap",link=1,append=False,sync=True,*args,**kargs):
+    def __init__(self,pcap="out.pcap",link=1,append=False,sync=True,rotate_size=None,rotate_interval=None,ring=None,*args,**kargs):
         super().__init__(*args,**kargs)
         self.pcap = pcap
         self.linktype = link
         self.append = append
         self.sync = sync
-        self.fd = open(self.pcap,"wb")
-        if not self.append:
-            self.write_pcap_header()
-
-    def write_pcap_header(self):
-        self.fd.write(struct.pack("IHHIIII",0xa1b2c3d4,2,4,0,0,0xFFFF,self.linktype))
+        # All connections share the same writer
+        self.writer = PcapWriter.get(pcap,link,append,sync,rotate_size,rotate_interval,ring)
 
     def write_pkt(self,pkt):
-        t = time.time()
-        it = int(t)
-        sec = it
-        usec = int(round((t - it) * (1000000)))
-        self.fd.write(struct.pack("IIII",sec,usec,len(pkt)+14,len(pkt)+14))
-        self.fd.write(b"\x00"*12 + b"\x08\x00" + pkt)
-        if self.sync:
-            self.fd.flush()
+        self.writer.add(pkt)
 
     def handle(self,data,one):
         super().handle(data,one)
         self.write_pkt(data)
         return data
-
-    def close(self):
-        self.fd.close()
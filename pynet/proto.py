@@ -6,6 +6,9 @@ from collections import defaultdict
 
 from pynet.tools.utils import Register,DirectAccessDict
 
+class ProtoError(Exception):
+    pass
+
 class ProtoRegister(Register):
     _cmd_  = "Proto"
     _desc_ = "List of registered Proto"
@@ -42,6 +45,13 @@ class Proto(object):
     def add(self,data):
         return data
 
+    def add_vectored(self,data):
+        """ Same as add, but each packet is a list of fragments that the endpoint sends without joining them """
+        pkts = self.add(data)
+        if pkts is None: return []
+        pkts = pkts if type(pkts) is list else [pkts]
+        return [[pkt] for pkt in pkts]
+
     def remove(self,data):
         return data
 
@@ -58,50 +68,63 @@ class NoProto(Proto):
 class LengthProto(Proto):
     _desc_ = "Lenght protocol"
 
-    def __init__(self,out=True,fmt=">H",*args,**kargs):
+    def __init__(self,out=True,fmt=">H",max_size=1<<24,*args,**kargs):
         super().__init__(*args,**kargs)
-        self.buf = b""
+        self.buf = bytearray()
+        self.pos = 0
         self.fmt = fmt
-        self.fmt_sz = struct.calcsize(self.fmt)
+        self.header = struct.Struct(fmt)
+        self.fmt_sz = self.header.size
+        self.max_size = max_size
         self.out = out
 
     def add_layer(self,data):
-        return struct.pack(self.fmt,len(data)) + data
+        return self.header.pack(len(data)) + data
 
-    def del_layer(self,data):
-        data = self.buf + data
-        self.buf = b""
+    def append(self,data):
+        """ Append data after the unread part of the buffer """
         try:
-            sz = struct.unpack(self.fmt,data[:self.fmt_sz])[0]
-        except:
-            self.buf = data
-            return None
+            # Only the beginning of an incomplete frame is moved
+            del self.buf[:self.pos]
+            self.buf += data
+        except BufferError:
+            # Frames returned previously are still used, keep them untouched
+            self.buf = self.buf[self.pos:] + data
+        self.pos = 0
 
-        payload  = data[self.fmt_sz:]
-
-        if len(payload) < sz: # Missing payload
-            self.buf = data
+    def del_layer(self,data):
+        """ Return complete frames as memoryview on the buffer, they are valid until the next call """
+        self.append(data)
+        buf = self.buf
+        end = len(buf)
+        pos = 0
+        frames = []
+        view = memoryview(buf)
+        while end - pos >= self.fmt_sz:
+            sz = self.header.unpack_from(buf,pos)[0]
+            if sz > self.max_size:
+                raise ProtoError("Frame of %u bytes is bigger than the maximum %u" % (sz,self.max_size))
+            if end - pos - self.fmt_sz < sz: # Missing payload
+                break
+            pos += self.fmt_sz
+            frames.append(view[pos:pos+sz])
+            pos += sz
+        self.pos = pos
+
+        if len(frames) == 0:
             return None
-        elif len(payload) == sz:
-            return payload
-        else: # To much data
-            res = []
-            while len(payload) > 0:
-                res.append(payload[:sz])
-                data = payload[sz:]
-                try:
-                    sz = struct.unpack(self.fmt,data[:self.fmt_sz])[0]
-                except:
-                    self.buf = data
-                    return res
-
-                payload  = data[self.fmt_sz:]
-                if len(payload) < sz:
-                    self.buf = data
-                    return res
+        elif len(frames) == 1:
+            return frames[0]
+        return frames
 
     def add(self,data):
         return self.add_layer(data) if self.out else self.del_layer(data)
 
+    def add_vectored(self,data):
+        # The header and the payload are sent as two fragments, the payload is not copied
+        if self.out:
+            return [[self.header.pack(len(data)),data]]
+        return super().add_vectored(data)
+
     def remove(self,data):
         return self.del_layer(data) if self.out else self.add_layer(data)
@@ -6,13 +6,17 @@ import logging
 from collections import defaultdict
 from copy import copy
 import time
+import asyncio
 from threading import Thread
 
-from pynet.forwarder import ThreadForwarder
+from pynet.forwarder import ThreadForwarder,AsyncForwarder,get_forwarder
 from pynet.tools.utils import Register
 from pynet.module import Module,PassThrough,ModuleContainer
-from pynet.endpoint import InputEndpoint,OutputEndpoint
+from pynet.endpoint import InputEndpoint,OutputEndpoint,EndpointClose
 from pynet.plugin import Plugin
+from pynet.tools import prefork
+from pynet.tools import metrics
+from pynet.tools.flow import set_watermarks
 
 logger = logging.getLogger("RELAY")
 logger.setLevel(logging.WARNING)
@@ -22,15 +26,25 @@ logger.addHandler(ch)
 
 
 class AbstractRelay(object):
+    # Used in metrics, the class name by default
+    name = None
+
     def __init__(self,module=ModuleContainer(PassThrough,{}),forwarder=ThreadForwarder):
-        self.modules = [module]
+        # A list of modules is a pipeline
+        self.modules = module if type(module) is list else [module]
         self.forwarder_cls = forwarder
 
     def instanciate_forwarder(self,ep1,ep2,end_forwarder_cb=None):
-        return self.forwarder_cls(ep1,ep2,self.modules,end_forwarder_cb)
+        fwd = self.forwarder_cls(ep1,ep2,self.modules,end_forwarder_cb)
+        fwd.name = self.name if self.name else type(self).__name__
+        return fwd
 
     def run(self):
-        self.init()
+        try:
+            self.init()
+        except OSError as e:
+            print("Unable to initialize endpoints: %s" % (e or type(e).__name__,))
+            return
         try:
             self.do_run()
         except KeyboardInterrupt:
@@ -74,6 +88,9 @@ class MultipleRelay(AbstractRelay):
     def end_forwarder(self,forwarder):
         """ Callback called by a forwarder when it ends """
         self.forwarders.remove(forwarder)
+        prefork.connection_closed()
+        metrics.active_connections.dec()
+        metrics.connection_duration.observe(time.monotonic() - forwarder.started)
         logger.debug("Remove forwarder %r" % (forwarder,))
 
     def close(self):
@@ -83,7 +100,11 @@ class MultipleRelay(AbstractRelay):
 
     def add(self,ep1,ep2):
         fwd = self.instanciate_forwarder(ep1,ep2,self.end_forwarder)
+        fwd.started = time.monotonic()
         self.forwarders.append(fwd)
+        prefork.connection_opened()
+        metrics.connections_total.inc()
+        metrics.active_connections.inc()
         fwd.start()
 
 
@@ -102,7 +123,13 @@ class MultipleClientRelay(MultipleRelay):
             while not self.stop:
                 client,_ = self.ep1.handle_new_client()
                 server = self.ep2.duplicate()
-                server.init()
+                try:
+                    server.init()
+                except (OSError,EndpointClose) as e:
+                    # Only this client is given up
+                    logger.warning("Unable to connect to server %r : %s" % (server,e or type(e).__name__))
+                    client.do_close()
+                    continue
                 self.add(client,server)
         except KeyboardInterrupt:
             self.stop = True
@@ -112,6 +139,64 @@ class MultipleClientRelay(MultipleRelay):
         self.stop = False
 
 
+class AsyncRelayMixin(object):
+    """ Run a relay inside an asyncio loop, init and do_run are coroutines """
+    def run(self):
+        try:
+            asyncio.run(self.async_run())
+        except KeyboardInterrupt:
+            pass
+        self.close()
+
+    async def async_run(self):
+        await self.init()
+        await self.do_run()
+
+
+class AsyncRelay(AsyncRelayMixin,Relay):
+    """ Relay running inside an asyncio loop, endpoints must be asyncio endpoints """
+    def __init__(self,first_endpoint,second_endpoint,module=ModuleContainer(PassThrough,{}),forwarder=AsyncForwarder):
+        super().__init__(first_endpoint,second_endpoint,module,forwarder)
+
+    async def init(self):
+        await self.ep1.init()
+        await self.ep2.init()
+
+    async def do_run(self):
+        self.forwarder = self.instanciate_forwarder(self.ep1,self.ep2)
+        logger.debug("relay starting forwarder %r" % (self.forwarder,))
+        await self.forwarder.run()
+
+
+class AsyncMultipleClientRelay(AsyncRelayMixin,MultipleClientRelay):
+    """ Accept clients from an asyncio loop, connection to the server is done concurrently """
+    def __init__(self,first_endpoint,second_endpoint,module=ModuleContainer(PassThrough,{}),forwarder=AsyncForwarder):
+        super().__init__(first_endpoint,second_endpoint,module,forwarder)
+
+    async def init(self):
+        await self.ep1.init()
+
+    async def do_run(self):
+        # Keep a reference on pending connections, the loop only keeps weak ones
+        self.connecting = set()
+        while not self.stop:
+            client,_ = await self.ep1.handle_new_client()
+            task = asyncio.ensure_future(self.handle_new_client(client))
+            self.connecting.add(task)
+            task.add_done_callback(self.connecting.discard)
+
+    async def handle_new_client(self,client):
+        """ Connect to the server without blocking the accept loop """
+        server = self.ep2.duplicate()
+        try:
+            await server.init()
+        except (OSError,EndpointClose) as e:
+            logger.warning("Unable to connect to server %r : %r" % (server,e))
+            client.do_close()
+            return
+        self.add(client,server)
+
+
 class ProxyRegister(Register):
     _cmd_  = "Proxy"
     _desc_ = "List of registered Proxys"
@@ -134,11 +219,26 @@ class Proxy(Plugin):
     @classmethod
     def set_cli_arguments(cls,parser):
         parser.add_argument("--console",action="store_true",help="Activate IPython console")
-
-    def __init__(self,module=ModuleContainer(PassThrough,{}),console=None,relay=MultipleRelay,*args,**kargs):
+        parser.add_argument("--forwarder",metavar="FORWARDER",default="thread",type=get_forwarder,help="Forwarder to use between thread (two threads per connection) and selector (shared epoll thread)")
+        io = parser.add_argument_group('I/O',"Read and kernel buffer sizes of the proxy endpoints")
+        io.add_argument("--read-size",metavar="SIZE",type=int,help="Size of a read")
+        io.add_argument("--adaptive-read",action="store_true",help="Grow the read size while reads fill it, shrink it back for small messages")
+        io.add_argument("--rcvbuf",metavar="SIZE",type=int,help="Kernel receive buffer size (SO_RCVBUF)")
+        io.add_argument("--sndbuf",metavar="SIZE",type=int,help="Kernel send buffer size (SO_SNDBUF)")
+        io.add_argument("--high-watermark",metavar="BYTES",type=int,help="Stop reading an endpoint once BYTES wait for the other one (selector forwarder, default 1MB)")
+        io.add_argument("--low-watermark",metavar="BYTES",type=int,help="Read it again once BYTES are left (default 256KB)")
+
+    def __init__(self,module=ModuleContainer(PassThrough,{}),console=None,relay=MultipleRelay,forwarder=ThreadForwarder,read_size=None,adaptive_read=False,rcvbuf=None,sndbuf=None,high_watermark=None,low_watermark=None,*args,**kargs):
         super().__init__(*args,**kargs)
+        set_watermarks(high_watermark,low_watermark)
+        # Given to every endpoint created by the proxy
+        self.endpoint_conf = {"read_size":read_size,"adaptive_read":adaptive_read,"rcvbuf":rcvbuf,"sndbuf":sndbuf}
+        if issubclass(forwarder,AsyncForwarder):
+            print("asyncio forwarder is only available with pycat")
+            sys.exit(1)
         self.module = module
-        self.relay = relay(module)
+        self.relay = relay(module,forwarder=forwarder)
+        self.relay.name = type(self).__name__
         self.console = console
         self.stop = False
         if console:
@@ -15,10 +15,10 @@ class HTTPSProxy(TLSProxy):
         super().__init__(*args,**kargs)
 
     def create_client_side(self):
-        return self.CLIENT_ENDPOINT(bind=self.host,port=self.port,certificate=self.certificate,key=self.key,tls_version=self.tls_version,tls_ciphers=self.tls_ciphers)
+        return self.CLIENT_ENDPOINT(bind=self.host,port=self.port,certificate=self.certificate,key=self.key,tls_version=self.tls_version,tls_ciphers=self.tls_ciphers,**self.endpoint_conf)
 
     def create_server_side(self,dest,dport):
-        return self.SERVER_ENDPOINT(destination=dest,port=dport,tls_version=self.tls_version,tls_ciphers=self.tls_ciphers)
+        return self.SERVER_ENDPOINT(destination=dest,port=dport,tls_version=self.tls_version,tls_ciphers=self.tls_ciphers,**self.endpoint_conf)
 
 
     def handle_new_connection(self,endpoint_client,real_dst_addr):
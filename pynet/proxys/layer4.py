@@ -3,12 +3,22 @@
 
 import sys
 import os
+import socket
+import signal
+import threading
 
 from pynet.proxy import Proxy
 from pynet.endpoints.socket import *
 from pynet.proxys.tproxy import TProxyConfigurator,BridgeConfigurator
+from pynet.tools.pool import ConnectionPool
+from pynet.tools.connector import Connector
+from pynet.tools.flow import FlowControl
+from pynet.tools import metrics
 
 class Layer4Proxy(Proxy):
+    # Options specific to a transport, of the listening endpoint and of both sides
+    listen_conf = {}
+    transport_conf = {}
 
     @classmethod
     def set_cli_arguments(cls,parser):
@@ -21,6 +31,10 @@ class Layer4Proxy(Proxy):
         parser.add_argument("--mirror",action="store_true",help="Use the same source port as the client one (might need root permission if port is lower than 1024, and don't work if client is on the same system as the proxy)")
         parser.add_argument("--transparent",action="store_true",help="Use as transparent proxy")
 
+        connect = parser.add_argument_group('Server connection',"Connections to the server are opened by worker threads, SIGUSR2 prints their statistics")
+        connect.add_argument("--connect-timeout",metavar="SECONDS",default=10,type=float,help="Give up connecting to the server after SECONDS and close the client (default 10)")
+        connect.add_argument("--connect-workers",metavar="N",default=32,type=int,help="Connect to the server for up to N clients at once, 0 to connect from the accept loop (default 32)")
+
         tproxy = parser.add_argument_group('Transparent proxy options')
         tproxy.add_argument("--tproxy-chain",metavar="CHAIN",default="INTERCEPT",help="Use CHAIN as Netfilter interception chain")
         tproxy.add_argument("--tproxy-mark",metavar="MARK",default=64,type=int,help="use MARK as NetFilter packet mark for ip rule")
@@ -31,8 +45,11 @@ class Layer4Proxy(Proxy):
         tproxy.add_argument("--no-tproxy-netfilter",action="store_false",dest="tproxy_netfilter",help="Configure netfilter system for tproxy")
         tproxy.add_argument("--bridge",action="store_true",help="Proxy mode is in bridged mode")
 
-    def __init__(self,port=8080,bind="0.0.0.0",src_port=None,server_ip="127.0.0.1",server_port=None,mirror=False,transparent=False,tproxy_chain="INTERCEPT",tproxy_mark="MARK",tproxy_table="TABLE",tproxy_client_iface="eth0",tproxy_server_iface="eth1",tproxy_specific_filter="",bridge=False,tproxy_netfilter=True,*args,**kargs):
+    def __init__(self,port=8080,bind="0.0.0.0",src_port=None,server_ip="127.0.0.1",server_port=None,mirror=False,transparent=False,tproxy_chain="INTERCEPT",tproxy_mark="MARK",tproxy_table="TABLE",tproxy_client_iface="eth0",tproxy_server_iface="eth1",tproxy_specific_filter="",bridge=False,tproxy_netfilter=True,reuse_port=False,pool_size=0,pool_max_idle=30,connect_timeout=10,connect_workers=32,*args,**kargs):
         super().__init__(*args,**kargs)
+        self.reuse_port = reuse_port
+        self.connect_timeout = connect_timeout
+        self.connector = Connector(connect_workers)
         self.port = port
         self.host = bind
         self.server_ip = server_ip
@@ -52,27 +69,67 @@ class Layer4Proxy(Proxy):
 
         self.client_side = self.create_client_side()
 
+        # Connections to the server can only be opened in advance if they all go to the same place
+        self.pool = None
+        if pool_size and not (self.transparent or self.mirror or self.src_port):
+            self.pool = ConnectionPool(self.connect_server,pool_size,pool_max_idle)
+
     def init(self):
         self.client_side.init()
+        if self.pool: self.pool.start()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR2,self.print_stats)
+        if hasattr(self.client_side,"accept_stats"):
+            stats = self.client_side.accept_stats
+            metrics.registry.callback_gauge("pynet_accept_queue","Clients waiting to be accepted",lambda:stats()["queue"])
+            metrics.registry.callback_gauge("pynet_accept_backlog","Maximum number of clients waiting to be accepted",lambda:stats()["backlog"])
+            metrics.registry.callback_gauge("pynet_listen_overflows","Clients dropped by full accept queues on this system",lambda:stats()["listen_overflows"])
 
     def close(self):
+        self.connector.close()
+        self.print_stats()
+        if self.pool:
+            self.pool.close()
         if self.transparent and self.args.tproxy_netfilter:
             self.netfilter_configurator.deconfigure()
         if self.bridge:
             self.bridge_configurator.deconfigure()
 
     def create_client_side(self):
-        return self.CLIENT_ENDPOINT(bind=self.host,sport=self.port,transparent=self.transparent)
+        return self.CLIENT_ENDPOINT(bind=self.host,sport=self.port,transparent=self.transparent,reuse_port=self.reuse_port,**self.listen_conf,**self.transport_conf,**self.endpoint_conf)
 
     def create_server_side(self,dest,dport,sport):
-        return self.SERVER_ENDPOINT(destination=dest,dport=dport,sport=sport,transparent=self.transparent)
+        return self.SERVER_ENDPOINT(destination=dest,dport=dport,sport=sport,transparent=self.transparent,connect_timeout=self.connect_timeout,**self.transport_conf,**self.endpoint_conf)
+
+    def print_stats(self,signum=None,frame=None):
+        print(self.connector.stats)
+        if hasattr(self.client_side,"accept_stats"):
+            print("accept: %s" % (", ".join("%s %d" % item for item in self.client_side.accept_stats().items()),))
+        print("flow: %s" % (", ".join("%s %d" % item for item in FlowControl.gauges().items()),))
+        print("splice: %d of %d connections" % (metrics.spliced_connections.labels().values()[0],metrics.connections_total.labels().values()[0]))
+        sys.stdout.flush()
+
+    def connect_server(self,dst_ip=None,dst_port=None,sport=None):
+        """ Return a new endpoint connected to the server, by default the one given on the command line """
+        endpoint_server = self.create_server_side(dst_ip if dst_ip else self.server_ip,dst_port if dst_port else self.server_port if self.server_port else self.port,sport)
+        endpoint_server.init()
+        return endpoint_server
 
     def handle_new_connection(self,endpoint_client,real_dst_addr=None):
         """ Handle a new data coming to the socket """
+        metrics.accepted_total.inc()
+        self.connector.submit(self.get_server_connector(endpoint_client,real_dst_addr),
+                              lambda endpoint_server:self.relay.add(endpoint_client,endpoint_server),
+                              lambda error:endpoint_client.do_close())
+
+    def get_server_connector(self,endpoint_client,real_dst_addr=None):
+        """ Return a function opening the connection to the server of this client """
+        if self.pool:
+            return self.pool.get
 
         # Create socket that will be exchanging data with the real server
         if self.mirror:
-            sport = endpoint_client.sock.getpeername()[1]
+            sport = endpoint_client.peer_addr()[1]
         elif self.src_port:
             sport = self.src_port
         else:
@@ -84,10 +141,7 @@ class Layer4Proxy(Proxy):
             dst_ip = self.server_ip
             dst_port = self.server_port if self.server_port else self.port
 
-        endpoint_server = self.create_server_side(dst_ip,dst_port,sport)
-        endpoint_server.init()
-
-        self.relay.add(endpoint_client,endpoint_server)
+        return lambda:self.connect_server(dst_ip,dst_port,sport)
 
     def do_run(self):
         self.init()
@@ -102,12 +156,42 @@ class TCPProxy(Layer4Proxy):
     CLIENT_ENDPOINT = TCP_LISTEN
     SERVER_ENDPOINT = TCP
 
+    @classmethod
+    def set_cli_arguments(cls,parser):
+        super().set_cli_arguments(parser)
+        pool = parser.add_argument_group('Connection pool',"Connections to the server opened before clients arrive")
+        pool.add_argument("--pool-size",metavar="N",default=0,type=int,help="Keep N connections to the server ready (not with --transparent, --mirror or --src-port)")
+        pool.add_argument("--pool-max-idle",metavar="SECONDS",default=30,type=float,help="Close pooled connections unused for SECONDS (default 30)")
+        accept = parser.add_argument_group('Accept',"Listening socket options")
+        accept.add_argument("--backlog",metavar="N",default=socket.SOMAXCONN,type=int,help="Maximum number of clients waiting to be accepted (default %d)" % (socket.SOMAXCONN,))
+        accept.add_argument("--defer-accept",metavar="SECONDS",type=int,help="Accept clients only once they have sent data, or after SECONDS (TCP_DEFER_ACCEPT, not for protocols where the server talks first)")
+        add_tcp_arguments(parser)
+
+    def __init__(self,backlog=socket.SOMAXCONN,defer_accept=None,tcp_profile="default",nodelay=None,quickack=None,fastopen=None,user_timeout=None,keepalive=None,notsent_lowat=None,*args,**kargs):
+        self.listen_conf = {"backlog":backlog,"defer_accept":defer_accept}
+        self.transport_conf = {"tcp_profile":tcp_profile,"nodelay":nodelay,"quickack":quickack,"fastopen":fastopen,"user_timeout":user_timeout,"keepalive":keepalive,"notsent_lowat":notsent_lowat}
+        super().__init__(*args,**kargs)
+
 @Proxy.register
 class UDPProxy(Layer4Proxy):
     _desc_ = "UDP Proxy"
     CLIENT_ENDPOINT = UDP_LISTEN
     SERVER_ENDPOINT = UDP
 
+    @classmethod
+    def set_cli_arguments(cls,parser):
+        super().set_cli_arguments(parser)
+        parser.add_argument("--session-timeout",metavar="SECONDS",default=60,type=float,help="Forget a client after SECONDS without traffic (default 60)")
+        parser.add_argument("--batch",metavar="N",default=64,type=int,help="Maximum number of datagrams read by one system call (default 64)")
+
+    def __init__(self,session_timeout=60,batch=64,*args,**kargs):
+        self.session_timeout = session_timeout
+        self.batch = batch
+        super().__init__(*args,**kargs)
+
+    def create_client_side(self):
+        return self.CLIENT_ENDPOINT(bind=self.host,sport=self.port,transparent=self.transparent,reuse_port=self.reuse_port,session_timeout=self.session_timeout,batch=self.batch,**self.endpoint_conf)
+
 @Proxy.register
 class UnixSocketProxy(Proxy):
     _desc_ = "Unix stream socket proxy"
@@ -119,9 +203,11 @@ class UnixSocketProxy(Proxy):
         super().set_cli_arguments(parser)
         parser.add_argument("-b","--bind",metavar="PATH",required=True,help="Unix socket to bind to")
         parser.add_argument("--destination","-d",metavar="PATH",required=True,help="Unix socket destination")
+        parser.add_argument("--backlog",metavar="N",default=socket.SOMAXCONN,type=int,help="Maximum number of clients waiting to be accepted (default %d)" % (socket.SOMAXCONN,))
 
-    def __init__(self,bind,destination,*args,**kargs):
+    def __init__(self,bind,destination,backlog=socket.SOMAXCONN,*args,**kargs):
         super().__init__(*args,**kargs)
+        self.backlog = backlog
         self.bind_addr = bind
         self.destination = destination
         self.client_side = self.create_client_side()
@@ -130,16 +216,21 @@ class UnixSocketProxy(Proxy):
         self.client_side.init()
  
     def create_client_side(self):
-        return self.CLIENT_ENDPOINT(bind=self.bind_addr)
+        return self.CLIENT_ENDPOINT(bind=self.bind_addr,backlog=self.backlog,**self.endpoint_conf)
 
     def create_server_side(self):
-        return self.SERVER_ENDPOINT(destination=self.destination)
+        return self.SERVER_ENDPOINT(destination=self.destination,**self.endpoint_conf)
 
     def handle_new_connection(self,endpoint_client):
         """ Handle a new data coming to the socket """
 
         endpoint_server = self.create_server_side()
-        endpoint_server.init()
+        try:
+            endpoint_server.init()
+        except OSError as e:
+            print("Unable to connect to %s: %s" % (self.destination,e))
+            endpoint_client.do_close()
+            return
 
         self.relay.add(endpoint_client,endpoint_server)
 
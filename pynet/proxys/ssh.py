@@ -99,10 +99,10 @@ class SSHProxy(TCPProxy):
         pass
 
     def create_client_side(self):
-        return SSH_LISTEN(bind=self.host,port=self.port,transparent=self.transparent)
+        return SSH_LISTEN(bind=self.host,port=self.port,transparent=self.transparent,**self.endpoint_conf)
 
     def create_server_side(self,dest,dport,sport):
-        return SSH(destination=dest,port=dport,user=self.user,password=self.password,exec_command=False,tty=False,src_port=sport,transparent=self.transparent,invoke_shell=False)
+        return SSH(destination=dest,port=dport,user=self.user,password=self.password,exec_command=False,tty=False,src_port=sport,transparent=self.transparent,invoke_shell=False,**self.endpoint_conf)
 
     def handle_new_tcp_connection(self,listening_channel,real_dst_addr=None):
         """ Handle a new data coming to the socket """
@@ -130,7 +130,7 @@ class SSHProxy(TCPProxy):
             print('*** SSH negotiation failed.')
             sys.exit(1)
 
-        proxy = SSHChannelProxy(listening_channel,endpoint_server,ssh_server,module=self.modules[0])
+        proxy = SSHChannelProxy(listening_channel,endpoint_server,ssh_server,module=self.modules)
         proxy_thread = SSHChannelProxyThread(proxy)
         proxy_thread.start()
 
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import deque
+from threading import Lock
+
+class BufferPool(object):
+    """ Pool of preallocated bytearray filled by recv_into and reused between receptions """
+
+    def __init__(self,size=4096,max_free=1024):
+        self.size = size
+        self.max_free = max_free
+        self.free = deque()
+
+    def get(self):
+        try:
+            return self.free.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    def put(self,buf):
+        # Keep only a bounded number of idle buffers
+        if len(self.free) < self.max_free:
+            self.free.append(buf)
+
+
+pools = {}
+pools_lock = Lock()
+
+def get_pool(size):
+    """ Return the global pool of buffers of this size """
+    try:
+        return pools[size]
+    except KeyError:
+        with pools_lock:
+            return pools.setdefault(size,BufferPool(size))
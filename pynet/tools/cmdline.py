@@ -20,19 +20,27 @@ Endpoints.import_all()
 Proxys.import_all()
 Modules.import_all()
 
+# Separate the plugins of a pipeline on the command line
+PIPE = "|"
+
 
 class PynetParser(object):
-    def __init__(self,name,description="",plugins_cb=[],preparser=None):
+    def __init__(self,name,description="",plugins_cb=[],preparser=None,pipelines=["Module"]):
         self.name = name
         self.description = description
         self.plugins_cb = plugins_cb
+        # Plugin types which can be chained, they are returned as a list
+        self.pipelines = pipelines
+        self.general_options = ["plugin","remain"]
         self.preparser = self.create_preparser()
         self.parser = self.create_parser()
         self.add_plugin_path_option()
 
     def add_option(self,*args,**kargs):
         self.preparser.add_argument(*args,**kargs)
-        self.parser.add_argument(*args,**kargs)
+        action = self.parser.add_argument(*args,**kargs)
+        # General options must not be given to plugins
+        self.general_options.append(action.dest)
 
     def add_plugin_path_option(self):
         self.add_option("--plugin-path",metavar="PATH",default=None,help="Where to find additionnal plugins")
@@ -92,7 +100,18 @@ class PynetParser(object):
 
             args,remain = self.parser.parse_known_args(remain)
             if hasattr(args,"remain"): remain = args.remain + remain
-            res.append(self.get_plugin_class(args)) 
+            plugin = self.get_plugin_class(args)
+
+            if ptype in self.pipelines:
+                plugin = [plugin]
+                while remain and remain[0] == PIPE:
+                    args,remain = self.parser.parse_known_args(remain[1:])
+                    if hasattr(args,"remain"): remain = args.remain + remain
+                    if not args.plugin or not cb(Plugin.registerer.get(args.plugin)):
+                        self.parser.error("a %s is expected after %s" % (ptype,PIPE))
+                    plugin.append(self.get_plugin_class(args))
+
+            res.append(plugin)
 
         return res
 
@@ -103,5 +122,5 @@ class PynetParser(object):
 
         plugin_args = vars(args)
         plugin_cls = Plugin.registerer.get(plugin_args["plugin"])
-        remove_keys(plugin_args,("plugin","plugin_path","remain"))
+        remove_keys(plugin_args,self.general_options)
         return plugin_cls,plugin_args
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import socket
+from collections import deque
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+
+from pynet.endpoint import EndpointClose
+from pynet.tools import metrics
+
+import logging
+
+logger = logging.getLogger("Connector")
+logger.setLevel(logging.WARNING)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+logger.addHandler(ch)
+
+# Number of latest connections used for the latency percentiles
+LATENCY_SAMPLES = 1024
+
+
+class ConnectStats(object):
+    """ Outcome and latency of connections to the server """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.connected = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.total = 0.
+        self.max = 0.
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def add_success(self,latency):
+        with self.lock:
+            self.connected += 1
+            self.total += latency
+            self.max = max(self.max,latency)
+            self.latencies.append(latency)
+
+    def add_failure(self,error):
+        with self.lock:
+            self.failed += 1
+            if isinstance(error,socket.timeout):
+                self.timeouts += 1
+
+    def percentile(self,p):
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return 0.
+        return latencies[min(len(latencies)-1,int(len(latencies)*p))]
+
+    def __str__(self):
+        mean = self.total/self.connected if self.connected else 0.
+        return "connect: %d ok, %d failed (%d timeouts), latency mean %.2f ms, p50 %.2f ms, p99 %.2f ms, max %.2f ms" % \
+               (self.connected,self.failed,self.timeouts,mean*1000,self.percentile(.5)*1000,self.percentile(.99)*1000,self.max*1000)
+
+
+class Connector(object):
+    """ Connect to servers from a pool of threads, so the accept loop never waits for a server
+
+        connect returns a connected endpoint, then success is called with it,
+        or failure with the error. With no worker, the connection is made by
+        the calling thread.
+    """
+
+    def __init__(self,workers=0):
+        self.stats = ConnectStats()
+        self.executor = ThreadPoolExecutor(max_workers=workers,thread_name_prefix="connect") if workers else None
+
+    def submit(self,connect,success,failure):
+        if self.executor:
+            self.executor.submit(self.do_connect,connect,success,failure)
+        else:
+            self.do_connect(connect,success,failure)
+
+    def do_connect(self,connect,success,failure):
+        start = time.monotonic()
+        try:
+            endpoint = connect()
+        except (OSError,EndpointClose) as e:
+            self.stats.add_failure(e)
+            metrics.connect_failures.inc()
+            logger.warning("Unable to connect to server: %s" % (e or type(e).__name__,))
+            failure(e)
+            return
+        latency = time.monotonic() - start
+        self.stats.add_success(latency)
+        metrics.connect_latency.observe(latency)
+        try:
+            success(endpoint)
+        except Exception as e:
+            logger.warning("Cannot relay the new connection: %r" % (e,))
+            endpoint.close()
+            failure(e)
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=False,cancel_futures=True)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import deque
+from threading import Condition,Lock
+
+from pynet.tools.metrics import registry
+
+# Bytes buffered for a consumer before its producer is paused, and until it is resumed
+HIGH_WATERMARK = 1 << 20
+LOW_WATERMARK = 1 << 18
+
+def set_watermarks(high=None,low=None):
+    """ Change the default watermarks, for flow controls created afterwards """
+    global HIGH_WATERMARK,LOW_WATERMARK
+    if high: HIGH_WATERMARK = high
+    if low is not None: LOW_WATERMARK = low
+
+
+class FlowControl(object):
+    """ Count bytes buffered between a producer and a consumer
+
+        The producer is paused once high bytes are buffered and resumed when
+        the consumer has brought them back to low. Loops are told through the
+        pause and resume callbacks, threads block in wait.
+    """
+
+    # Gauges over every instance of the process
+    lock = Lock()
+    total_buffered = 0
+    total_paused = 0
+    pauses = 0
+
+    def __init__(self,high=None,low=None,pause=None,resume=None):
+        self.high = high if high else HIGH_WATERMARK
+        self.low = min(low if low is not None else LOW_WATERMARK,self.high)
+        self.pause_cb = pause
+        self.resume_cb = resume
+        self.buffered = 0
+        self.paused = False
+        self.closed = False
+        self.cond = Condition()
+
+    def add(self,size):
+        with self.cond:
+            if self.closed: return
+            self.buffered += size
+            pause = not self.paused and self.buffered >= self.high
+            if pause: self.paused = True
+        with FlowControl.lock:
+            FlowControl.total_buffered += size
+            if pause:
+                FlowControl.total_paused += 1
+                FlowControl.pauses += 1
+        if pause and self.pause_cb: self.pause_cb()
+
+    def remove(self,size):
+        with self.cond:
+            if self.closed: return
+            self.buffered -= size
+            resume = self.paused and self.buffered <= self.low
+            if resume:
+                self.paused = False
+                self.cond.notify_all()
+        with FlowControl.lock:
+            FlowControl.total_buffered -= size
+            if resume: FlowControl.total_paused -= 1
+        if resume and self.resume_cb: self.resume_cb()
+
+    def wait(self):
+        """ Block while the producer is paused, return False if closed in the meantime """
+        with self.cond:
+            while self.paused and not self.closed:
+                self.cond.wait()
+            return not self.closed
+
+    def close(self):
+        """ Wake up waiting producers and forget what is still buffered """
+        with self.cond:
+            if self.closed: return
+            self.closed = True
+            size,paused = self.buffered,self.paused
+            self.buffered = 0
+            self.paused = False
+            self.cond.notify_all()
+        with FlowControl.lock:
+            FlowControl.total_buffered -= size
+            if paused: FlowControl.total_paused -= 1
+
+    @classmethod
+    def gauges(cls):
+        with cls.lock:
+            return {"buffered_bytes":cls.total_buffered,"paused":cls.total_paused,"pauses":cls.pauses}
+
+
+class BoundedQueue(object):
+    """ Queue of messages holding at most about high bytes, put blocks above it until low is reached """
+
+    def __init__(self,high=None,low=None):
+        self.items = deque()
+        self.flow = FlowControl(high,low)
+        self.cond = Condition()
+
+    def put(self,item):
+        """ Return False if the queue has been closed """
+        if not self.flow.wait(): return False
+        with self.cond:
+            self.items.append(item)
+            self.cond.notify()
+        self.flow.add(len(item))
+        return True
+
+    def get(self):
+        """ Return the next message, None once the queue is closed """
+        with self.cond:
+            while not self.items:
+                self.cond.wait()
+            item = self.items.popleft()
+        if item is not None:
+            self.flow.remove(len(item))
+        return item
+
+    def close(self):
+        with self.cond:
+            self.items.append(None)
+            self.cond.notify()
+        self.flow.close()
+
+
+registry.callback_gauge("pynet_buffered_bytes","Bytes waiting for a slow endpoint",lambda:FlowControl.total_buffered)
+registry.callback_gauge("pynet_paused_endpoints","Endpoints not read because their peer is not draining",lambda:FlowControl.total_paused)
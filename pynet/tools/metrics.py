@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import bisect
+import socketserver
+from threading import Thread,Lock,local,current_thread
+from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+
+from pynet.tools import prefork
+
+import logging
+
+logger = logging.getLogger("Metrics")
+logger.setLevel(logging.WARNING)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+logger.addHandler(ch)
+
+# Shards of dead threads are merged once there are more than that
+MAX_SHARDS = 64
+
+SIZE_BUCKETS = (64,256,1024,4096,16384,65536,262144,1048576)
+DURATION_BUCKETS = (.01,.1,1,10,60,300,1800,3600)
+LATENCY_BUCKETS = (.0005,.001,.0025,.005,.01,.025,.05,.1,.25,.5,1,2.5,5,10)
+
+
+class Sharded(object):
+    """ Values updated without lock, each thread has its own copy which are summed when read """
+
+    def __init__(self,size):
+        self.size = size
+        self.local = local()
+        self.lock = Lock()
+        self.shards = []
+        # Values of threads which have ended
+        self.base = [0]*size
+
+    def shard(self):
+        try:
+            return self.local.values
+        except AttributeError:
+            values = self.local.values = [0]*self.size
+            with self.lock:
+                if len(self.shards) >= MAX_SHARDS:
+                    self.merge_dead()
+                self.shards.append((current_thread(),values))
+            return values
+
+    def merge_dead(self):
+        """ Fold shards of ended threads into base, must be called with the lock held """
+        alive = []
+        for thread,values in self.shards:
+            if thread.is_alive():
+                alive.append((thread,values))
+            else:
+                self.base = [a+b for a,b in zip(self.base,values)]
+        self.shards = alive
+
+    def values(self):
+        with self.lock:
+            self.merge_dead()
+            res = list(self.base)
+            for thread,values in self.shards:
+                res = [a+b for a,b in zip(res,values)]
+        return res
+
+
+class Counter(Sharded):
+    TYPE = "counter"
+
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self,n=1):
+        self.shard()[0] += n
+
+    def dec(self,n=1):
+        self.shard()[0] -= n
+
+    def samples(self,name,labels):
+        yield name,labels,self.values()[0]
+
+
+class Gauge(Counter):
+    """ Value going up and down, as a counter """
+    TYPE = "gauge"
+
+
+class Histogram(Sharded):
+    TYPE = "histogram"
+
+    def __init__(self,buckets):
+        self.buckets = tuple(buckets)
+        # One count per bucket, the +Inf one, then the sum
+        super().__init__(len(self.buckets)+2)
+
+    def observe(self,value):
+        values = self.shard()
+        values[bisect.bisect_left(self.buckets,value)] += 1
+        values[-1] += value
+
+    def samples(self,name,labels):
+        values = self.values()
+        total = 0
+        for bound,count in zip(self.buckets + ("+Inf",),values):
+            total += count
+            yield name + "_bucket",labels + (("le",format_value(bound)),),total
+        yield name + "_sum",labels,values[-1]
+        yield name + "_count",labels,total
+
+
+class CallbackGauge(object):
+    """ Gauge whose value is computed when metrics are collected """
+    TYPE = "gauge"
+
+    def __init__(self,callback):
+        self.callback = callback
+
+    def samples(self,name,labels):
+        yield name,labels,self.callback()
+
+
+class Family(object):
+    """ Metrics sharing a name, one per set of label values """
+
+    def __init__(self,name,help,labels,factory):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.factory = factory
+        self.children = {}
+        self.lock = Lock()
+
+    def labels(self,*values):
+        """ Return the metric of these label values, to be kept by callers of hot paths """
+        try:
+            return self.children[values]
+        except KeyError:
+            with self.lock:
+                if not values in self.children:
+                    self.children[values] = self.factory()
+                return self.children[values]
+
+    def __getattr__(self,name):
+        # Metrics without labels are used directly
+        if name in ("inc","dec","observe"):
+            return getattr(self.labels(),name)
+        raise AttributeError(name)
+
+    def render(self):
+        children = list(self.children.items())
+        if not children: return []
+        lines = ["# HELP %s %s" % (self.name,self.help),"# TYPE %s %s" % (self.name,children[0][1].TYPE)]
+        for values,metric in children:
+            for name,labels,value in metric.samples(self.name,tuple(zip(self.label_names,values))):
+                lines.append("%s%s %s" % (name,format_labels(labels),format_value(value)))
+        return lines
+
+
+def format_value(value):
+    if type(value) is str: return value
+    if type(value) is float and value.is_integer(): return str(int(value))
+    return repr(value)
+
+def format_labels(labels):
+    if not labels: return ""
+    return "{%s}" % (",".join('%s="%s"' % (k,str(v).replace("\\","\\\\").replace('"','\\"')) for k,v in labels),)
+
+
+class Registry(object):
+    """ Metrics of the process, by name """
+
+    def __init__(self):
+        self.families = {}
+        self.lock = Lock()
+
+    def register(self,name,help,labels,factory):
+        with self.lock:
+            if not name in self.families:
+                self.families[name] = Family(name,help,labels,factory)
+                # Metrics without labels are shown from the start
+                if not labels and factory: self.families[name].labels()
+            return self.families[name]
+
+    def counter(self,name,help,labels=()):
+        return self.register(name,help,labels,Counter)
+
+    def gauge(self,name,help,labels=()):
+        return self.register(name,help,labels,Gauge)
+
+    def histogram(self,name,help,buckets,labels=()):
+        return self.register(name,help,labels,lambda:Histogram(buckets))
+
+    def callback_gauge(self,name,help,callback):
+        """ Gauge computed by callback, a new callback replaces the previous one """
+        family = self.register(name,help,(),None)
+        family.children[()] = CallbackGauge(callback)
+        return family
+
+    def render(self):
+        with self.lock:
+            families = list(self.families.values())
+        lines = []
+        for family in families:
+            try:
+                lines.extend(family.render())
+            except Exception as e:
+                logger.warning("Cannot collect %s: %r" % (family.name,e))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# Metrics updated by the forwarders, relays and proxies
+bytes_total = registry.counter("pynet_bytes_total","Bytes received from endpoints",("direction",))
+messages_total = registry.counter("pynet_messages_total","Messages received from endpoints",("direction",))
+message_bytes = registry.histogram("pynet_message_bytes","Size of received messages",SIZE_BUCKETS)
+module_errors = registry.counter("pynet_module_errors_total","Exceptions raised by modules",("module",))
+connections_total = registry.counter("pynet_connections_total","Connections relayed")
+spliced_connections = registry.counter("pynet_spliced_connections_total","Connections relayed with splice, without copying data into python")
+active_connections = registry.gauge("pynet_active_connections","Connections being relayed")
+connection_duration = registry.histogram("pynet_connection_duration_seconds","Duration of relayed connections",DURATION_BUCKETS)
+accepted_total = registry.counter("pynet_accepted_total","Clients accepted by proxies")
+connect_latency = registry.histogram("pynet_connect_latency_seconds","Time to connect to the server",LATENCY_BUCKETS)
+connect_failures = registry.counter("pynet_connect_failures_total","Connections to the server which failed")
+
+DIRECTIONS = {True:"client_to_server",False:"server_to_client"}
+direction_bytes = {one:bytes_total.labels(name) for one,name in DIRECTIONS.items()}
+direction_messages = {one:messages_total.labels(name) for one,name in DIRECTIONS.items()}
+message_size = message_bytes.labels()
+
+def received(from_client,messages):
+    """ Account messages received by a forwarder """
+    size = 0
+    for msg in messages:
+        size += len(msg)
+        message_size.observe(len(msg))
+    direction_bytes[from_client].inc(size)
+    direction_messages[from_client].inc(len(messages))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/","/metrics"):
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type","text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self,format,*args):
+        logger.debug(format % args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        super().server_bind()
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def start_exporter(address):
+    """ Serve metrics over HTTP on HOST:PORT, or unix:PATH
+
+        Forked workers each serve their own metrics, on PORT+slot or PATH.slot.
+    """
+    slot = prefork.worker[1] if prefork.worker else None
+    if address.startswith("unix:"):
+        path = address[5:]
+        if slot is not None: path = "%s.%d" % (path,slot)
+        server = UnixHTTPServer(path,MetricsHandler)
+    else:
+        host,_,port = address.rpartition(":")
+        port = int(port) + (slot if slot is not None else 0)
+        server = ThreadingHTTPServer((host if host else "127.0.0.1",port),MetricsHandler)
+        server.daemon_threads = True
+    Thread(target=server.serve_forever,daemon=True).start()
+    return server
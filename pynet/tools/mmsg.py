@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import socket
+import ctypes
+import ctypes.util
+import struct
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c"),use_errno=True)
+    recvmmsg = libc.recvmmsg
+    sendmmsg = libc.sendmmsg
+except (OSError,AttributeError):
+    recvmmsg = None
+    sendmmsg = None
+
+MSG_DONTWAIT = getattr(socket,"MSG_DONTWAIT",0x40)
+MSG_WAITFORONE = 0x10000
+SOCKADDR_SIZE = 128 # sizeof(struct sockaddr_storage)
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base",ctypes.c_void_p),
+                ("iov_len",ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name",ctypes.c_void_p),
+                ("msg_namelen",ctypes.c_uint32),
+                ("msg_iov",ctypes.POINTER(iovec)),
+                ("msg_iovlen",ctypes.c_size_t),
+                ("msg_control",ctypes.c_void_p),
+                ("msg_controllen",ctypes.c_size_t),
+                ("msg_flags",ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr",msghdr),
+                ("msg_len",ctypes.c_uint)]
+
+if recvmmsg:
+    recvmmsg.argtypes = [ctypes.c_int,ctypes.POINTER(mmsghdr),ctypes.c_uint,ctypes.c_int,ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ctypes.c_int,ctypes.POINTER(mmsghdr),ctypes.c_uint,ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+
+def raise_errno():
+    err = ctypes.get_errno()
+    raise OSError(err,os.strerror(err))
+
+
+def parse_sockaddr(addr,length):
+    """ Convert a struct sockaddr to the address format used by the socket module """
+    if length == 0:
+        return None
+    family, = struct.unpack_from("H",addr)
+    if family == socket.AF_INET:
+        port,ip = struct.unpack_from("!H4s",addr,2)
+        return socket.inet_ntoa(ip),port
+    if family == socket.AF_INET6:
+        # Like the socket module, flowinfo is converted from network order, scope_id is in host order
+        port,flowinfo = struct.unpack_from("!HI",addr,2)
+        ip,scope_id = struct.unpack_from("=16sI",addr,8)
+        return socket.inet_ntop(socket.AF_INET6,ip),port,flowinfo,scope_id
+    if family == socket.AF_UNIX:
+        path = bytes(addr[2:length])
+        # Abstract sockets keep their leading null byte and are returned as bytes
+        if path[:1] == b"\x00":
+            return path
+        return path.split(b"\x00",1)[0].decode()
+    raise ValueError("Unsupported address family %d" % (family,))
+
+
+class DatagramReceiver(object):
+    """ Receive up to count datagrams with a single recvmmsg call
+
+        Buffers are allocated once and reused, received datagrams are copied
+        out of them. Falls back to one recvfrom per call when recvmmsg is not
+        available.
+    """
+
+    def __init__(self,sock,count=64,size=65536):
+        self.sock = sock
+        self.count = count if recvmmsg else 1
+        self.size = size
+        if not recvmmsg:
+            return
+
+        self.data = bytearray(self.count*size)
+        self.view = memoryview(self.data)
+        self.names = bytearray(self.count*SOCKADDR_SIZE)
+        self.iovecs = (iovec*self.count)()
+        self.msgs = (mmsghdr*self.count)()
+        data = (ctypes.c_char*len(self.data)).from_buffer(self.data)
+        names = (ctypes.c_char*len(self.names)).from_buffer(self.names)
+        for i in range(self.count):
+            self.iovecs[i].iov_base = ctypes.addressof(data) + i*size
+            self.iovecs[i].iov_len = size
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(names) + i*SOCKADDR_SIZE
+            hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+            hdr.msg_iovlen = 1
+
+    def recv(self,wait=False):
+        """ Return a list of (data,address), empty if nothing is waiting
+
+            If wait is set, block until at least one datagram is received.
+        """
+        if not recvmmsg:
+            try:
+                return [self.sock.recvfrom(self.size,0 if wait else MSG_DONTWAIT)]
+            except BlockingIOError:
+                return []
+
+        while True:
+            for i in range(self.count):
+                self.msgs[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+            n = recvmmsg(self.sock.fileno(),self.msgs,self.count,MSG_WAITFORONE if wait else MSG_DONTWAIT,None)
+            if n >= 0: break
+            # Interrupted by a signal, an empty list would mean the end of the socket to callers
+            if ctypes.get_errno() == errno.EINTR: continue
+            if not wait and ctypes.get_errno() in (errno.EAGAIN,errno.EWOULDBLOCK):
+                return []
+            raise_errno()
+
+        res = []
+        for i in range(n):
+            sz = self.msgs[i].msg_len
+            name = memoryview(self.names)[i*SOCKADDR_SIZE:(i+1)*SOCKADDR_SIZE]
+            res.append((bytes(self.view[i*self.size:i*self.size+sz]),parse_sockaddr(name,self.msgs[i].msg_hdr.msg_namelen)))
+        return res
+
+
+class DatagramSender(object):
+    """ Send a list of datagrams with as few sendmmsg calls as possible, on a connected socket
+
+        Falls back to one sendmsg per datagram when sendmmsg is not available.
+    """
+
+    def __init__(self,sock,count=64):
+        self.sock = sock
+        self.count = count
+        if sendmmsg:
+            self.iovecs = (iovec*count)()
+            self.msgs = (mmsghdr*count)()
+            for i in range(count):
+                self.msgs[i].msg_hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+                self.msgs[i].msg_hdr.msg_iovlen = 1
+
+    def send(self,pkts):
+        """ Send packets given as lists of fragments, one datagram per packet """
+        if not sendmmsg:
+            for frags in pkts:
+                self.sock.sendmsg(frags)
+            return
+
+        # ctypes needs a contiguous bytes object per datagram, kept alive until sent
+        datagrams = [frags[0] if len(frags) == 1 and type(frags[0]) is bytes else b"".join(frags) for frags in pkts]
+        while datagrams:
+            batch = datagrams[:self.count]
+            for i,d in enumerate(batch):
+                self.iovecs[i].iov_base = ctypes.cast(ctypes.c_char_p(d),ctypes.c_void_p).value
+                self.iovecs[i].iov_len = len(d)
+            n = sendmmsg(self.sock.fileno(),self.msgs,len(batch),0)
+            if n < 0:
+                if ctypes.get_errno() == errno.EINTR: continue
+                raise_errno()
+            datagrams = datagrams[n:]
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import itertools
+import weakref
+import multiprocessing
+from threading import Lock
+from concurrent.futures import Future,ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import logging
+
+from pynet.module import Module
+
+logger = logging.getLogger("Offload")
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+logger.addHandler(ch)
+
+# Smallest shared memory segment used to exchange messages with a worker
+MIN_SEGMENT_SIZE = 1 << 16
+
+
+# Worker side, module instances and attached segments of each offloaded module
+worker_modules = {}
+worker_segments = {}
+
+def worker_open(key,module_cls,module_args):
+    # Endpoints live in the main process
+    worker_modules[key] = module_cls.from_cli(dict(module_args,ep1=None,ep2=None))
+
+def worker_attach(key,one,name):
+    shm = worker_segments.get((key,one))
+    if shm is None or shm.name != name:
+        if shm is not None: shm.close()
+        # Workers share the resource tracker of the main process, which unlinks the segment
+        shm = shared_memory.SharedMemory(name=name)
+        worker_segments[(key,one)] = shm
+    return shm
+
+def worker_handle(key,one,name,sizes):
+    """ Give messages stored in the segment to the module, write back what it returns when it fits """
+    shm = worker_attach(key,one,name)
+    messages = []
+    offset = 0
+    for sz in sizes:
+        messages.append(bytes(shm.buf[offset:offset+sz]))
+        offset += sz
+
+    out = [bytes(msg) for msg in worker_modules[key].handle_batch(messages,one)]
+    if sum(map(len,out)) > shm.size:
+        return None,out
+
+    offset = 0
+    for msg in out:
+        shm.buf[offset:offset+len(msg)] = msg
+        offset += len(msg)
+    return list(map(len,out)),None
+
+def worker_release(key):
+    worker_modules.pop(key,None)
+    for one in (True,False):
+        shm = worker_segments.pop((key,one),None)
+        if shm is not None: shm.close()
+
+
+def chain(future,result):
+    """ Complete result as future completes """
+    def done(future):
+        if future.exception() is None:
+            result.set_result(future.result())
+        else:
+            result.set_exception(future.exception())
+    future.add_done_callback(done)
+
+
+class OffloadPool(object):
+    """ Single process executors, a connection always uses the same one so its module state stays in one process """
+
+    def __init__(self,processes):
+        self.executors = [self.create_executor() for i in range(processes)]
+        self.lock = Lock()
+
+    @staticmethod
+    def create_executor():
+        # Workers are started when first used, forked from the proxy they would keep
+        # its listening socket and the sockets of open connections
+        return ProcessPoolExecutor(max_workers=1,mp_context=multiprocessing.get_context("forkserver"))
+
+    def get_slot(self,ep1):
+        return hash(ep1) % len(self.executors)
+
+    def get_executor(self,slot):
+        return self.executors[slot]
+
+    def replace_executor(self,slot,executor):
+        """ Replace the broken executor of slot, unless another connection already did, return the new one """
+        with self.lock:
+            if self.executors[slot] is executor:
+                logger.warning("Offload worker %d has died, starting a new one" % (slot,))
+                executor.shutdown(wait=False)
+                self.executors[slot] = self.create_executor()
+            return self.executors[slot]
+
+
+pools = {}
+pools_lock = Lock()
+
+def get_offload_pool(processes):
+    """ Return the global pool of this number of processes """
+    with pools_lock:
+        if not processes in pools:
+            pools[processes] = OffloadPool(processes)
+        return pools[processes]
+
+
+def release(pool,slot,key,segments):
+    for shm in segments.values():
+        shm.close()
+        shm.unlink()
+    try:
+        pool.get_executor(slot).submit(worker_release,key)
+    except RuntimeError:
+        # Executor already shut down at exit, or broken
+        pass
+
+
+class OffloadedModule(Module):
+    """ Run a module in a worker process
+
+        Messages are copied into a shared memory segment per direction and
+        handled by the same module instance, in order. handle_batch waits
+        for the result, forwarders driven by a loop use submit_batch and stop
+        reading the direction until the result comes. If the worker dies,
+        the module is created again in a new one and its state is lost.
+    """
+    # Messages are copied into shared memory without being converted to bytes
+    ZERO_COPY = True
+
+    keys = itertools.count()
+
+    def __init__(self,module_cls,module_args,pool,slot,*args,**kargs):
+        super().__init__(*args,**kargs)
+        self.module_cls = module_cls
+        self.module_args = module_cls.offload_args(module_args)
+        self.pool = pool
+        self.slot = slot
+        self.executor = pool.get_executor(slot)
+        self.lock = Lock()
+        self.key = next(OffloadedModule.keys)
+        self.segments = {}
+        try:
+            self.open()
+        except BrokenProcessPool:
+            self.restart(self.executor)
+        weakref.finalize(self,release,pool,slot,self.key,self.segments)
+
+    def open(self):
+        self.opened = self.executor.submit(worker_open,self.key,self.module_cls,self.module_args)
+
+    def open_error(self):
+        """ Exception raised while creating the module in the worker, calls fail without it """
+        if not self.opened.done(): return None
+        error = self.opened.exception()
+        return None if isinstance(error,BrokenProcessPool) else error
+
+    def restart(self,broken):
+        """ Create the module again in the worker replacing the broken executor, unless the other direction already did """
+        with self.lock:
+            if self.executor is broken:
+                self.executor = self.pool.replace_executor(self.slot,broken)
+                self.open()
+
+    def submit(self,then,f,*args,retry=True):
+        """ Call f in the worker, return a future of then(result), f is called again once if the worker has died """
+        result = Future()
+        executor = self.executor
+        try:
+            future = executor.submit(f,*args)
+        except BrokenProcessPool:
+            if not retry: raise
+            self.restart(executor)
+            return self.submit(then,f,*args,retry=False)
+
+        def done(future):
+            try:
+                # The worker handles calls in order, the module has been created or not by now
+                error = self.open_error()
+                if error is not None: raise error
+                try:
+                    res = future.result()
+                except BrokenProcessPool:
+                    if not retry: raise
+                    self.restart(executor)
+                    chain(self.submit(then,f,*args,retry=False),result)
+                    return
+                result.set_result(then(res))
+            except BaseException as e:
+                result.set_exception(e)
+        future.add_done_callback(done)
+        return result
+
+    def get_segment(self,one,size):
+        shm = self.segments.get(one)
+        if shm is None or shm.size < size:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            sz = MIN_SEGMENT_SIZE
+            while sz < size: sz <<= 1
+            shm = self.segments[one] = shared_memory.SharedMemory(create=True,size=sz)
+        return shm
+
+    def submit_batch(self,messages,one):
+        """ Start handle_batch in the worker, return a future of its result
+
+            Messages are copied before returning, a single batch per direction can be in progress.
+        """
+        sizes = list(map(len,messages))
+        shm = self.get_segment(one,sum(sizes))
+        offset = 0
+        for msg in messages:
+            shm.buf[offset:offset+len(msg)] = msg
+            offset += len(msg)
+
+        def read(res):
+            sizes,out = res
+            if out is not None:
+                return out
+            out = []
+            offset = 0
+            for sz in sizes:
+                out.append(bytes(shm.buf[offset:offset+sz]))
+                offset += sz
+            return out
+        return self.submit(read,worker_handle,self.key,one,shm.name,sizes)
+
+    def handle_batch(self,messages,one):
+        return self.submit_batch(messages,one).result()
+
+    def __repr__(self):
+        return "Offloaded(%s)" % (self.module_cls.__name__,)
+
+
+class OffloadContainer(object):
+    """ Same as ModuleContainer, but the module runs in one of the processes of the pool """
+
+    def __init__(self,module_cls,module_args,processes):
+        self.cls = module_cls
+        self.args = module_args
+        self.pool = get_offload_pool(processes)
+
+    def get(self,ep1,ep2):
+        return OffloadedModule(self.cls,self.args,self.pool,self.pool.get_slot(ep1),ep1=ep1,ep2=ep2)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+from collections import deque
+from threading import Thread,Condition
+
+import logging
+
+logger = logging.getLogger("Pool")
+logger.setLevel(logging.WARNING)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+logger.addHandler(ch)
+
+# Delay before trying again when the server cannot be reached
+RETRY_DELAY = 1
+
+
+class ConnectionPool(object):
+    """ Keep up to size endpoints connected in advance, refilled by a background thread
+
+        factory returns a new connected endpoint. Idle endpoints are dropped
+        after max_idle seconds, or as soon as is_alive says the peer has
+        closed them.
+    """
+
+    def __init__(self,factory,size,max_idle=30):
+        self.factory = factory
+        self.size = size
+        self.max_idle = max_idle
+        self.idle = deque()
+        self.cond = Condition()
+        self.stop = False
+        self.thread = Thread(target=self.refill,daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def is_usable(self,endpoint,connected):
+        if time.monotonic() - connected > self.max_idle:
+            return False
+        return endpoint.is_alive()
+
+    def get(self):
+        """ Return a connected endpoint, connect a new one if no idle one is usable """
+        with self.cond:
+            while self.idle:
+                endpoint,connected = self.idle.popleft()
+                self.cond.notify()
+                if self.is_usable(endpoint,connected):
+                    return endpoint
+                endpoint.close()
+        return self.factory()
+
+    def check_idle(self):
+        """ Close idle endpoints which cannot be used anymore, must be called with the lock held """
+        for item in list(self.idle):
+            if not self.is_usable(*item):
+                self.idle.remove(item)
+                item[0].close()
+
+    def refill(self):
+        while True:
+            with self.cond:
+                self.check_idle()
+                while not self.stop and len(self.idle) >= self.size:
+                    self.cond.wait(min(self.max_idle,1))
+                    self.check_idle()
+                if self.stop:
+                    break
+
+            try:
+                endpoint = self.factory()
+            except OSError as e:
+                logger.warning("Cannot fill the connection pool: %s" % (e,))
+                time.sleep(RETRY_DELAY)
+                continue
+
+            with self.cond:
+                if self.stop:
+                    endpoint.close()
+                    break
+                self.idle.append((endpoint,time.monotonic()))
+
+    def close(self):
+        with self.cond:
+            self.stop = True
+            self.cond.notify()
+            while self.idle:
+                self.idle.popleft()[0].close()
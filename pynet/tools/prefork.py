@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import mmap
+import struct
+import signal
+import atexit
+import traceback
+from threading import Lock
+
+import logging
+
+logger = logging.getLogger("Prefork")
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+logger.addHandler(ch)
+
+# A worker dying sooner than that after its start is restarted with a delay
+MIN_WORKER_LIFETIME = 1
+
+
+class WorkerStats(object):
+    """ Counters of each worker, in memory shared between the master and its workers """
+    COUNTERS = struct.Struct("qq") # connections, active connections
+
+    def __init__(self,workers):
+        self.workers = workers
+        self.mem = mmap.mmap(-1,self.COUNTERS.size*workers)
+        self.lock = Lock()
+
+    def add(self,slot,connections,active):
+        with self.lock:
+            offset = slot*self.COUNTERS.size
+            c,a = self.COUNTERS.unpack_from(self.mem,offset)
+            self.COUNTERS.pack_into(self.mem,offset,c+connections,a+active)
+
+    def reset_active(self,slot):
+        c,a = self.COUNTERS.unpack_from(self.mem,slot*self.COUNTERS.size)
+        self.COUNTERS.pack_into(self.mem,slot*self.COUNTERS.size,c,0)
+
+    def get(self,slot):
+        return self.COUNTERS.unpack_from(self.mem,slot*self.COUNTERS.size)
+
+
+# Set in worker processes: (stats,slot)
+worker = None
+
+def worker_path(path):
+    """ Path of a file written by every worker, this one writes PATH.slot """
+    if worker:
+        return "%s.%d" % (path,worker[1])
+    return path
+
+def connection_opened():
+    if worker:
+        worker[0].add(worker[1],1,1)
+
+def connection_closed():
+    if worker:
+        worker[0].add(worker[1],0,-1)
+
+
+def terminate_worker(signum,frame):
+    sys.exit(0)
+
+
+class Prefork(object):
+    """ Run target in N forked workers, restart those which crash
+
+        Workers have to share the listening port, by binding it with
+        SO_REUSEPORT. SIGTERM or SIGINT stops every worker, SIGUSR2 prints
+        the statistics of the workers.
+    """
+
+    def __init__(self,workers,target):
+        self.workers = workers
+        self.target = target
+        self.stats = WorkerStats(workers)
+        self.children = {}
+        self.restarts = 0
+        self.stop = False
+
+    def spawn(self,slot):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (slot,time.monotonic())
+            return
+
+        global worker
+        worker = (self.stats,slot)
+        # Leave through SystemExit, for the exit handlers to run
+        signal.signal(signal.SIGTERM,terminate_worker)
+        signal.signal(signal.SIGUSR2,signal.SIG_DFL)
+        signal.signal(signal.SIGINT,signal.default_int_handler)
+        code = 1
+        try:
+            code = self.target() or 0
+        except SystemExit as e:
+            code = e.code if type(e.code) is int else 1
+        except KeyboardInterrupt:
+            code = 0
+        except:
+            traceback.print_exc()
+        finally:
+            # os._exit skips them, writers of modules flush their files there
+            atexit._run_exitfuncs()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def terminate(self,signum,frame):
+        self.stop = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid,signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def print_stats(self,signum=None,frame=None):
+        total = [0,0]
+        for slot in range(self.workers):
+            connections,active = self.stats.get(slot)
+            total[0] += connections
+            total[1] += active
+            print("worker %d: %d connections, %d active" % (slot,connections,active))
+        print("total: %d workers, %d restarts, %d connections, %d active" % (self.workers,self.restarts,total[0],total[1]))
+        sys.stdout.flush()
+
+    def run(self):
+        signal.signal(signal.SIGTERM,self.terminate)
+        signal.signal(signal.SIGINT,self.terminate)
+        signal.signal(signal.SIGUSR2,self.print_stats)
+
+        for slot in range(self.workers):
+            self.spawn(slot)
+
+        while self.children:
+            try:
+                pid,status = os.wait()
+            except ChildProcessError:
+                break
+            slot,started = self.children.pop(pid)
+            # Its connections died with it
+            self.stats.reset_active(slot)
+            if self.stop:
+                continue
+
+            code = os.waitstatus_to_exitcode(status)
+            logger.warning("Worker %d (pid %d) exited with %d, restarting it" % (slot,pid,code))
+            if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                time.sleep(MIN_WORKER_LIFETIME)
+                if self.stop: continue
+            self.restarts += 1
+            self.spawn(slot)
+
+        self.print_stats()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import signal
+import threading
+from threading import Thread,Lock
+
+from pynet.forwarder import ThreadForwarder,SelectorLoop
+from pynet.proxy import Proxy
+from pynet.tools import prefork
+from pynet.tools.metrics import DIRECTIONS
+
+import logging
+
+logger = logging.getLogger("Profiler")
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+logger.addHandler(ch)
+
+# Functions whose locals tell which connection and direction a thread is forwarding
+TAGGED_FUNCTIONS = ("fw","run","ready","writable")
+
+# Leaf added to samples of threads which did not use the CPU since the previous sample
+OFF_CPU = "[off-cpu]"
+
+
+def thread_kind(thread):
+    """ Name of the sampled threads in the profile, None for threads which are not sampled """
+    if isinstance(thread,ThreadForwarder.FwdThread): return "FwdThread"
+    if isinstance(thread,SelectorLoop): return "SelectorLoop"
+    if isinstance(thread,Proxy.BackgroundTask): return "BackgroundTask"
+    # Proxies accept clients and asyncio forwarders run in the main thread
+    if thread is threading.main_thread(): return "MainThread"
+    return None
+
+
+def cpu_clock(thread):
+    """ Clock of the CPU time used by thread, None if unavailable
+
+        Built from the thread id as the kernel does, so reading the clock of
+        a thread which has ended fails instead of reading a freed pthread.
+    """
+    if not sys.platform.startswith("linux") or not thread.native_id:
+        return None
+    return ((~thread.native_id) << 3) | 6
+
+
+def connection(frame):
+    """ Return the id and direction of the connection forwarded in the stack of frame, None outside of one """
+    while frame is not None:
+        if frame.f_code.co_name in TAGGED_FUNCTIONS:
+            local = frame.f_locals
+            owner = local.get("self")
+            # Forwarder.fw, for every forwarder
+            if "from_client" in local and hasattr(owner,"id"):
+                return owner.id,local["from_client"]
+            # FwdThread.run and the selector watchers, also when splicing
+            forwarder = getattr(owner,"forwarder",None)
+            if forwarder is not None and hasattr(owner,"from_ep1"):
+                return getattr(forwarder,"id",0),owner.from_ep1
+        frame = frame.f_back
+    return None
+
+
+def terminate(signum,frame):
+    sys.exit(128 + signum)
+
+
+def format_frame(frame):
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_qualname,os.path.basename(code.co_filename),code.co_firstlineno)
+
+
+class SamplingProfiler(Thread):
+    """ Sample the stacks of forwarding threads rate times per second
+
+        Stacks are counted in the collapsed format of flame graphs, one line
+        per stack "thread;conn ID;direction;frame;...;frame count", written
+        to output on SIGUSR1 and when stopped.
+    """
+
+    def __init__(self,rate=100,output=None):
+        super().__init__(name="profiler")
+        self.daemon = True
+        self.interval = 1./rate
+        self.output = output if output else "pynet-profile-%d.txt" % (os.getpid(),)
+        self.stacks = {}
+        self.samples = 0
+        self.lock = Lock()
+        self.running = True
+        # Last CPU time of the sampled threads, by thread id
+        self.cpu = {}
+
+    def start(self):
+        super().start()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1,self.dump)
+            # Exit through the stop of the profiler when terminated
+            if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+                signal.signal(signal.SIGTERM,terminate)
+        logger.info("Profiling forwarding threads %d times per second into %s" % (1/self.interval,self.output))
+
+    def run(self):
+        next_sample = time.monotonic()
+        while self.running:
+            self.sample()
+            next_sample += self.interval
+            delay = next_sample - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # Too slow to keep the rate, skip the missed samples
+                next_sample = time.monotonic()
+
+    def on_cpu(self,thread):
+        clock = cpu_clock(thread)
+        if clock is None: return True
+        try:
+            now = time.clock_gettime(clock)
+        except OSError:
+            return True
+        last = self.cpu.get(thread.ident)
+        self.cpu[thread.ident] = now
+        return last is None or now > last
+
+    def sample(self):
+        frames = sys._current_frames()
+        threads = {t.ident:t for t in threading.enumerate()}
+        stacks = []
+        for ident,frame in frames.items():
+            thread = threads.get(ident)
+            kind = thread_kind(thread) if thread is not None else None
+            if kind is None: continue
+
+            calls = []
+            f = frame
+            while f is not None:
+                calls.append(format_frame(f))
+                f = f.f_back
+            calls.reverse()
+
+            stack = [kind]
+            tag = connection(frame)
+            if tag is not None:
+                stack += ["conn %d" % (tag[0],),DIRECTIONS[bool(tag[1])]]
+            stack += calls
+            if not self.on_cpu(thread):
+                stack.append(OFF_CPU)
+            stacks.append(";".join(stack))
+
+        # Forget the clocks of ended threads
+        for ident in list(self.cpu):
+            if not ident in frames:
+                del self.cpu[ident]
+
+        with self.lock:
+            self.samples += 1
+            for stack in stacks:
+                self.stacks[stack] = self.stacks.get(stack,0) + 1
+
+    def dump(self,signum=None,frame=None):
+        """ Write the stacks sampled since the start to output """
+        with self.lock:
+            stacks = sorted(self.stacks.items())
+            samples = self.samples
+        tmp = self.output + ".tmp"
+        try:
+            with open(tmp,"w") as f:
+                for stack,count in stacks:
+                    f.write("%s %d\n" % (stack,count))
+            os.replace(tmp,self.output)
+        except OSError as e:
+            logger.warning("Cannot write the profile to %s: %s" % (self.output,e))
+            return
+        logger.info("%d samples, %d stacks written to %s" % (samples,len(stacks),self.output))
+
+    def stop(self):
+        self.running = False
+        self.dump()
+
+
+def profiled(target,rate=100,output=None):
+    """ Return a function running target under a SamplingProfiler
+
+        Forked workers each write their own profile, to output.slot.
+    """
+    def run():
+        path = prefork.worker_path(output) if output else None
+        profiler = SamplingProfiler(rate,path)
+        profiler.start()
+        try:
+            return target()
+        finally:
+            profiler.stop()
+    return run
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import atexit
+import itertools
+
+import logging
+
+from pynet.tools import metrics
+
+logger = logging.getLogger("Tracing")
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+logger.addHandler(ch)
+
+STAGE_BUCKETS = (.00001,.000025,.00005,.0001,.00025,.0005,.001,.0025,.005,.01,.025,.05,.1,.25,1)
+
+stage_latency = metrics.registry.histogram("pynet_stage_latency_seconds","Time spent by sampled messages in each stage of the forwarding pipeline",STAGE_BUCKETS,("proxy","stage","module"))
+pipeline_latency = metrics.registry.histogram("pynet_pipeline_latency_seconds","Time between the reception and the sending of sampled messages",STAGE_BUCKETS,("proxy",))
+
+# Trace 1 message out of sample_every, 0 disables tracing
+sample_every = 0
+# Messages taking longer than that, in seconds, are logged
+slow_threshold = None
+counter = itertools.count()
+
+
+def configure(every,slow_ms=None,slow_log=None):
+    """ Enable tracing of 1 message out of every """
+    global sample_every,slow_threshold
+    sample_every = every
+    slow_threshold = slow_ms/1000. if slow_ms else None
+    if slow_log:
+        handler = logging.FileHandler(slow_log)
+        logger.addHandler(handler)
+        logger.removeHandler(ch)
+    if every:
+        atexit.register(print_summary)
+
+
+def sample(forwarder,from_client):
+    """ Return a Trace if this message is sampled, None otherwise """
+    if not sample_every or next(counter) % sample_every:
+        return None
+    return Trace(forwarder,from_client)
+
+
+class Trace(object):
+    """ Timestamps of messages going through a forwarder, taken from their reception """
+
+    def __init__(self,forwarder,from_client):
+        self.forwarder = forwarder
+        self.from_client = from_client
+        self.start = self.last = time.perf_counter()
+        self.stages = []
+
+    def mark(self,stage,module=""):
+        now = time.perf_counter()
+        self.stages.append((stage,module,now - self.last))
+        self.last = now
+
+    def end(self):
+        proxy = self.forwarder.name
+        for stage,module,duration in self.stages:
+            stage_latency.labels(proxy,stage,module).observe(duration)
+        total = self.last - self.start
+        pipeline_latency.labels(proxy).observe(total)
+
+        if slow_threshold is not None and total >= slow_threshold:
+            logger.warning("Slow message on connection %d (%r, %s): %.3f ms [%s]" % \
+                           (self.forwarder.id,self.forwarder,metrics.DIRECTIONS[self.from_client],total*1000,
+                            ", ".join("%s %.3f ms" % (module if module else stage,duration*1000) for stage,module,duration in self.stages)))
+
+
+def print_summary():
+    """ Mean time spent in each stage by sampled messages """
+    for family in (stage_latency,pipeline_latency):
+        for labels,histogram in list(family.children.items()):
+            values = histogram.values()
+            count = sum(values[:-1])
+            if not count: continue
+            print("%s %s: %d messages, mean %.3f ms" % (family.name,"/".join(l for l in labels if l),count,values[-1]/count*1000))
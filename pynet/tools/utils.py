@@ -37,26 +37,24 @@ class DirectAccessDict(dict):
     def __getattr__(self,f):
         return self[f]
 
-def hexdump(s,size=16):
+# Replace non printable characters by a dot in the ascii column of hexdumps
+HEXDUMP_TABLE = bytes(c if 32 <= c <= 126 else ord(".") for c in range(256))
+
+def hexdump_lines(s,size=16,limit=None):
+    """ Return the lines of the hexdump of s, truncated to limit bytes """
+    s = bytes(s)
+    shown = s[:limit] if limit else s
+    lines = []
+    for i in range(0,len(shown),size):
+        chunk = shown[i:i+size]
+        lines.append("%s\t\t|%s|" % ((chunk.hex(" ") + " ").ljust(size*3),chunk.translate(HEXDUMP_TABLE).decode("ascii").ljust(size)))
+    if limit and len(s) > limit:
+        lines.append("... %d more bytes" % (len(s) - limit,))
+    return lines
+
+def hexdump(s,size=16,limit=None):
     """ Hexdump data """
-    def out(c):
-        if c < 32 or c > 126: sys.stdout.write(".")
-        else: sys.stdout.write(chr(c))
-
-    s = list(s)
-    for i in range(len(s)):
-        sys.stdout.write("%02x " % (s[i],))
-        if i != 0 and i%size == size-1:
-            sys.stdout.write("\t\t|")
-            for j in range(i-size+1,i+1):
-                out(s[j])
-            sys.stdout.write("|\n")
-    l = len(s)
-    m = l%size
-    sys.stdout.write("%s\t\t|" % (" "*(size-m)*3,))
-    for i in range(l-m,l):
-        out(s[i])
-    sys.stdout.write("%s|\n" % (" "*(size-m),))
+    sys.stdout.write("".join("%s\n" % l for l in hexdump_lines(s,size,limit)))
 
 def get_all_subclasses(cls):
     all_subclasses = []
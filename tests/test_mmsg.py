@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import socket
+import struct
+import unittest
+
+from pynet.tools.mmsg import parse_sockaddr,DatagramReceiver
+
+
+def sockaddr_in6(ip,port,flowinfo,scope_id):
+    """ struct sockaddr_in6 as filled by the kernel """
+    return bytearray(struct.pack("=H",socket.AF_INET6) + struct.pack("!HI",port,flowinfo) +
+                     socket.inet_pton(socket.AF_INET6,ip) + struct.pack("=I",scope_id))
+
+
+class TestParseSockaddr(unittest.TestCase):
+    def test_ipv4(self):
+        addr = bytearray(struct.pack("=H",socket.AF_INET) + struct.pack("!H",5353) + socket.inet_aton("192.0.2.1") + b"\x00"*8)
+        self.assertEqual(parse_sockaddr(addr,len(addr)),("192.0.2.1",5353))
+
+    def test_ipv6(self):
+        addr = sockaddr_in6("fe80::1",5353,0x12345,2)
+        self.assertEqual(parse_sockaddr(addr,len(addr)),("fe80::1",5353,0x12345,2))
+
+    def test_ipv6_received(self):
+        # Same address as the socket module gives
+        try:
+            receiver = socket.socket(socket.AF_INET6,socket.SOCK_DGRAM)
+            receiver.bind(("::1",0))
+        except OSError:
+            self.skipTest("IPv6 is not available")
+        sender = socket.socket(socket.AF_INET6,socket.SOCK_DGRAM)
+        try:
+            sender.bind(("::1",0))
+            sender.sendto(b"data",receiver.getsockname())
+            self.assertEqual(DatagramReceiver(receiver).recv(wait=True),[(b"data",sender.getsockname())])
+        finally:
+            sender.close()
+            receiver.close()
+
+    def test_empty(self):
+        self.assertIsNone(parse_sockaddr(bytearray(16),0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import signal
+import socket
+import socketserver
+import threading
+import itertools
+import unittest
+
+from pynet.forwarder import SelectorForwarder,ThreadForwarder
+from pynet.module import Module,create_pipeline
+from pynet.modules.Corrupt import Corrupt
+from pynet.proxys.layer4 import TCPProxy
+
+CORRUPT_NOTHING = {"seed":None,"bytes":False,"number":None,"percentage":0.01,"request":False,"response":False,"both":False}
+CORRUPT_SEEDED = dict(CORRUPT_NOTHING,seed=1,bytes=True,number=8,both=True)
+
+
+class Slow(Module):
+    """ Hold messages starting with slow for a while """
+    def handle(self,data,one):
+        if data.startswith(b"slow"): time.sleep(1)
+        return data
+
+
+class Broken(Module):
+    def __init__(self,*args,**kargs):
+        raise ValueError("bad arguments")
+
+
+class Endpoint(object):
+    """ Endpoint placeholder choosing the worker of its connection """
+    def __init__(self,worker):
+        self.worker = worker
+
+    def __hash__(self):
+        return self.worker
+
+
+class EchoHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            data = self.request.recv(65536)
+            if not data: break
+            self.request.sendall(data)
+        # The proxy has closed its connection to the server
+        self.server.ended.release()
+
+
+def start_echo_server():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1",0),EchoHandler)
+    server.daemon_threads = True
+    server.ended = threading.Semaphore(0)
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server
+
+
+def start_proxy(server,forwarder,module=(Corrupt,CORRUPT_NOTHING),processes=1):
+    """ Return the port of a TCP proxy running module in worker processes """
+    sock = socket.socket()
+    sock.bind(("127.0.0.1",0))
+    port = sock.getsockname()[1]
+    sock.close()
+    module = create_pipeline([(module[0],dict(module[1]))],processes)
+    proxy = TCPProxy(bind="127.0.0.1",port=port,server_ip="127.0.0.1",server_port=server.server_address[1],
+                     forwarder=forwarder,module=module)
+    proxy.start()
+    return port,module[0].pool
+
+
+def exchange(port,data):
+    """ Send data and return as many bytes received back """
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            sock = socket.create_connection(("127.0.0.1",port),timeout=10)
+            break
+        except ConnectionRefusedError:
+            # The proxy is not listening yet
+            if time.monotonic() > deadline: raise
+            time.sleep(0.05)
+    try:
+        sock.sendall(data)
+        received = b""
+        while len(received) < len(data):
+            chunk = sock.recv(65536)
+            if not chunk: break
+            received += chunk
+        return received
+    finally:
+        sock.close()
+
+
+class TestOffload(unittest.TestCase):
+    def setUp(self):
+        self.server = start_echo_server()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def check_sequential_connections(self,forwarder):
+        port,pool = start_proxy(self.server,forwarder)
+        for i in range(2):
+            data = b"connection %d " % (i,) * 1000
+            self.assertEqual(exchange(port,data),data)
+            self.assertTrue(self.server.ended.acquire(timeout=5),"connection %d not closed on the server side" % (i,))
+
+    def test_sequential_connections_selector(self):
+        # Workers must not hold the sockets of the proxy, or EOF never comes
+        self.check_sequential_connections(SelectorForwarder)
+
+    def test_sequential_connections_thread(self):
+        self.check_sequential_connections(ThreadForwarder)
+
+    def test_selector_not_blocked(self):
+        port,pool = start_proxy(self.server,SelectorForwarder,(Slow,{}),4)
+        # Connections use the workers in turn
+        slots = itertools.count()
+        pool.get_slot = lambda ep1:next(slots) % len(pool.executors)
+        # Workers are started by their first connection
+        for i in range(len(pool.executors)):
+            exchange(port,b"warm up")
+        slow = threading.Thread(target=exchange,args=(port,b"slow"))
+        slow.start()
+        time.sleep(0.2)
+        start = time.monotonic()
+        # The loop forwards other connections while a worker is busy
+        self.assertEqual(exchange(port,b"fast"),b"fast")
+        self.assertLess(time.monotonic() - start,0.5)
+        slow.join()
+
+
+class TestOffloadedModule(unittest.TestCase):
+    def test_connections_of_workers_differ(self):
+        # Each worker numbers connections from 0, with the same seed they would be corrupted the same way
+        container = create_pipeline([(Corrupt,dict(CORRUPT_SEEDED))],2)[0]
+        data = bytes(range(256))*16
+        out = [container.get(Endpoint(i),None).handle_batch([data],True)[0] for i in range(2)]
+        self.assertNotEqual(out[0],data)
+        self.assertNotEqual(out[0],out[1])
+
+    def test_open_error(self):
+        # The error of the module is raised, not the missing module in the worker
+        module = create_pipeline([(Broken,{})],3)[0].get(Endpoint(1),None)
+        with self.assertRaisesRegex(ValueError,"bad arguments"):
+            module.handle_batch([b"data"],True)
+
+    def test_killed_worker(self):
+        container = create_pipeline([(Corrupt,dict(CORRUPT_NOTHING))],3)[0]
+        module = container.get(Endpoint(0),None)
+        self.assertEqual(module.handle_batch([b"before"],True),[b"before"])
+        executor = container.pool.get_executor(0)
+        for pid in list(executor._processes):
+            os.kill(pid,signal.SIGKILL)
+        # The connection goes on with a new worker, as well as new ones
+        self.assertEqual(module.handle_batch([b"after"],True),[b"after"])
+        self.assertIsNot(container.pool.get_executor(0),executor)
+        self.assertEqual(container.get(Endpoint(0),None).handle_batch([b"new"],False),[b"new"])
+
+
+if __name__ == "__main__":
+    unittest.main()